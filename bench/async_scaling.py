@@ -0,0 +1,163 @@
+# Concurrent-connection scaling: sync (Flask) build vs async (ASGI) build
+#
+# Starts one gunicorn worker per build, seeds it over HTTP, then sweeps the
+# number of concurrent client connections and reports throughput and
+# p50/p99 latency of a checkout-heavy mix for each. Both builds share the
+# database modules, so the difference is only in how a worker waits on
+# MongoDB. Without a mongod, run on the memory backend with an emulated
+# round trip:
+#
+#   python bench/async_scaling.py --backend memory --db-latency-ms 2
+#   python bench/async_scaling.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+BUILDS = {
+    'sync': ['app:app'],
+    'async': ['-k', 'uvicorn.workers.UvicornWorker', 'asgi:app'],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def call(port, method, path, body=None):
+    # A fresh connection per request: sync workers close the connection anyway
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        connection.request(method, path, body=payload, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
+
+
+def start_server(build, port, args):
+    env = dict(os.environ, STORAGE_BACKEND=args.backend, MONGODB_URI=args.mongodb_uri,
+               MONGODB_DATABASE=args.database, MEMORY_DB_LATENCY_MS=str(args.db_latency_ms),
+               MONGODB_ENSURE_INDEXES='true', BCRYPT_ROUNDS='4')
+    command = [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}',
+               '--log-level', 'warning', *BUILDS[build]]
+    # gunicorn.conf.py is read from the working directory
+    process = subprocess.Popen(command, cwd=SERVER_DIR, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if call(port, 'GET', '/livez')[0] == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f'{build} server did not start')
+
+
+def seed(port, args):
+    # Through the API so the memory backend's in-process store is populated
+    call(port, 'POST', '/create_hardware_set', {'hwSetName': 'HWSet-hot', 'initCapacity': 100000})
+    for i in range(args.users):
+        username = f'bench-user-{i}'
+        call(port, 'POST', '/register', {'username': username, 'password': 'bench-pass',
+                                         'email': f'{username}@bench.local'})
+        call(port, 'POST', '/create_project', {'projectName': username, 'projectId': f'bench-project-{i}',
+                                               'username': username})
+        call(port, 'POST', '/join_project', {'projectId': f'bench-project-{i}', 'username': username})
+
+
+def run_level(port, connections, duration, users):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(n):
+        rng = random.Random(n)
+        i = n % users
+        body = {'projectId': f'bench-project-{i}', 'hwSetName': 'HWSet-hot', 'qty': 1, 'username': f'bench-user-{i}'}
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            roll = rng.random()
+            if roll < 0.4:
+                request = ('GET', '/get_all_hardware', None)
+            elif roll < 0.7:
+                request = ('POST', '/check_out', body)
+            else:
+                request = ('POST', '/check_in', body)
+            start = time.perf_counter()
+            try:
+                status, _ = call(port, *request)
+                failed += status >= 500
+            except OSError:
+                failed += 1
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'connections': connections,
+        'requests': count,
+        'errors': errors[0],
+        'throughput_rps': round(count / duration, 1),
+        'p50_ms': round(latencies[count // 2] * 1000, 2) if count else None,
+        'p99_ms': round(latencies[min(count - 1, int(count * 0.99))] * 1000, 2) if count else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync vs async build concurrency scaling')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--db-latency-ms', type=float, default=2.0,
+                        help='emulated round trip per operation on the memory backend')
+    parser.add_argument('--connections', default='1,4,16,64', help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per level')
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--builds', default='sync,async')
+    args = parser.parse_args()
+
+    report = {'config': vars(args), 'builds': {}}
+    for build in args.builds.split(','):
+        if args.backend == 'mongo':
+            from pymongo import MongoClient
+            MongoClient(args.mongodb_uri).drop_database(args.database)
+        port = free_port()
+        process = start_server(build, port, args)
+        try:
+            seed(port, args)
+            report['builds'][build] = [
+                run_level(port, int(level), args.duration, args.users) for level in args.connections.split(',')
+            ]
+        finally:
+            process.terminate()
+            process.wait()
+        for row in report['builds'][build]:
+            print(f"{build:>5} {row['connections']:>4} conns: {row['throughput_rps']:>8} req/s  "
+                  f"p50 {row['p50_ms']} ms  p99 {row['p99_ms']} ms  errors {row['errors']}", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Burst checkouts of one hardware set, with and without write coalescing
+#
+# Hammers requestSpace (qty 1) on a single set from many threads for a fixed
+# time, first with coalescing off, then with each coalescing window, and
+# reports checkouts per second, latency percentiles, writes per checkout and
+# the average group size. Checks afterwards that availability plus every
+# granted unit equals the capacity. --capacity below the expected demand also
+# exercises the partial grants once units run out.
+#
+# On the memory backend, MEMORY_DB_WRITE_MS models how long MongoDB holds the
+# hot document per write and MEMORY_DB_LATENCY_MS the network round trip:
+#
+#   python bench/checkout_coalescing.py --windows 0.5,1,2,5
+#   python bench/checkout_coalescing.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+def run(client, hw_name, window_ms, capacity, threads, duration):
+    import checkout_coalescer
+    import db_utils
+    import hardwareDatabase
+    import hardware_cache
+
+    db = db_utils.get_database(client)
+    db['hardware_sets'].delete_many({'hwName': hw_name})
+    hardwareDatabase.createHardwareSet(client, hw_name, capacity)
+    hardware_cache.invalidate()
+    checkout_coalescer.CHECKOUT_COALESCE_ENABLED = window_ms is not None
+    checkout_coalescer.CHECKOUT_COALESCE_WINDOW_MS = window_ms or 0
+    coalescer = checkout_coalescer._coalescer = checkout_coalescer.CheckoutCoalescer()
+
+    granted = [0] * threads
+    attempts = [0] * threads
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+    stop = threading.Event()
+
+    def worker(index):
+        barrier.wait()
+        while not stop.is_set():
+            start = time.perf_counter()
+            result = hardwareDatabase.requestSpace(client, hw_name, 1)
+            latencies[index].append((time.perf_counter() - start) * 1000)
+            attempts[index] += 1
+            if result['success']:
+                granted[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    total_granted = sum(granted)
+    remaining = db['hardware_sets'].find_one({'hwName': hw_name})['availability']
+    samples = [ms for per_thread in latencies for ms in per_thread]
+    stats = coalescer.get_stats()
+    # Without coalescing every request is its own write
+    writes = stats['groups'] if window_ms is not None else sum(attempts)
+    return {
+        'requests_per_s': sum(attempts) / elapsed,
+        'p50_ms': percentile(samples, 0.5),
+        'p99_ms': percentile(samples, 0.99),
+        'writes_per_request': writes / sum(attempts) if attempts else 0,
+        'avg_group': stats['avg_group'] or 1,
+        'granted': total_granted,
+        'consistent': remaining >= 0 and remaining + total_granted == capacity
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checkout write-coalescing benchmark')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--windows', default='0.5,1,2,5', help='comma-separated coalescing windows (ms)')
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per run')
+    parser.add_argument('--capacity', type=int, default=10000000, help='large enough not to run out')
+    parser.add_argument('--write-ms', type=float, default=2.0, help='memory backend: per-document write hold')
+    parser.add_argument('--latency-ms', type=float, default=0.5, help='memory backend: round trip latency')
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    os.environ['MEMORY_DB_WRITE_MS'] = str(args.write_ms)
+    os.environ['MEMORY_DB_LATENCY_MS'] = str(args.latency_ms)
+    sys.path.insert(0, SERVER_DIR)
+    import db_utils
+
+    client = db_utils.get_mongo_client()
+    db_utils.ensure_indexes(client)
+    print(f'{args.threads} threads, {args.duration:g}s per run ({args.backend} backend)')
+    failed = False
+    for window in [None] + [float(w) for w in args.windows.split(',')]:
+        summary = run(client, '__bench_coalescing__', window, args.capacity, args.threads, args.duration)
+        failed |= not summary['consistent']
+        label = 'off' if window is None else f'{window:g} ms'
+        print(f"  window {label:>7}: {summary['requests_per_s']:8.0f} req/s  "
+              f"p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+              f"writes/req {summary['writes_per_request']:.3f}  group {summary['avg_group']:6.2f}  "
+              f"granted {summary['granted']}  consistent {summary['consistent']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Concurrency check for hardwareDatabase.requestSpace
+#
+# Hammers a single hardware set from many threads and verifies that
+# availability never goes negative and that every granted unit is accounted
+# for: used + availability must equal the capacity. Exits non-zero otherwise,
+# so it doubles as a regression test. Runs on the memory backend by default;
+# pass --backend mongo to check against a live mongod:
+#
+#   python bench/checkout_contention.py
+#   python bench/checkout_contention.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import sys
+import threading
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def run(client, hw_name, capacity, threads, attempts, qty):
+    """Run the contention check and return a summary dict."""
+    import db_utils
+    import hardwareDatabase
+    import hardware_cache
+
+    hardware_collection = db_utils.get_database(client)['hardware_sets']
+    hardware_collection.delete_many({'hwName': hw_name})
+    hardwareDatabase.createHardwareSet(client, hw_name, capacity)
+    hardware_cache.invalidate()
+
+    granted = []
+    observed_negative = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        barrier.wait()
+        for _ in range(attempts):
+            result = hardwareDatabase.requestSpace(client, hw_name, qty)
+            if result['success']:
+                with lock:
+                    granted.append(qty)
+                    if result.get('new_availability', 0) < 0:
+                        observed_negative.append(result['new_availability'])
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    final = hardware_collection.find_one({'hwName': hw_name})['availability']
+    hardware_collection.delete_many({'hwName': hw_name})
+
+    used = sum(granted)
+    return {
+        'capacity': capacity,
+        'requested': threads * attempts * qty,
+        'used': used,
+        'final_availability': final,
+        'negative_observations': len(observed_negative),
+        'consistent': final >= 0 and not observed_negative and used + final == capacity
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent requestSpace check')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--hw-name', default='__bench_contention__')
+    parser.add_argument('--capacity', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--attempts', type=int, default=50)
+    parser.add_argument('--qty', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    sys.path.insert(0, SERVER_DIR)
+    import db_utils
+
+    client = db_utils.get_mongo_client()
+    db_utils.ensure_indexes(client)
+    summary = run(client, args.hw_name, args.capacity, args.threads, args.attempts, args.qty)
+    for key, value in summary.items():
+        print(f'{key}: {value}')
+    sys.exit(0 if summary['consistent'] else 1)
+
+
+if __name__ == '__main__':
+    main()
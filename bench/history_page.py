@@ -0,0 +1,111 @@
+# Micro-benchmark for projectsDatabase.getProjectUsageHistory
+#
+# Compares the old read path (fetch the whole project document, sort the
+# embedded usageHistory array in Python, copy every entry to format its
+# timestamp) against the current server-side sorted, limited and formatted
+# page from usage_history. Reports bytes received from the server and
+# latency for each. Requires a live mongod:
+#
+#   MONGODB_URI=mongodb://localhost:27017/ python bench/history_page.py
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+import bson
+from pymongo import MongoClient, monitoring
+
+import db_utils
+import projectsDatabase
+
+
+class _ReplyBytes(monitoring.CommandListener):
+    """Sum the BSON size of every reply the server sends."""
+
+    def __init__(self):
+        self.total = 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.total += len(bson.encode(event.reply))
+
+    def failed(self, event):
+        pass
+
+
+def legacy_history(client, projectId, limit):
+    """The previous implementation, kept here as the baseline."""
+    project = db_utils.get_database(client)['projects'].find_one({'projectId': projectId})
+    history = project.get('usageHistory', [])
+    history_sorted = sorted(history, key=lambda x: x.get('timestamp', datetime.min), reverse=True)[:limit]
+    history_formatted = []
+    for entry in history_sorted:
+        formatted_entry = entry.copy()
+        if 'timestamp' in formatted_entry and isinstance(formatted_entry['timestamp'], datetime):
+            formatted_entry['timestamp'] = formatted_entry['timestamp'].isoformat()
+        history_formatted.append(formatted_entry)
+    return history_formatted
+
+
+def seed(client, projectId, entries, legacy_projectId):
+    db = db_utils.get_database(client)
+    db['projects'].delete_many({'projectId': {'$in': [projectId, legacy_projectId]}})
+    db['usage_history'].delete_many({'projectId': projectId})
+
+    base = datetime.utcnow() - timedelta(days=1)
+    history = [
+        {'timestamp': base + timedelta(seconds=i), 'action': 'checkout' if i % 2 else 'checkin',
+         'hwSetName': 'HWSet1', 'qty': 1 + i % 5, 'username': f'user{i % 10}'}
+        for i in range(entries)
+    ]
+    project = {'projectName': 'bench', 'description': 'history benchmark', 'hwSets': {'HWSet1': 0},
+               'users': [f'user{i}' for i in range(10)], 'owner': 'user0'}
+    # Legacy layout keeps at most 100 embedded entries
+    db['projects'].insert_one(dict(project, projectId=legacy_projectId, usageHistory=history[-100:]))
+    db['projects'].insert_one(dict(project, projectId=projectId))
+    db['usage_history'].insert_many([dict(entry, projectId=projectId) for entry in history])
+
+
+def measure(label, fn, iterations, listener):
+    fn()  # warm up
+    listener.total = 0
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(f'{label:>10}: {listener.total / iterations:9.0f} bytes/call  '
+          f'p50 {statistics.median(timings):6.2f} ms  p95 {timings[int(len(timings) * 0.95) - 1]:6.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='getProjectUsageHistory micro-benchmark')
+    parser.add_argument('--entries', type=int, default=5000, help='history entries in usage_history')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    listener = _ReplyBytes()
+    bench_client = MongoClient(db_utils.MONGODB_SERVER, event_listeners=[listener])
+
+    projectId, legacy_projectId = '__bench_history__', '__bench_history_legacy__'
+    seed(bench_client, projectId, args.entries, legacy_projectId)
+    try:
+        measure('before', lambda: legacy_history(bench_client, legacy_projectId, args.limit), args.iterations, listener)
+        measure('after', lambda: projectsDatabase.getProjectUsageHistory(bench_client, projectId, args.limit),
+                args.iterations, listener)
+    finally:
+        db = db_utils.get_database(bench_client)
+        db['projects'].delete_many({'projectId': {'$in': [projectId, legacy_projectId]}})
+        db['usage_history'].delete_many({'projectId': projectId})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Serialization cost of /api/inventory: stdlib json vs the orjson provider
+#
+# Seeds thousands of projects, then times building the /api/inventory
+# response the old way (stringify every _id, encode with Flask's default
+# stdlib provider) against the current way (cursor results encoded as-is by
+# json_provider.OrjsonProvider). The full request through the Flask test
+# client is timed too. Runs on the memory backend by default:
+#
+#   python bench/inventory_json.py --projects 5000
+#   python bench/inventory_json.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import statistics
+import sys
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def seed(db, count):
+    # The benchmark database is separate (MONGODB_DATABASE), so start it empty
+    db['projects'].delete_many({})
+    db['projects'].insert_many([
+        {'projectName': f'Project {i}', 'projectId': f'bench-inventory-{i}',
+         'description': 'Hardware inventory benchmark project with a realistic description length',
+         'hwSets': {'HWSet1': i % 7, 'HWSet2': i % 11},
+         'users': [f'user{(i + k) % 500}' for k in range(5)], 'owner': f'user{i % 500}'}
+        for i in range(count)
+    ])
+
+
+def measure(fn, iterations):
+    fn()  # warm up
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[max(0, int(len(timings) * 0.95) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/inventory serialization benchmark')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--projects', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    sys.path.insert(0, SERVER_DIR)
+    from flask.json.provider import DefaultJSONProvider
+    import app
+    import db_utils
+
+    client = db_utils.get_mongo_client()
+    projects = db_utils.get_database(client)['projects']
+    seed(db_utils.get_database(client), args.projects)
+    stdlib_provider = DefaultJSONProvider(app.app)
+
+    def before():
+        # The previous handler: mutate every document, then stdlib json
+        docs = list(projects.find({}))
+        for doc in docs:
+            doc['_id'] = str(doc['_id'])
+        return stdlib_provider.response({'success': True, 'data': docs})
+
+    def after():
+        return app.app.json.response({'success': True, 'data': list(projects.find({}))})
+
+    # Encoding alone, on documents fetched once: the memory backend's find
+    # costs far more than pymongo's C BSON decoder and would hide the encoder
+    fetched = list(projects.find({}))
+
+    def encode_before():
+        docs = [dict(doc, _id=str(doc['_id'])) for doc in fetched]
+        return stdlib_provider.response({'success': True, 'data': docs})
+
+    def encode_after():
+        return app.app.json.response({'success': True, 'data': fetched})
+
+    with app.app.app_context():
+        size_before = len(before().get_data())
+        size_after = len(after().get_data())
+        before_ms = measure(before, args.iterations)
+        after_ms = measure(after, args.iterations)
+        encode_before_ms = measure(encode_before, args.iterations)
+        encode_after_ms = measure(encode_after, args.iterations)
+    test_client = app.app.test_client()
+    request_ms = measure(lambda: test_client.get('/api/inventory'), args.iterations)
+
+    print(f'{args.projects} projects ({args.backend} backend)')
+    print(f'  before: p50 {before_ms[0]:7.2f} ms  p95 {before_ms[1]:7.2f} ms  {size_before} bytes')
+    print(f'   after: p50 {after_ms[0]:7.2f} ms  p95 {after_ms[1]:7.2f} ms  {size_after} bytes')
+    print(f'  encode: before p50 {encode_before_ms[0]:7.2f} ms, after p50 {encode_after_ms[0]:7.2f} ms '
+          f'({encode_before_ms[0] / encode_after_ms[0]:.1f}x)')
+    print(f' request: p50 {request_ms[0]:7.2f} ms  p95 {request_ms[1]:7.2f} ms  (GET /api/inventory, after)')
+
+
+if __name__ == '__main__':
+    main()
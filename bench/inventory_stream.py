@@ -0,0 +1,100 @@
+# Peak memory of /api/inventory: whole collection vs pages vs NDJSON stream
+#
+# Seeds projects (legacy ones still embedding usageHistory), then measures
+# the peak Python memory allocated while serving the inventory three ways:
+# the old handler (list(find({})) encoded as one blob), walking every page
+# with ?after=, and consuming ?format=ndjson incrementally. Uses tracemalloc,
+# so absolute numbers are inflated but the growth with project count is what
+# matters. Runs on the memory backend by default:
+#
+#   python bench/inventory_stream.py --projects 2000,8000
+#   python bench/inventory_stream.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def seed(db, count, history):
+    db['projects'].delete_many({})
+    base = datetime.utcnow() - timedelta(days=1)
+    db['projects'].insert_many([
+        {'projectName': f'Project {i}', 'projectId': f'bench-inventory-{i:07d}',
+         'description': 'Hardware inventory benchmark project', 'hwSets': {'HWSet1': i % 7, 'HWSet2': i % 11},
+         'users': [f'user{(i + k) % 500}' for k in range(5)], 'owner': f'user{i % 500}',
+         'usageHistory': [{'timestamp': base + timedelta(seconds=k), 'action': 'checkout', 'hwSetName': 'HWSet1',
+                           'qty': 1, 'username': 'user0'} for k in range(history)]}
+        for i in range(count)
+    ])
+
+
+def measure(fn):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    nbytes = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1e6, elapsed * 1000, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/inventory peak memory benchmark')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--projects', default='1000,4000', help='comma-separated project counts')
+    parser.add_argument('--history', type=int, default=20, help='embedded usageHistory entries per project')
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    sys.path.insert(0, SERVER_DIR)
+    import app
+    import db_utils
+
+    client = db_utils.get_mongo_client()
+    db = db_utils.get_database(client)
+    db_utils.ensure_indexes(client)
+    test_client = app.app.test_client()
+
+    def whole():
+        # The previous handler
+        with app.app.app_context():
+            return len(app.jsonify({'success': True, 'data': list(db['projects'].find({}))}).get_data())
+
+    def paged():
+        total, after = 0, None
+        while True:
+            query = f'/api/inventory?limit={args.page_size}' + (f'&after={after}' if after else '')
+            response = test_client.get(query)
+            total += len(response.get_data())
+            page = response.get_json()
+            if not page['hasMore']:
+                return total
+            after = page['cursor']['after']
+
+    def streamed():
+        response = test_client.get('/api/inventory?format=ndjson', buffered=False)
+        total = sum(len(chunk) for chunk in response.response)
+        response.close()
+        return total
+
+    for count in (int(n) for n in args.projects.split(',')):
+        seed(db, count, args.history)
+        print(f'{count} projects ({args.backend} backend)')
+        for label, fn in (('whole', whole), ('paged', paged), ('ndjson', streamed)):
+            peak_mb, ms, nbytes = measure(fn)
+            print(f'  {label:>6}: peak {peak_mb:8.2f} MB  {ms:8.1f} ms  {nbytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Time to drain a backlog of expired hardware leases, by batch size
+#
+# Seeds projects that each hold leased units of a few hardware sets, backdates
+# every lease so it has expired, then runs one expiry pass
+# (lease_expiry.expire_due) and reports how long the backlog took to go back.
+# Afterwards every project must hold nothing and every set must be back at
+# capacity. Runs on the memory backend by default; MEMORY_DB_LATENCY_MS
+# models the round trip that batching saves:
+#
+#   python bench/lease_backlog.py --leases 5000 --batch-sizes 1,10,100,500
+#   python bench/lease_backlog.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def seed(client, leases, projects, hw_sets):
+    import db_utils
+    import hardware_cache
+
+    db = db_utils.get_database(client)
+    for name in ('projects', 'leases', 'usage_history', 'hardware_sets'):
+        db[name].delete_many({})
+    names = [f'BenchHW{i}' for i in range(hw_sets)]
+    per_set = leases // hw_sets + 1
+    db['hardware_sets'].insert_many([{'hwName': name, 'capacity': per_set, 'availability': 0} for name in names])
+    hardware_cache.catalog_changed(client)
+
+    held = {}
+    expired = datetime.utcnow() - timedelta(seconds=60)
+    docs = []
+    for i in range(leases):
+        projectId, name = f'bench-lease-{i % projects:05d}', names[i % hw_sets]
+        held.setdefault(projectId, {}).setdefault(name, 0)
+        held[projectId][name] += 1
+        docs.append({'projectId': projectId, 'hwSetName': name, 'qty': 1, 'username': 'user0',
+                     'createdAt': expired, 'expiresAt': expired})
+    db['leases'].insert_many(docs)
+    db['projects'].insert_many([
+        {'projectId': projectId, 'projectName': projectId, 'users': ['user0'], 'hwSets': hw, 'owner': 'user0'}
+        for projectId, hw in held.items()
+    ])
+    # Sets start empty: every unit is out under a lease
+    for name in names:
+        units = sum(hw.get(name, 0) for hw in held.values())
+        db['hardware_sets'].update_one({'hwName': name}, {'$set': {'capacity': units}})
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Expired lease backlog drain benchmark')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--leases', type=int, default=2000)
+    parser.add_argument('--projects', type=int, default=200)
+    parser.add_argument('--hw-sets', type=int, default=4)
+    parser.add_argument('--batch-sizes', default='1,10,100,500', help='comma-separated LEASE_BATCH_SIZE values')
+    parser.add_argument('--latency-ms', type=float, default=0.5, help='memory backend: round trip latency')
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    # The bench drives expiry itself; no background scheduler
+    os.environ['LEASE_EXPIRY'] = 'false'
+    sys.path.insert(0, SERVER_DIR)
+    import db_utils
+    import lease_expiry
+
+    client = db_utils.get_mongo_client()
+    db = db_utils.get_database(client)
+    db_utils.ensure_indexes(client)
+    print(f'{args.leases} expired leases over {args.projects} projects and {args.hw_sets} sets '
+          f'({args.backend} backend, {args.latency_ms:g} ms latency)')
+    failed = False
+    for batch_size in (int(n) for n in args.batch_sizes.split(',')):
+        names = seed(client, args.leases, args.projects, args.hw_sets)
+        lease_expiry.LEASE_BATCH_SIZE = batch_size
+        if args.backend == 'memory':
+            client.latency = args.latency_ms / 1000
+        start = time.perf_counter()
+        expired = lease_expiry.expire_due(client)
+        elapsed = time.perf_counter() - start
+        if args.backend == 'memory':
+            client.latency = 0
+        drained = (db['leases'].count_documents({}) == 0
+                   and all(all(qty == 0 for qty in p['hwSets'].values()) for p in db['projects'].find({}))
+                   and all(hw['availability'] == hw['capacity']
+                           for hw in db['hardware_sets'].find({'hwName': {'$in': names}})))
+        failed |= not drained
+        print(f'  batch {batch_size:>4}: {expired} leases in {elapsed * 1000:8.1f} ms '
+              f'({expired / elapsed:8.0f} leases/s)  drained {drained}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
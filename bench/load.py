@@ -0,0 +1,275 @@
+# Load-generation benchmark for the hardware checkout workflow
+#
+# Seeds users, projects and hardware sets, then drives a weighted mix of
+# /login, /get_user_projects_list, /get_all_hardware and /check_out + /check_in
+# on one hot hardware set for a fixed duration. Prints (or writes) a JSON
+# report with throughput and p50/p95/p99 latency per route for regression
+# comparison.
+#
+#   # In-process Flask app on the in-memory backend (no mongod needed)
+#   python bench/load.py --backend memory --concurrency 16 --duration 20
+#
+#   # In-process Flask app against a local mongod (uses a separate database)
+#   python bench/load.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+#
+#   # A running server; start it with MONGODB_DATABASE=momentum_swelab_bench so
+#   # it reads the data this script seeds
+#   python bench/load.py --backend mongo --target http://localhost:5000
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.request
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+HOT_SET = 'HWSet-hot'
+PASSWORD = 'bench-pass'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mixed-workload load generator')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default=os.environ.get('MONGODB_DATABASE', 'momentum_swelab_bench'),
+                        help='database to seed and use (dropped at start for the mongo backend)')
+    parser.add_argument('--target', help='base URL of a running server; default drives the app in-process')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--projects-per-user', type=int, default=3)
+    parser.add_argument('--hardware-sets', type=int, default=20)
+    parser.add_argument('--hot-capacity', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load after warm-up')
+    parser.add_argument('--mix', default='login=1,get_user_projects_list=3,get_all_hardware=4,check_out=3,check_in=3',
+                        help='comma-separated route=weight pairs')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4,
+                        help='bcrypt cost for seeded users and logins (the app default is 12)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # Must happen before the server modules are imported
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    os.environ.setdefault('MONGODB_ENSURE_INDEXES', 'false')
+    # Let the benchmark, not the shedding limit, decide the concurrency
+    os.environ.setdefault('BCRYPT_MAX_QUEUE', str(args.concurrency * 2))
+    sys.path.insert(0, SERVER_DIR)
+
+
+def seed(args):
+    """Create users, projects and hardware sets directly in the database."""
+    import db_utils
+    import hardware_cache
+    from decryptEncrypt import encrypt_password
+
+    client = db_utils.get_mongo_client()
+    if args.backend == 'mongo':
+        client.drop_database(args.database)
+    db_utils.ensure_indexes(client)
+    db = db_utils.get_database(client)
+
+    rng = random.Random(args.seed)
+    password_hash = encrypt_password(PASSWORD)
+    project_ids = [f'bench-project-{i}' for i in range(args.projects)]
+    hw_names = [HOT_SET] + [f'HWSet-{i}' for i in range(args.hardware_sets - 1)]
+
+    members = {pid: [] for pid in project_ids}
+    users = []
+    for i in range(args.users):
+        username = f'bench-user-{i}'
+        # Every user is in their "home" project plus a few random others
+        projects = [project_ids[i % args.projects]]
+        projects += rng.sample(project_ids, min(args.projects_per_user - 1, args.projects))
+        projects = list(dict.fromkeys(projects))
+        for pid in projects:
+            members[pid].append(username)
+        users.append({'username': username, 'email': f'{username}@bench.local', 'password': password_hash,
+                      'projects': projects})
+    db['users'].insert_many(users)
+    db['projects'].insert_many([
+        {'projectName': pid, 'projectId': pid, 'description': 'load benchmark', 'hwSets': {HOT_SET: 0},
+         'users': members[pid], 'owner': members[pid][0] if members[pid] else None}
+        for pid in project_ids
+    ])
+    db['hardware_sets'].insert_many([
+        {'hwName': name, 'capacity': args.hot_capacity if name == HOT_SET else 500,
+         'availability': args.hot_capacity if name == HOT_SET else 500}
+        for name in hw_names
+    ])
+    # Seeded directly, so tell every worker's hardware cache the catalog changed
+    hardware_cache.catalog_changed(client)
+    return [(user['username'], user['projects'][0]) for user in users]
+
+
+class InProcessTransport:
+    def __init__(self):
+        import app
+        self.client = app.app.test_client()
+
+    def call(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def call(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, json.loads(response.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            return e.code, {}
+
+
+class Recorder:
+    """Thread-safe per-route latency samples and outcome counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.rejected = {}
+
+    def record(self, route, seconds, status, payload):
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if status >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            elif payload.get('success') is False:
+                # Business rejections such as "Not enough hardware available"
+                self.rejected[route] = self.rejected.get(route, 0) + 1
+
+    def report(self, elapsed):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            samples.sort()
+            routes[route] = {
+                'count': len(samples),
+                'errors': self.errors.get(route, 0),
+                'rejected': self.rejected.get(route, 0),
+                'throughput_rps': round(len(samples) / elapsed, 1),
+                'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p95_ms': round(percentile(samples, 95) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            }
+        total = sum(route['count'] for route in routes.values())
+        return {'total_requests': total, 'throughput_rps': round(total / elapsed, 1), 'routes': routes}
+
+
+def percentile(sorted_samples, pct):
+    # Nearest-rank percentile
+    index = max(0, min(len(sorted_samples) - 1, int(round(pct / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        weights[route.strip()] = float(weight or 1)
+    return list(weights), list(weights.values())
+
+
+def worker(transport, recorder, accounts, routes, weights, deadline, warmup_until, rng):
+    username, project_id = rng.choice(accounts)
+    held = 0  # units of the hot set this worker has checked out
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        route = rng.choices(routes, weights)[0]
+        # Only check in what this worker holds so check-ins measure real work
+        if route == 'check_in' and held == 0:
+            route = 'check_out'
+
+        if route == 'login':
+            request = ('POST', '/login', {'username': username, 'password': PASSWORD})
+        elif route == 'get_user_projects_list':
+            request = ('POST', '/get_user_projects_list', {'username': username})
+        elif route == 'get_all_hardware':
+            request = ('GET', '/get_all_hardware', None)
+        elif route == 'check_out':
+            request = ('POST', '/check_out', {'projectId': project_id, 'hwSetName': HOT_SET, 'qty': 1,
+                                              'username': username})
+        elif route == 'check_in':
+            request = ('POST', '/check_in', {'projectId': project_id, 'hwSetName': HOT_SET, 'qty': 1,
+                                             'username': username})
+        else:
+            raise SystemExit(f'Unknown route in --mix: {route}')
+
+        start = time.perf_counter()
+        status, payload = transport.call(*request)
+        elapsed = time.perf_counter() - start
+        if payload.get('success'):
+            held += 1 if route == 'check_out' else -1 if route == 'check_in' else 0
+        if start >= warmup_until:
+            recorder.record(route, elapsed, status, payload)
+
+
+def check_consistency(args):
+    """The hot set's availability plus what projects hold must equal its capacity."""
+    import db_utils
+    db = db_utils.get_database(db_utils.get_mongo_client())
+    hot = db['hardware_sets'].find_one({'hwName': HOT_SET})
+    held = sum(project.get('hwSets', {}).get(HOT_SET, 0)
+               for project in db['projects'].find({}, {'hwSets': 1}))
+    return {'capacity': hot['capacity'], 'availability': hot['availability'], 'checked_out': held,
+            'consistent': hot['availability'] >= 0 and hot['availability'] + held == hot['capacity']}
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    accounts = seed(args)
+
+    transport_factory = (lambda: HttpTransport(args.target)) if args.target else InProcessTransport
+    routes, weights = parse_mix(args.mix)
+    recorder = Recorder()
+
+    warmup = min(2.0, args.duration / 5)
+    start = time.perf_counter()
+    warmup_until = start + warmup
+    deadline = warmup_until + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(transport_factory(), recorder, accounts, routes, weights, deadline,
+                                              warmup_until, random.Random(args.seed + i)))
+        for i in range(args.concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'duration_s': args.duration,
+        **recorder.report(args.duration),
+    }
+    if not args.target:
+        report['hot_set'] = check_consistency(args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Overhead of per-request metrics recording (metrics.record_request)
+#
+# Measures the cost of one record_request call in single-process mode and in
+# the multiprocess (memory-mapped) mode used under gunicorn. No database needed:
+#
+#   python bench/metrics_overhead.py
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def measure(iterations):
+    sys.path.insert(0, SERVER_DIR)
+    import metrics
+
+    routes = ['check_out', 'check_in', 'login', 'get_all_hardware']
+    metrics.record_request('warmup', 0.001)
+    per_call = min(timeit.repeat(
+        lambda: metrics.record_request(routes[0], 0.0042), number=iterations, repeat=5
+    )) / iterations
+    with_error = min(timeit.repeat(
+        lambda: metrics.record_request(routes[1], 0.0042, error=True), number=iterations, repeat=5
+    )) / iterations
+    return per_call * 1e6, with_error * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='metrics.record_request overhead')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        ok, err = measure(args.iterations)
+        mode = 'multiprocess' if os.environ.get('PROMETHEUS_MULTIPROC_DIR') else 'single-process'
+        print(f'{mode:>15}: {ok:.2f} us/request, {err:.2f} us/request with error')
+        return
+
+    # Each mode needs a fresh interpreter because prometheus_client reads the
+    # environment when metrics are created
+    env = {k: v for k, v in os.environ.items() if k != 'PROMETHEUS_MULTIPROC_DIR'}
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--iterations', str(args.iterations)]
+    subprocess.run(command, env=env, check=True)
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(command, env=dict(env, PROMETHEUS_MULTIPROC_DIR=directory), check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Checkout throughput on one hot hardware set, unsharded vs split into shards
+#
+# For each shard count, creates a fresh set, shards it with shardHardwareSet
+# (1 leaves it a single document), then hammers requestSpace from many threads
+# for a fixed time and reports checkouts per second and latency percentiles.
+# Afterwards it checks that no unit was lost or oversold: the shards' total
+# plus every granted unit must equal the capacity, and the set's materialized
+# availability must catch up with the shards once the version stamper flushes.
+#
+# On the memory backend, MEMORY_DB_WRITE_MS models how long MongoDB holds a
+# document per write (writes to one document queue, writes to different
+# documents overlap) and MEMORY_DB_LATENCY_MS the network round trip:
+#
+#   python bench/sharded_counters.py --write-ms 2 --latency-ms 0.5
+#   python bench/sharded_counters.py --backend mongo --mongodb-uri mongodb://localhost:27017/
+import argparse
+import os
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server')
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+def run(client, hw_name, shards, capacity, threads, duration):
+    import db_utils
+    import hardwareDatabase
+    import hardware_cache
+    import hardware_versions
+
+    db = db_utils.get_database(client)
+    db['hardware_sets'].delete_many({'hwName': hw_name})
+    db['hardware_shards'].delete_many({'hwName': hw_name})
+    hardwareDatabase.createHardwareSet(client, hw_name, capacity)
+    if shards > 1:
+        hardwareDatabase.shardHardwareSet(client, hw_name, shards)
+    hardware_cache.invalidate()
+
+    granted = [0] * threads
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+    stop = threading.Event()
+
+    def worker(index):
+        barrier.wait()
+        while not stop.is_set():
+            start = time.perf_counter()
+            result = hardwareDatabase.requestSpace(client, hw_name, 1)
+            latencies[index].append((time.perf_counter() - start) * 1000)
+            if result['success']:
+                granted[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    hardware_versions.flush()
+    total_granted = sum(granted)
+    if shards > 1:
+        remaining = sum(s['availability'] for s in db['hardware_shards'].find({'hwName': hw_name}))
+    else:
+        remaining = db['hardware_sets'].find_one({'hwName': hw_name})['availability']
+    materialized = db['hardware_sets'].find_one({'hwName': hw_name})['availability']
+    samples = [ms for per_thread in latencies for ms in per_thread]
+    return {
+        'checkouts_per_s': total_granted / elapsed,
+        'p50_ms': percentile(samples, 0.5),
+        'p99_ms': percentile(samples, 0.99),
+        'granted': total_granted,
+        'consistent': remaining + total_granted == capacity and remaining >= 0 and materialized == remaining
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded availability counter benchmark')
+    parser.add_argument('--backend', choices=['memory', 'mongo'], default='memory')
+    parser.add_argument('--mongodb-uri', default=os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/'))
+    parser.add_argument('--database', default='momentum_swelab_bench')
+    parser.add_argument('--shards', default='1,2,4,8,16', help='comma-separated shard counts (1 = unsharded)')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds per shard count')
+    parser.add_argument('--capacity', type=int, default=10000000, help='large enough not to run out')
+    parser.add_argument('--write-ms', type=float, default=2.0, help='memory backend: per-document write hold')
+    parser.add_argument('--latency-ms', type=float, default=0.5, help='memory backend: round trip latency')
+    args = parser.parse_args()
+
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    os.environ['MONGODB_DATABASE'] = args.database
+    os.environ['MONGODB_ENSURE_INDEXES'] = 'false'
+    os.environ['MEMORY_DB_WRITE_MS'] = str(args.write_ms)
+    os.environ['MEMORY_DB_LATENCY_MS'] = str(args.latency_ms)
+    sys.path.insert(0, SERVER_DIR)
+    import db_utils
+
+    client = db_utils.get_mongo_client()
+    db_utils.ensure_indexes(client)
+    print(f'{args.threads} threads, {args.duration:g}s per run ({args.backend} backend)')
+    failed = False
+    for shards in (int(n) for n in args.shards.split(',')):
+        summary = run(client, '__bench_sharded__', shards, args.capacity, args.threads, args.duration)
+        failed |= not summary['consistent']
+        print(f"  shards {shards:>3}: {summary['checkouts_per_s']:9.0f} checkouts/s  "
+              f"p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+              f"granted {summary['granted']}  consistent {summary['consistent']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -36,5 +36,8 @@ cd ..
 echo "Installing Python dependencies..."
 pip install -r requirements.txt
 
+# Precompress the build so the server can send gzip/brotli variants without compressing per request
+python server/static_assets.py compress client/build
+
 echo "Build complete!"
 
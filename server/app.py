@@ -1,7 +1,10 @@
 # Import necessary libraries and modules
 import os
+import hmac
 import json
-from flask import Flask, request, jsonify, send_from_directory
+import time
+from functools import wraps
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 
 from itsdangerous import URLSafeTimedSerializer
@@ -13,6 +16,14 @@ import usersDatabase
 import projectsDatabase
 import hardwareDatabase
 import db_utils
+import metrics
+import static_assets
+import availability_stream
+import hardware_cache
+import checkout_coalescer
+import lease_expiry
+import leasesDatabase
+from json_provider import OrjsonProvider
 
 # Initialize a new Flask web application
 # Determine static folder path - works for both local dev and Render deployment
@@ -21,10 +32,17 @@ if not os.path.exists(static_folder_path):
     # Fallback: try relative path from server directory
     static_folder_path = '../client/build'
 
+# Scan the build once; serve() and the 404 handler answer from this manifest
+static_assets.init(static_folder_path)
+
 # Don't use static_url_path='/' as it interferes with routing
 # We'll handle static files manually in the catch-all route
 app = Flask(__name__, static_folder=None)
 
+# orjson-backed JSON that encodes ObjectId and datetime, so routes can return
+# documents as they come from MongoDB
+app.json = OrjsonProvider(app)
+
 # Configure CORS to allow GitHub Pages and local development
 # Get allowed origins from environment or use defaults
 ALLOWED_ORIGINS = os.environ.get('ALLOWED_ORIGINS', 
@@ -39,16 +57,48 @@ CORS(app, resources={
     }
 })
 
+# Shared secret for the /admin routes; they are refused while it is unset.
+# /admin/drop_userid_index predates the token and stays open for its callers.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def require_admin(f):
+    """Decorator for /admin routes: requires 'Authorization: Bearer <ADMIN_TOKEN>'."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        supplied = request.headers.get('Authorization', '').encode('utf-8')
+        if not ADMIN_TOKEN or not hmac.compare_digest(supplied, f'Bearer {ADMIN_TOKEN}'.encode('utf-8')):
+            return jsonify({'success': False, 'message': 'Admin token required'}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Background threads (index creation, the MongoDB pinger behind /health and
+# /readyz, lease expiry) start in the worker, not at import: gunicorn's
+# post_fork starts them, and the first request does when it did not run
+@app.before_request
+def start_worker_threads():
+    db_utils.start_worker_threads()
+
+@app.after_request
+def add_db_timing(response):
+    # Attach the request's MongoDB summary as Server-Timing and log a sample
+    summary = db_utils.get_request_db_summary()
+    if summary is not None:
+        response.headers['Server-Timing'] = db_utils.server_timing_header(summary)
+        db_utils.log_request_sample(dict(
+            summary,
+            ts=time.time(),
+            route=request.endpoint,
+            method=request.method,
+            status=response.status_code
+        ))
+    return response
+
 @app.errorhandler(404)
 def not_found(e):
     # Serve index.html for 404s so React Router can handle client-side routing
-    static_folder_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'client', 'build')
-    if not os.path.exists(static_folder_path):
-        static_folder_path = '../client/build'
-    
-    index_path = os.path.join(static_folder_path, 'index.html')
-    if os.path.exists(index_path):
-        return send_from_directory(static_folder_path, 'index.html')
+    manifest = static_assets.get_manifest()
+    if manifest.index is not None:
+        return static_assets.index_response(manifest)
     return jsonify({'error': 'Not found', 'message': 'The requested resource was not found.'}), 404
 
 # Health check route
@@ -59,6 +109,7 @@ def health_check():
     
     Returns:
         JSON response with system status and MongoDB connection status.
+        The MongoDB status comes from a background ping, so this never blocks.
         
     Example Response:
         {
@@ -74,6 +125,52 @@ def health_check():
         'message': 'MongoDB connection required for full functionality' if not mongo_status else 'All systems operational'
     })
 
+# Liveness probe route
+@app.route('/livez', methods=['GET'])
+def liveness_probe():
+    """
+    Liveness probe: the process is up and serving requests.
+    Does not depend on MongoDB, so a database outage never restarts workers.
+    """
+    return jsonify({'status': 'alive'})
+
+# Readiness probe route
+@app.route('/readyz', methods=['GET'])
+def readiness_probe():
+    """
+    Readiness probe served from the cached background ping.
+    
+    Returns:
+        200 when the last ping succeeded and is fresh, 503 otherwise.
+        
+    Example Response:
+        {
+            "status": "ready",
+            "mongodb": {
+                "connected": true,
+                "ready": true,
+                "last_ping_ms": 1.42,
+                "stale_seconds": 2.1,
+                "last_checked": 1700000000.0,
+                "last_success": 1700000000.0,
+                "error": null,
+                "pool": {"open_connections": 4, "checked_out": 1, "checkout_failures": 0, "max_pool_size": 100}
+            }
+        }
+    """
+    status = db_utils.get_health_status()
+    return jsonify({'status': 'ready' if status['ready'] else 'not ready', 'mongodb': status}), 200 if status['ready'] else 503
+
+# Prometheus metrics route
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    Per-route request count, error count and latency histograms in Prometheus
+    text format, aggregated across all gunicorn workers.
+    """
+    body, content_type = metrics.render_metrics()
+    return Response(body, content_type=content_type)
+
 # Route for user login
 @app.route('/login', methods=['POST'])
 @db_utils.with_db_connection
@@ -490,11 +587,14 @@ def get_project_usage_history(client):
     Request Body:
         {
             "projectId": str (required),
-            "limit": int (optional, default 50)
+            "limit": int (optional, default 50, max 500),
+            "before": str (optional, cursor - return entries older than this),
+            "after": str (optional, cursor - return entries newer than this)
         }
     
     Returns:
-        JSON response with usage history.
+        JSON response with one page of usage history (most recent first), plus
+        a "cursor" with the "before"/"after" values for the neighbouring pages.
     """
     data = request.get_json()
     projectId = data.get('projectId')
@@ -505,16 +605,118 @@ def get_project_usage_history(client):
         return jsonify({'success': False, 'message': 'projectId is required'})
 
     # Attempt to get usage history using the projectsDatabase module
-    result = projectsDatabase.getProjectUsageHistory(client, projectId, limit)
+    result = projectsDatabase.getProjectUsageHistory(
+        client, projectId, limit, before=data.get('before'), after=data.get('after')
+    )
+    return jsonify(result)
+
+# Route for listing a project's active hardware leases
+@app.route('/get_project_leases', methods=['POST'])
+@db_utils.with_db_connection
+def get_project_leases(client):
+    """
+    List a project's time-limited checkouts, soonest expiring first.
+    
+    Request Body:
+        {
+            "projectId": str (required)
+        }
+    
+    Example Response:
+        {
+            "success": true,
+            "leases": [
+                {"leaseId": "665f1c2e8b3e4a1d9c0f1234", "hwSetName": "HWSet1", "qty": 5,
+                 "username": "john", "expiresAt": "2024-06-05T10:15:00.000"}
+            ]
+        }
+    """
+    data = request.get_json()
+    projectId = data.get('projectId')
+
+    if not projectId:
+        return jsonify({'success': False, 'message': 'projectId is required'})
+
+    result = leasesDatabase.getProjectLeases(client, projectId)
     return jsonify(result)
 
+def _parse_since(value):
+    # Validate ?since=<version>; returns (since or None, error_response)
+    if value is None:
+        return None, None
+    try:
+        since = int(value)
+    except ValueError:
+        since = -1
+    if since < 0:
+        return None, {'success': False, 'message': 'since must be a non-negative integer'}
+    return since, None
+
 # Route for getting all hardware sets with details
 @app.route('/get_all_hardware', methods=['GET'])
 @db_utils.with_db_connection
 def get_all_hardware(client):
+    """
+    All hardware sets, or with ?since=<version> only those changed after it.
+    
+    Start with since=0 and pass the returned version on the next call. Sets
+    in "data" replace the client's copies; "full" means the client should
+    drop sets it did not receive. The strong ETag lets an unchanged result
+    be revalidated with If-None-Match for a 304.
+    
+    Example Response (since=41):
+        {
+            "success": true,
+            "data": [{"hwSetName": "HWSet1", "capacity": 100, "availability": 75, "version": 42}],
+            "version": 42,
+            "full": false
+        }
+    """
+    since, error = _parse_since(request.args.get('since'))
+    if error:
+        return jsonify(error)
+
     # Fetch all hardware sets with full details using the hardwareDatabase module
-    result = hardwareDatabase.getAllHardwareSets(client)
-    return jsonify(result)
+    result = hardwareDatabase.getAllHardwareSets(client, since)
+    response = jsonify(result)
+    if result['success']:
+        response.add_etag()
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Route for live hardware availability (Server-Sent Events)
+@app.route('/availability_stream', methods=['GET'])
+def stream_availability():
+    """
+    Push hardware availability as it changes, as a text/event-stream.
+    
+    The first event is a snapshot of every hardware set; each later
+    "availability" event carries one set's new state. Browsers reconnect on
+    their own and send Last-Event-ID, which resumes from the missed events.
+    
+    An open stream holds its worker thread until the client leaves, so this
+    route refuses with 503 under single-threaded (sync) workers, where one
+    client would take the whole worker. Serve it from the async build
+    (asgi.py), or from threaded workers (--threads) for a few clients.
+    
+    Example Events:
+        id: 1f2a18c9e2b3a1-42
+        event: snapshot
+        data: {"hardware": [{"hwSetName": "HWSet1", "availability": 80, "capacity": 100}]}
+        
+        id: 1f2a18c9e2b3a1-43
+        event: availability
+        data: {"hwSetName": "HWSet1", "availability": 75, "capacity": 100}
+    """
+    if not request.environ.get('wsgi.multithread'):
+        return jsonify({'success': False,
+                        'message': 'Availability stream is not served by sync workers; use the async build'}), 503
+    try:
+        stream = availability_stream.iter_stream(request.headers.get('Last-Event-ID'))
+    except db_utils.ServiceBusyError as e:
+        return jsonify({'success': False, 'message': str(e), 'retry': True}), 503, {'Retry-After': str(e.retry_after)}
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Route for getting all hardware names (legacy endpoint)
 @app.route('/get_all_hw_names', methods=['GET'])
@@ -535,6 +737,40 @@ def get_hw_info(client):
     result = hardwareDatabase.queryHardwareSet(client, hwSetName)
     return jsonify(result)
 
+def _parse_hw_request(data):
+    # Validate a check out / check in body; returns ((projectId, hwSetName, qty, username), error_response)
+    projectId = data.get('projectId')
+    hwSetName = data.get('hwSetName')
+    qty = data.get('qty')
+    username = data.get('username')
+
+    # Validate required fields
+    if not projectId or not hwSetName or qty is None or not username:
+        return None, {'success': False, 'message': 'projectId, hwSetName, qty, and username are required'}
+
+    # Validate qty is numeric and positive
+    try:
+        qty = int(qty)
+    except (ValueError, TypeError):
+        return None, {'success': False, 'message': 'qty must be a valid number'}
+    if qty <= 0:
+        return None, {'success': False, 'message': 'qty must be a positive integer'}
+    return (projectId, hwSetName, qty, username), None
+
+def _parse_lease(data):
+    # Validate the optional leaseSeconds of a check out; returns (leaseSeconds or None, error_response)
+    leaseSeconds = data.get('leaseSeconds')
+    if leaseSeconds is None:
+        return None, None
+    try:
+        leaseSeconds = int(leaseSeconds)
+    except (ValueError, TypeError):
+        return None, {'success': False, 'message': 'leaseSeconds must be a valid number'}
+    if leaseSeconds <= 0 or leaseSeconds > lease_expiry.LEASE_MAX_SECONDS:
+        return None, {'success': False,
+                      'message': f'leaseSeconds must be between 1 and {lease_expiry.LEASE_MAX_SECONDS}'}
+    return leaseSeconds, None
+
 # Route for checking out hardware
 @app.route('/check_out', methods=['POST'])
 @db_utils.with_db_connection
@@ -547,7 +783,8 @@ def check_out(client):
             "projectId": str (required),
             "hwSetName": str (required),
             "qty": int (required, must be positive),
-            "username": str (required)
+            "username": str (required),
+            "leaseSeconds": int (optional) - return the units automatically after this long
         }
     
     Returns:
@@ -558,14 +795,22 @@ def check_out(client):
             "projectId": "ML-2024-001",
             "hwSetName": "HWSet1",
             "qty": 5,
-            "username": "john"
+            "username": "john",
+            "leaseSeconds": 86400
         }
         
     Example Response:
         {
             "success": true,
             "message": "Hardware checked out successfully",
-            "availability": 40
+            "availability": 40,
+            "lease": {
+                "leaseId": "665f1c2e8b3e4a1d9c0f1234",
+                "hwSetName": "HWSet1",
+                "qty": 5,
+                "username": "john",
+                "expiresAt": "2024-06-05T10:15:00.000"
+            }
         }
         
     Status Codes:
@@ -573,25 +818,15 @@ def check_out(client):
         400 Bad Request - Missing required fields, invalid quantity, or insufficient availability
     """
     data = request.get_json()
-    projectId = data.get('projectId')
-    hwSetName = data.get('hwSetName')
-    qty = data.get('qty')
-    username = data.get('username')
-
-    # Validate required fields
-    if not projectId or not hwSetName or qty is None or not username:
-        return jsonify({'success': False, 'message': 'projectId, hwSetName, qty, and username are required'})
-    
-    # Validate qty is numeric and positive
-    try:
-        qty = int(qty)
-        if qty <= 0:
-            return jsonify({'success': False, 'message': 'qty must be a positive integer'})
-    except (ValueError, TypeError):
-        return jsonify({'success': False, 'message': 'qty must be a valid number'})
+    params, error = _parse_hw_request(data)
+    if error:
+        return jsonify(error)
+    leaseSeconds, error = _parse_lease(data)
+    if error:
+        return jsonify(error)
 
     # Attempt to check out the hardware using the projectsDatabase module
-    result = projectsDatabase.checkOutHW(client, projectId, hwSetName, qty, username)
+    result = projectsDatabase.checkOutHW(client, *params, leaseSeconds=leaseSeconds)
     return jsonify(result)
 
 # Route for checking in hardware
@@ -631,26 +866,100 @@ def check_in(client):
         200 OK - Check-in successful
         400 Bad Request - Missing required fields, invalid quantity, or attempting to check in more than checked out
     """
-    data = request.get_json()
+    params, error = _parse_hw_request(request.get_json())
+    if error:
+        return jsonify(error)
+
+    # Attempt to check in the hardware using the projectsDatabase module
+    result = projectsDatabase.checkInHW(client, *params)
+    return jsonify(result)
+
+# Largest number of items accepted by the batch checkout/check-in routes
+MAX_BATCH_ITEMS = 50
+
+def _parse_batch_request(data):
+    # Validate a batch request body; returns (items, error_response)
     projectId = data.get('projectId')
-    hwSetName = data.get('hwSetName')
-    qty = data.get('qty')
     username = data.get('username')
+    items = data.get('items')
+
+    if not projectId or not username or not isinstance(items, list) or not items:
+        return None, {'success': False, 'message': 'projectId, username, and a non-empty items list are required'}
+    if len(items) > MAX_BATCH_ITEMS:
+        return None, {'success': False, 'message': f'A batch may contain at most {MAX_BATCH_ITEMS} items'}
+
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get('hwSetName') or item.get('qty') is None:
+            return None, {'success': False, 'message': 'Each item requires hwSetName and qty'}
+        # Validate qty is numeric and positive
+        try:
+            qty = int(item['qty'])
+        except (ValueError, TypeError):
+            return None, {'success': False, 'message': 'qty must be a valid number'}
+        if qty <= 0:
+            return None, {'success': False, 'message': 'qty must be a positive integer'}
+        parsed.append({'hwSetName': item['hwSetName'], 'qty': qty})
+    return parsed, None
 
-    # Validate required fields
-    if not projectId or not hwSetName or qty is None or not username:
-        return jsonify({'success': False, 'message': 'projectId, hwSetName, qty, and username are required'})
+# Route for checking out several hardware sets at once
+@app.route('/check_out_batch', methods=['POST'])
+@db_utils.with_db_connection
+def check_out_batch(client):
+    """
+    Check out hardware from several hardware sets for one project.
+    Either every item is checked out or none are.
     
-    # Validate qty is numeric and positive
-    try:
-        qty = int(qty)
-        if qty <= 0:
-            return jsonify({'success': False, 'message': 'qty must be a positive integer'})
-    except (ValueError, TypeError):
-        return jsonify({'success': False, 'message': 'qty must be a valid number'})
+    Request Body:
+        {
+            "projectId": str (required),
+            "username": str (required),
+            "items": [{"hwSetName": str, "qty": int}, ...] (required, at most 50)
+        }
+    
+    Example Response:
+        {
+            "success": true,
+            "message": "Successfully checked out 2 item(s)",
+            "results": [
+                {"hwSetName": "HWSet1", "qty": 5, "success": true, "message": "OK"},
+                {"hwSetName": "HWSet2", "qty": 2, "success": true, "message": "OK"}
+            ],
+            "availability": {"HWSet1": 40, "HWSet2": 48}
+        }
+    """
+    data = request.get_json()
+    items, error = _parse_batch_request(data)
+    if error:
+        return jsonify(error)
 
-    # Attempt to check in the hardware using the projectsDatabase module
-    result = projectsDatabase.checkInHW(client, projectId, hwSetName, qty, username)
+    result = projectsDatabase.checkOutHWBatch(client, data.get('projectId'), items, data.get('username'))
+    return jsonify(result)
+
+# Route for checking in several hardware sets at once
+@app.route('/check_in_batch', methods=['POST'])
+@db_utils.with_db_connection
+def check_in_batch(client):
+    """
+    Check in hardware to several hardware sets from one project.
+    Either every item is checked in or none are.
+    
+    Request Body:
+        {
+            "projectId": str (required),
+            "username": str (required),
+            "items": [{"hwSetName": str, "qty": int}, ...] (required, at most 50)
+        }
+    
+    Returns:
+        JSON response with per-item results and final availabilities (same shape as /check_out_batch).
+    """
+    data = request.get_json()
+    items, error = _parse_batch_request(data)
+    if error:
+        return jsonify(error)
+
+    result = projectsDatabase.checkInHWBatch(client, data.get('projectId'), items, data.get('username'))
     return jsonify(result)
 
 # Route for creating a new hardware set
@@ -669,16 +978,52 @@ def create_hardware_set(client):
 @app.route('/api/inventory', methods=['GET'])
 @db_utils.with_db_connection
 def check_inventory(client):
-    # Fetch all projects from the projects collection
-    db = db_utils.get_database(client)
-    projects_collection = db['projects']
-    projects = list(projects_collection.find({}))
+    """
+    Project inventory (admin function), ordered by projectId.
+    
+    Without 'after' or 'limit' every project is returned in one response, as
+    before paging existed; either one switches to pages with a cursor.
     
-    # Convert ObjectId to string for JSON serialization
-    for project in projects:
-        project['_id'] = str(project['_id'])
+    Query Parameters:
+        after: str (optional) - projectId from the previous page's cursor
+        limit: int (optional, default 100, at most 1000) - projects per page
+        fields: str (optional) - comma-separated fields to return, e.g. "projectName,hwSets";
+            projectId is always included
+        format: "ndjson" (optional) - stream every project after 'after' as
+            newline-delimited JSON instead of returning one page
     
-    return jsonify({'success': True, 'data': projects})
+    Example Response:
+        {
+            "success": true,
+            "data": [{"projectId": "ML-2024-001", "projectName": "Machine Learning Research", "hwSets": {"HWSet1": 5}}],
+            "cursor": {"after": "ML-2024-001"},
+            "hasMore": true
+        }
+    """
+    after = request.args.get('after')
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()] or None
+
+    if request.args.get('format') != 'ndjson':
+        if after is None and 'limit' not in request.args:
+            # Legacy callers expect the full list
+            return jsonify(projectsDatabase.getInventory(client, fields))
+        result = projectsDatabase.getInventoryPage(client, after, request.args.get('limit', 100), fields)
+        return jsonify(result)
+
+    result = projectsDatabase.getInventoryCursor(client, after, fields)
+    if not result['success']:
+        return jsonify(result)
+
+    def generate():
+        # One line per project, written as the cursor delivers each batch
+        try:
+            for project in result['projects']:
+                yield app.json.dumpb(project) + b'\n'
+        except Exception as e:
+            # The status line is already sent, so the stream ends with an error record
+            yield app.json.dumpb({'success': False, 'message': f'Error: {str(e)}'}) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 serializer = URLSafeTimedSerializer(os.environ.get("SECRET_KEY", "default-secret"))
@@ -797,6 +1142,222 @@ def drop_userid_index_route(client):
     result = db_utils.drop_userId_index()
     return jsonify(result)
 
+# Route for moving embedded usageHistory arrays into usage_history (admin utility)
+@app.route('/admin/migrate_usage_history', methods=['POST'])
+@require_admin
+@db_utils.with_db_connection
+def migrate_usage_history_route(client):
+    """
+    Move any remaining embedded project usageHistory arrays into the
+    usage_history collection. Safe to run while the app is serving traffic
+    and safe to re-run.
+    """
+    result = projectsDatabase.migrateEmbeddedUsageHistory(client)
+    return jsonify(result)
+
+# Route for splitting a hot hardware set across shard documents (admin utility)
+@app.route('/admin/shard_hardware_set', methods=['POST'])
+@require_admin
+@db_utils.with_db_connection
+def shard_hardware_set_route(client):
+    """
+    Split a hardware set's units across several documents so concurrent
+    checkouts stop contending on one, or merge them back with shards <= 1.
+
+    Request Body:
+        {"hwSetName": "HWSet1", "shards": 8}
+
+    Example Response:
+        {"success": true, "message": "Hardware set split into 8 shards"}
+    """
+    data = request.get_json() or {}
+    hwSetName = data.get('hwSetName')
+    try:
+        shards = int(data.get('shards', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'shards must be an integer'})
+
+    result = hardwareDatabase.shardHardwareSet(client, hwSetName, shards)
+    return jsonify(result)
+
+# Route for reporting missing/extra indexes (admin utility)
+@app.route('/admin/indexes', methods=['GET', 'POST'])
+@require_admin
+@db_utils.with_db_connection
+def indexes_route(client):
+    """
+    Compare declared indexes with the database.
+    GET only reports; POST also creates any missing indexes.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "users": {"created": [], "missing": [], "extra": ["userId_1"], "errors": []},
+                ...
+            }
+        }
+    """
+    report = db_utils.check_indexes(client, create=request.method == 'POST')
+    return jsonify({'success': True, 'data': report})
+
+# Route for Mongo round trips per route (admin utility)
+@app.route('/admin/round_trips', methods=['GET'])
+@require_admin
+def round_trips():
+    """
+    Report how many MongoDB commands each route has issued in this worker.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "check_out": {"requests": 200, "round_trips": 600, "per_request": 3.0},
+                ...
+            }
+        }
+    """
+    return jsonify({'success': True, 'data': db_utils.get_round_trip_stats()})
+
+# Route for transaction contention counters (admin utility)
+@app.route('/admin/transaction_stats', methods=['GET'])
+@require_admin
+def transaction_stats():
+    """
+    Report this worker's checkout/check-in transaction counters.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "mode": "auto",
+                "supported": true,
+                "commits": 120,
+                "retries": 3,
+                "commit_retries": 0,
+                "aborts": 7,
+                "fallbacks": 0
+            }
+        }
+    """
+    return jsonify({'success': True, 'data': db_utils.get_transaction_stats()})
+
+# Route for hardware catalog cache counters (admin utility)
+@app.route('/admin/hardware_cache', methods=['GET'])
+@require_admin
+def hardware_cache_stats():
+    """
+    Report this worker's hardware catalog cache.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "enabled": true,
+                "hits": 9400,
+                "misses": 112,
+                "hit_ratio": 0.9882,
+                "revalidations": 80,
+                "catalog_loads": 2,
+                "availability_loads": 30,
+                "local_updates": 410,
+                "stale_updates": 2,
+                "invalidations": 1,
+                "served_age_ms_avg": 412.5,
+                "served_age_ms_max": 999.8,
+                "hardware_sets": 2,
+                "availability_ttl_s": 1.0
+            }
+        }
+    """
+    return jsonify({'success': True, 'data': hardware_cache.get_stats()})
+
+# Route for checkout coalescing counters (admin utility)
+@app.route('/admin/checkout_coalescer', methods=['GET'])
+@require_admin
+def checkout_coalescer_stats():
+    """
+    Report how this worker's checkout coalescer grouped requestSpace calls.
+    "transactions": true means checkouts run in transactions and are not
+    coalesced.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "enabled": true,
+                "transactions": false,
+                "requests": 5200,
+                "groups": 410,
+                "avg_group": 12.68,
+                "max_group": 64,
+                "full_groups": 3,
+                "window_ms": 2.0,
+                "max_batch": 64
+            }
+        }
+    """
+    return jsonify({'success': True, 'data': checkout_coalescer.get_stats()})
+
+# Route for lease expiry counters, or an immediate expiry run (admin utility)
+@app.route('/admin/lease_expiry', methods=['GET', 'POST'])
+@require_admin
+@db_utils.with_db_connection
+def lease_expiry_route(client):
+    """
+    Report this worker's lease expiry scheduler. POST returns every expired
+    lease's units right away instead of waiting for the scheduler.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "enabled": true,
+                "queued": 12,
+                "next_expiry": "2024-06-05T10:15:00.000",
+                "scheduled": 40,
+                "loaded": 57,
+                "runs": 9,
+                "batches": 11,
+                "expired": 310,
+                "units_returned": 655,
+                "errors": 0,
+                "lag_s_avg": 0.041,
+                "lag_s_max": 0.35,
+                "batch_size": 100,
+                "poll_interval_s": 30.0
+            }
+        }
+    """
+    if request.method == 'POST':
+        lease_expiry.expire_due(client)
+    return jsonify({'success': True, 'data': lease_expiry.get_stats()})
+
+# Route for availability stream counters (admin utility)
+@app.route('/admin/availability_stream', methods=['GET'])
+@require_admin
+def availability_stream_stats():
+    """
+    Report this worker's availability stream hub.
+    
+    Example Response:
+        {
+            "success": true,
+            "data": {
+                "mode": "change_stream",
+                "subscribers": 12,
+                "hardware_sets": 2,
+                "events": 340,
+                "replays": 3,
+                "snapshots": 15,
+                "overflows": 0,
+                "errors": 0,
+                "sequence": 340
+            }
+        }
+    """
+    return jsonify({'success': True, 'data': availability_stream.get_hub().get_stats()})
+
 # Route for deleting a user account
 @app.route('/delete_account', methods=['POST'])
 @db_utils.with_db_connection
@@ -830,29 +1391,21 @@ def delete_account(client):
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
-    # Determine static folder path
-    static_folder_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'client', 'build')
-    if not os.path.exists(static_folder_path):
-        static_folder_path = '../client/build'
-    
-    # Check if this is a request for a static file (JS, CSS, images, etc.)
-    # React build puts files in /static/ subdirectory
-    if path:
-        # Try the path as-is (works for both root files and static/ subdirectory)
-        static_file_path = os.path.join(static_folder_path, path)
-        if os.path.exists(static_file_path) and os.path.isfile(static_file_path):
-            return send_from_directory(static_folder_path, path)
+    # Look the path up in the build manifest scanned at startup (see static_assets.py)
+    manifest = static_assets.get_manifest()
+    asset = manifest.assets.get(path) if path else None
+    if asset is not None:
+        return static_assets.asset_response(asset)
     
     # For all other routes (frontend routes), serve index.html so React Router can handle routing
-    index_path = os.path.join(static_folder_path, 'index.html')
-    if not os.path.exists(index_path):
+    if manifest.index is None:
         return jsonify({
             'error': 'Frontend not built',
             'message': 'The React app build folder is missing. Please ensure the frontend is built before deployment.',
             'static_folder': static_folder_path
         }), 503
     
-    return send_from_directory(static_folder_path, 'index.html')
+    return static_assets.index_response(manifest)
 
 # Main entry point for the application
 if __name__ == '__main__':
@@ -0,0 +1,270 @@
+# ASGI entry point: the same API served from an event loop
+#
+#   gunicorn -c server/gunicorn.conf.py --chdir server -k uvicorn.workers.UvicornWorker asgi:app
+#
+# A sync gunicorn worker serves one request at a time, so most of a worker's
+# time is spent idle waiting on MongoDB. Here the event loop holds any number
+# of connections. The hot API routes are native async endpoints whose database
+# calls run on a per-worker executor sized to the MongoDB pool. Every other
+# route (admin, account, static files) is the Flask app itself behind a WSGI
+# adapter. Business logic stays in the *Database.py modules, shared with app.py.
+#
+# pymongo 4.6 has no asyncio API, and Motor drives pymongo from a thread pool
+# in the same way, so the database modules are awaited on an executor instead
+# of being duplicated as coroutines.
+import asyncio
+import contextvars
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from a2wsgi import WSGIMiddleware
+from flask import g
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import generate_etag, parse_etags, quote_etag
+
+import usersDatabase
+import projectsDatabase
+import hardwareDatabase
+import db_utils
+import metrics
+import availability_stream
+from app import (app as flask_app, ALLOWED_ORIGINS, _parse_batch_request, _parse_hw_request, _parse_lease,
+                 _parse_since)
+
+# Threads per worker running database calls: the cap on in-flight MongoDB work
+ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', db_utils.POOL_OPTIONS.get('maxPoolSize', 100)))
+# Threads per worker for the routes still served by the Flask app
+ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', '16'))
+
+_executor = None
+_executor_pid = None
+
+# MongoDB summary of the database call made by the current request
+_db_summary = contextvars.ContextVar('db_summary', default=None)
+
+class FlaskJSONResponse(JSONResponse):
+    """JSON response serialized by the Flask app's JSON provider, so both builds send the same bodies."""
+
+    def render(self, content):
+        return flask_app.json.dumpb(content)
+
+def _get_executor():
+    # One executor per process, like the MongoClient: threads do not survive a fork
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=ASYNC_DB_THREADS, thread_name_prefix='db')
+        _executor_pid = os.getpid()
+    return _executor
+
+def _call(fn, args):
+    # Runs on an executor thread inside a Flask app context so the command
+    # listener attributes round trips to this call, as with_db_connection does
+    with flask_app.app_context():
+        g.db_round_trips = 0
+        g.db_time_us = 0
+        g.db_slowest = (None, 0)
+        g.request_start = time.perf_counter()
+        result = fn(db_utils.get_mongo_client(), *args)
+        return result, db_utils.get_request_db_summary()
+
+async def run_db(fn, *args):
+    """Await fn(client, *args) from a database module without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    result, summary = await loop.run_in_executor(_get_executor(), _call, fn, args)
+    _db_summary.set(summary)
+    return result
+
+def db_route(f):
+    """Async counterpart of db_utils.with_db_connection: errors, load shedding, metrics and Server-Timing."""
+    @wraps(f)
+    async def endpoint(request):
+        start = time.perf_counter()
+        error = False
+        try:
+            response = await f(request)
+        except db_utils.ServiceBusyError as e:
+            # Shed load quickly and tell the client when to come back
+            error = True
+            return FlaskJSONResponse({'success': False, 'message': str(e), 'retry': True}, status_code=503,
+                                     headers={'Retry-After': str(e.retry_after)})
+        except Exception as e:
+            error = True
+            return FlaskJSONResponse({'success': False, 'message': f'Error: {str(e)}'})
+        finally:
+            metrics.record_request(f.__name__, time.perf_counter() - start, error)
+
+        summary = _db_summary.get()
+        if summary is not None:
+            db_utils.record_round_trips(f.__name__, summary['round_trips'])
+            summary['request_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            response.headers['Server-Timing'] = db_utils.server_timing_header(summary)
+            db_utils.log_request_sample(dict(
+                summary,
+                ts=time.time(),
+                route=f.__name__,
+                method=request.method,
+                status=response.status_code
+            ))
+        return response
+
+    return endpoint
+
+async def liveness_probe(request):
+    # Same contract as /livez in app.py
+    return FlaskJSONResponse({'status': 'alive'})
+
+async def readiness_probe(request):
+    # Same contract as /readyz in app.py, from the cached background ping
+    status = db_utils.get_health_status()
+    return FlaskJSONResponse({'status': 'ready' if status['ready'] else 'not ready', 'mongodb': status},
+                             status_code=200 if status['ready'] else 503)
+
+async def stream_availability(request):
+    # Same stream as /availability_stream in app.py; an idle client costs no thread here.
+    # The hub's first load reads the database, so it runs off the event loop
+    await asyncio.get_running_loop().run_in_executor(_get_executor(), availability_stream.get_hub().start)
+    stream = availability_stream.aiter_stream(request.headers.get('Last-Event-ID'))
+    try:
+        first = await stream.__anext__()
+    except db_utils.ServiceBusyError as e:
+        return FlaskJSONResponse({'success': False, 'message': str(e), 'retry': True}, status_code=503,
+                                 headers={'Retry-After': str(e.retry_after)})
+
+    async def body():
+        try:
+            yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            # Unsubscribes now rather than when the generator is collected
+            await stream.aclose()
+
+    return StreamingResponse(body(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@db_route
+async def login(request):
+    data = await request.json()
+    username = data.get('username')
+    password = data.get('password')
+
+    # Validate required fields
+    if not username or not password:
+        return FlaskJSONResponse({'success': False, 'message': 'Username and password are required'})
+
+    # bcrypt runs on the hasher pool inside usersDatabase.login, as in the sync build
+    return FlaskJSONResponse(await run_db(usersDatabase.login, username, password))
+
+@db_route
+async def get_user_projects_list(request):
+    data = await request.json()
+    username = data.get('username')
+
+    # Validate required fields
+    if not username:
+        return FlaskJSONResponse({'success': False, 'message': 'username is required'})
+
+    return FlaskJSONResponse(await run_db(usersDatabase.getUserProjectsList, username))
+
+@db_route
+async def get_project_info(request):
+    data = await request.json()
+    return FlaskJSONResponse(await run_db(projectsDatabase.queryProject, data.get('projectId')))
+
+@db_route
+async def get_all_hardware(request):
+    since, error = _parse_since(request.query_params.get('since'))
+    if error:
+        return FlaskJSONResponse(error)
+    result = await run_db(hardwareDatabase.getAllHardwareSets, since)
+    response = FlaskJSONResponse(result)
+    if not result['success']:
+        return response
+    # Strong ETag of the body, as response.add_etag() gives in the Flask route
+    etag = generate_etag(response.body)
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+@db_route
+async def get_all_hw_names(request):
+    return FlaskJSONResponse(await run_db(hardwareDatabase.getAllHwNames))
+
+@db_route
+async def get_hw_info(request):
+    data = await request.json()
+    return FlaskJSONResponse(await run_db(hardwareDatabase.queryHardwareSet, data.get('hwSetName')))
+
+@db_route
+async def check_out(request):
+    data = await request.json()
+    params, error = _parse_hw_request(data)
+    if error:
+        return FlaskJSONResponse(error)
+    leaseSeconds, error = _parse_lease(data)
+    if error:
+        return FlaskJSONResponse(error)
+    return FlaskJSONResponse(await run_db(projectsDatabase.checkOutHW, *params, leaseSeconds))
+
+@db_route
+async def check_in(request):
+    params, error = _parse_hw_request(await request.json())
+    if error:
+        return FlaskJSONResponse(error)
+    return FlaskJSONResponse(await run_db(projectsDatabase.checkInHW, *params))
+
+@db_route
+async def check_out_batch(request):
+    data = await request.json()
+    items, error = _parse_batch_request(data)
+    if error:
+        return FlaskJSONResponse(error)
+    return FlaskJSONResponse(await run_db(projectsDatabase.checkOutHWBatch, data.get('projectId'), items,
+                                          data.get('username')))
+
+@db_route
+async def check_in_batch(request):
+    data = await request.json()
+    items, error = _parse_batch_request(data)
+    if error:
+        return FlaskJSONResponse(error)
+    return FlaskJSONResponse(await run_db(projectsDatabase.checkInHWBatch, data.get('projectId'), items,
+                                          data.get('username')))
+
+app = Starlette(
+    routes=[
+        Route('/livez', liveness_probe, methods=['GET']),
+        Route('/readyz', readiness_probe, methods=['GET']),
+        Route('/login', login, methods=['POST']),
+        Route('/get_user_projects_list', get_user_projects_list, methods=['POST']),
+        Route('/get_project_info', get_project_info, methods=['POST']),
+        Route('/get_all_hardware', get_all_hardware, methods=['GET']),
+        Route('/get_all_hw_names', get_all_hw_names, methods=['GET']),
+        Route('/get_hw_info', get_hw_info, methods=['POST']),
+        Route('/availability_stream', stream_availability, methods=['GET']),
+        Route('/check_out', check_out, methods=['POST']),
+        Route('/check_in', check_in, methods=['POST']),
+        Route('/check_out_batch', check_out_batch, methods=['POST']),
+        Route('/check_in_batch', check_in_batch, methods=['POST']),
+        # Everything else is served by the Flask app unchanged
+        Mount('/', app=WSGIMiddleware(flask_app, workers=ASYNC_WSGI_THREADS)),
+    ],
+    # Requests served natively skip Flask's before_request, which starts these in the Flask build
+    on_startup=[db_utils.start_worker_threads],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=[origin.strip() for origin in ALLOWED_ORIGINS],
+            allow_methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
+            allow_headers=['Content-Type', 'Authorization'],
+        ),
+    ],
+)
@@ -0,0 +1,362 @@
+# Server-Sent Events feed of hardware availability
+#
+# One AvailabilityHub per worker follows hardware_sets and fans every change
+# out to the connected SSE clients (/availability_stream in app.py and
+# asgi.py), so dashboards no longer re-read the whole collection on a timer.
+#
+# - On a replica set or sharded cluster the hub reads a change stream; the
+#   stream's resume token lets it continue after a dropped connection without
+#   missing writes. On a standalone mongod (or the memory backend) it polls the
+#   collection every SSE_POLL_INTERVAL seconds and publishes what changed.
+# - Every delta carries the set's absolute availability and capacity, so
+#   applying one twice is harmless.
+# - Event ids are '<hub epoch>-<sequence>'. A client reconnecting with
+#   Last-Event-ID gets the events it missed from a replay buffer, or a fresh
+#   snapshot when the id is too old or came from another worker.
+# - Each client has a bounded queue. A client that falls SSE_CLIENT_QUEUE
+#   events behind has its backlog dropped and is sent a snapshot instead, so a
+#   slow reader never holds up the hub or the other clients.
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import db_utils
+
+# Stream configuration (per worker)
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', '1'))
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', '15'))
+SSE_CLIENT_QUEUE = int(os.environ.get('SSE_CLIENT_QUEUE', '256'))
+SSE_REPLAY_EVENTS = int(os.environ.get('SSE_REPLAY_EVENTS', '1024'))
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', '1000'))
+# Client reconnect delay sent in the stream, in milliseconds
+SSE_RETRY_MS = int(os.environ.get('SSE_RETRY_MS', '3000'))
+
+# Queued in place of the dropped backlog of a client that fell behind
+RESYNC = object()
+
+_FIELDS = {'hwName': 1, 'availability': 1, 'capacity': 1}
+# Server error code for a resume token older than the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+class StreamBusyError(db_utils.ServiceBusyError):
+    """Raised when this worker already serves SSE_MAX_CLIENTS streams."""
+    retry_after = 5
+
+class Subscriber:
+    """One SSE client fed from the hub thread through a bounded queue."""
+
+    def __init__(self, max_queue=None):
+        self.queue = queue.Queue(max_queue or SSE_CLIENT_QUEUE)
+        self.last_seq = 0
+
+    def offer(self, event):
+        # Called by the hub with its lock held: never blocks. Returns False
+        # once the subscriber can no longer be fed, so the hub drops it.
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self._resync()
+        return True
+
+    def _resync(self):
+        # Too far behind: drop the backlog and start over from a snapshot
+        with self.queue.mutex:
+            self.queue.queue.clear()
+        self.queue.put_nowait(RESYNC)
+        _hub.overflows += 1  # hub lock held by offer's caller
+
+    def get(self, timeout):
+        """Next event, or None after timeout seconds without one."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AsyncSubscriber(Subscriber):
+    """Subscriber consumed from an asyncio event loop (asgi.py)."""
+
+    def __init__(self, loop, max_queue=None):
+        self.loop = loop
+        self.queue = asyncio.Queue(max_queue or SSE_CLIENT_QUEUE)
+        self.last_seq = 0
+
+    def offer(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._offer, event)
+        except RuntimeError:
+            # The client's event loop is closed (worker shutting down)
+            return False
+        return True
+
+    def _offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self._resync()
+
+    def _resync(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(RESYNC)
+        # Runs on the event loop, not the hub thread
+        with _hub.lock:
+            _hub.overflows += 1
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class AvailabilityHub:
+    """Per-worker watcher of hardware_sets that fans deltas out to subscribers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.subscribers = set()
+        self.epoch = f'{os.getpid():x}{int(time.time() * 1000):x}'
+        self.seq = 0
+        self.replay = deque(maxlen=SSE_REPLAY_EVENTS)
+        self.sets = {}  # _id -> {'hwSetName', 'availability', 'capacity'}
+        self.mode = None
+        self.resume_token = None
+        self.started_pid = None
+        self.events = 0
+        self.overflows = 0
+        self.replays = 0
+        self.snapshots = 0
+        self.errors = 0
+
+    # -- subscribers --
+
+    def subscribe(self, subscriber, last_event_id=None):
+        """Register subscriber and return the events it should be sent first."""
+        self.start()
+        with self.lock:
+            if len(self.subscribers) >= SSE_MAX_CLIENTS:
+                raise StreamBusyError('Too many availability streams on this worker')
+            self.subscribers.add(subscriber)
+            missed = self._missed_events(last_event_id)
+            if missed is not None:
+                self.replays += 1
+                initial = missed
+            else:
+                initial = [self._snapshot_event()]
+            subscriber.last_seq = initial[-1][0] if initial else self.seq
+            return initial
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def snapshot_event(self):
+        """A snapshot of every hardware set, for a client that has to resync."""
+        with self.lock:
+            return self._snapshot_event()
+
+    def _snapshot_event(self):
+        self.snapshots += 1
+        return (self.seq, 'snapshot', {'hardware': sorted(self.sets.values(), key=lambda hw: hw['hwSetName'])})
+
+    def _missed_events(self, last_event_id):
+        # Events after last_event_id from the replay buffer, or None if they are not all there
+        if not last_event_id:
+            return None
+        epoch, _, seq = last_event_id.rpartition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq == self.seq:
+            return []
+        if not self.replay or seq < self.replay[0][0] - 1 or seq > self.seq:
+            return None
+        return [event for event in self.replay if event[0] > seq]
+
+    def event_id(self, event):
+        return f'{self.epoch}-{event[0]}'
+
+    # -- change detection --
+
+    def start(self):
+        """Load the hardware sets and start following them (once per process)."""
+        with self.start_lock:
+            # Threads do not survive fork, so each worker starts its own watcher
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+            # Load the current state first so the first clients get a full snapshot
+            try:
+                self._refresh(db_utils.get_database()['hardware_sets'])
+            except PyMongoError as e:
+                print(f"Availability stream could not load hardware sets: {str(e)}")
+            threading.Thread(target=self._run, name='availability-hub', daemon=True).start()
+
+    def _publish(self, doc_id, data):
+        # data is the new state of one set, or {'hwSetName', 'deleted': True}
+        with self.lock:
+            if data.get('deleted'):
+                self.sets.pop(doc_id, None)
+            else:
+                self.sets[doc_id] = data
+            self.seq += 1
+            self.events += 1
+            event = (self.seq, 'availability', data)
+            self.replay.append(event)
+            gone = [subscriber for subscriber in self.subscribers if not subscriber.offer(event)]
+            self.subscribers.difference_update(gone)
+
+    def _refresh(self, collection):
+        # Compare the collection with the known state and publish the differences
+        current = {}
+        for doc in collection.find({}, _FIELDS):
+            current[doc['_id']] = {
+                'hwSetName': doc.get('hwName'),
+                'availability': doc.get('availability'),
+                'capacity': doc.get('capacity')
+            }
+        for doc_id, data in current.items():
+            if self.sets.get(doc_id) != data:
+                self._publish(doc_id, data)
+        for doc_id in set(self.sets) - set(current):
+            self._publish(doc_id, {'hwSetName': self.sets[doc_id]['hwSetName'], 'deleted': True})
+
+    def _apply_change(self, change):
+        operation = change['operationType']
+        doc_id = change['documentKey']['_id']
+        if operation in ('insert', 'replace'):
+            doc = change['fullDocument']
+            self._publish(doc_id, {'hwSetName': doc.get('hwName'), 'availability': doc.get('availability'),
+                                   'capacity': doc.get('capacity')})
+        elif operation == 'update':
+            # updatedFields already has the new values, so no document lookup is needed
+            fields = change['updateDescription']['updatedFields']
+            known = self.sets.get(doc_id)
+            if known is None or not any(field in fields for field in _FIELDS):
+                return
+            self._publish(doc_id, {
+                'hwSetName': fields.get('hwName', known['hwSetName']),
+                'availability': fields.get('availability', known['availability']),
+                'capacity': fields.get('capacity', known['capacity'])
+            })
+        elif operation == 'delete' and doc_id in self.sets:
+            self._publish(doc_id, {'hwSetName': self.sets[doc_id]['hwSetName'], 'deleted': True})
+
+    def _watch(self, collection):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+        with collection.watch(pipeline, resume_after=self.resume_token) as stream:
+            if self.resume_token is None:
+                # Read the collection only once the stream is open, so no write falls in between
+                self._refresh(collection)
+            for change in stream:
+                self._apply_change(change)
+                self.resume_token = stream.resume_token
+
+    def _run(self):
+        client = db_utils.get_mongo_client()
+        collection = db_utils.get_database(client)['hardware_sets']
+        while True:
+            try:
+                if db_utils.STORAGE_BACKEND != 'memory' and db_utils.is_replicated(client):
+                    self.mode = 'change_stream'
+                    self._watch(collection)
+                else:
+                    self.mode = 'polling'
+                    self._refresh(collection)
+                    time.sleep(SSE_POLL_INTERVAL)
+            except PyMongoError as e:
+                # Resumes from resume_token (or re-reads the collection) on the next pass
+                if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_HISTORY_LOST:
+                    # The token fell off the oplog: start over from a fresh read
+                    self.resume_token = None
+                self.errors += 1
+                print(f"Availability stream error: {str(e)}")
+                time.sleep(min(SSE_POLL_INTERVAL, 5))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'subscribers': len(self.subscribers),
+                'hardware_sets': len(self.sets),
+                'events': self.events,
+                'replays': self.replays,
+                'snapshots': self.snapshots,
+                'overflows': self.overflows,
+                'errors': self.errors,
+                'sequence': self.seq
+            }
+
+_hub = AvailabilityHub()
+
+def get_hub():
+    return _hub
+
+def format_event(event):
+    """Encode an (seq, name, data) event as an SSE message."""
+    data = json.dumps(event[2], separators=(',', ':'))
+    return f'id: {_hub.event_id(event)}\nevent: {event[1]}\ndata: {data}\n\n'.encode('utf-8')
+
+def stream_preamble():
+    return f'retry: {SSE_RETRY_MS}\n\n'.encode('utf-8')
+
+HEARTBEAT = b': heartbeat\n\n'
+
+def iter_stream(last_event_id=None):
+    """
+    Blocking SSE byte stream for a WSGI response. Each open stream occupies a
+    thread for as long as it is open, so app.py only serves it from threaded
+    workers; the async build (aiter_stream) is the one meant for many clients.
+    """
+    subscriber = Subscriber()
+    initial = _hub.subscribe(subscriber, last_event_id)
+
+    def generate():
+        try:
+            yield stream_preamble()
+            for event in initial:
+                yield format_event(event)
+            while True:
+                event = subscriber.get(SSE_HEARTBEAT_INTERVAL)
+                if event is None:
+                    # Keeps proxies from closing an idle connection
+                    yield HEARTBEAT
+                    continue
+                if event is RESYNC:
+                    event = _hub.snapshot_event()
+                elif event[0] <= subscriber.last_seq:
+                    continue  # already covered by the snapshot just sent
+                subscriber.last_seq = event[0]
+                yield format_event(event)
+        finally:
+            _hub.unsubscribe(subscriber)
+
+    return generate()
+
+async def aiter_stream(last_event_id=None):
+    """SSE byte stream for the async build; waiting costs no thread."""
+    subscriber = AsyncSubscriber(asyncio.get_running_loop())
+    initial = _hub.subscribe(subscriber, last_event_id)
+    try:
+        yield stream_preamble()
+        for event in initial:
+            yield format_event(event)
+        while True:
+            event = await subscriber.get(SSE_HEARTBEAT_INTERVAL)
+            if event is None:
+                yield HEARTBEAT
+                continue
+            if event is RESYNC:
+                event = _hub.snapshot_event()
+            elif event[0] <= subscriber.last_seq:
+                continue
+            subscriber.last_seq = event[0]
+            yield format_event(event)
+    finally:
+        _hub.unsubscribe(subscriber)
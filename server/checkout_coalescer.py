@@ -0,0 +1,106 @@
+# Micro-batching of concurrent hardwareDatabase.requestSpace calls
+#
+# During bursts (a lab session starting) many one-unit checkouts of the same
+# hardware set arrive within milliseconds, and each would be its own update
+# of one hot document. With CHECKOUT_COALESCE=true the first request for a
+# set opens a group and waits CHECKOUT_COALESCE_WINDOW_MS; requests for the
+# same set arriving meanwhile join it, up to CHECKOUT_COALESCE_MAX_BATCH
+# (a full group goes at once). The opening thread then runs the whole group
+# through hardwareDatabase.requestSpaceBatch: usually one conditional $inc
+# for the sum, with grants made in arrival order until units run out. Each
+# caller gets its own result, exactly as if the requests had run one after
+# another.
+#
+# The window is latency every coalesced request pays, in return for fewer
+# writes to the hot document: a longer window groups more requests.
+#
+# Only requests made outside a transaction are coalesced: in a transaction the
+# hardware write belongs to that transaction alone, together with the project
+# update and history entry of the same checkout. With MONGODB_TRANSACTIONS=auto
+# on a replica set every /check_out runs in a transaction, so coalescing has
+# no effect there; it helps standalone deployments and MONGODB_TRANSACTIONS=off.
+import os
+import threading
+
+import db_utils
+
+CHECKOUT_COALESCE_ENABLED = os.environ.get('CHECKOUT_COALESCE', 'false').lower() == 'true'
+CHECKOUT_COALESCE_WINDOW_MS = float(os.environ.get('CHECKOUT_COALESCE_WINDOW_MS', '2'))
+CHECKOUT_COALESCE_MAX_BATCH = int(os.environ.get('CHECKOUT_COALESCE_MAX_BATCH', '64'))
+
+class _Group:
+    """Requests for one hardware set collected during one window."""
+
+    def __init__(self):
+        self.amounts = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()  # set when the group stops taking requests early
+        self.done = threading.Event()
+
+class CheckoutCoalescer:
+    """Open groups per hardware set; the thread that opens a group runs it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = {}  # hwSetName -> _Group still taking requests
+        self.stats = {'requests': 0, 'groups': 0, 'max_group': 0, 'full_groups': 0}
+
+    def submit(self, client, hwSetName, amount):
+        with self.lock:
+            self.stats['requests'] += 1
+            group = self.open.get(hwSetName)
+            leader = group is None
+            if leader:
+                group = self.open[hwSetName] = _Group()
+            index = len(group.amounts)
+            group.amounts.append(amount)
+            if len(group.amounts) >= CHECKOUT_COALESCE_MAX_BATCH:
+                del self.open[hwSetName]
+                self.stats['full_groups'] += 1
+                group.full.set()
+
+        if not leader:
+            group.done.wait()
+            if group.error is not None:
+                raise group.error
+            return group.results[index]
+
+        group.full.wait(CHECKOUT_COALESCE_WINDOW_MS / 1000)
+        with self.lock:
+            if self.open.get(hwSetName) is group:
+                del self.open[hwSetName]
+            self.stats['groups'] += 1
+            self.stats['max_group'] = max(self.stats['max_group'], len(group.amounts))
+        import hardwareDatabase
+        try:
+            group.results = hardwareDatabase.requestSpaceBatch(client, hwSetName, group.amounts)
+        except Exception as e:
+            # Every caller in the group sees the failure, as it would have on its own write
+            group.error = e
+            raise
+        finally:
+            group.done.set()
+        return group.results[index]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats.update({
+            'enabled': CHECKOUT_COALESCE_ENABLED,
+            # Checkouts run in transactions, which are never coalesced
+            'transactions': db_utils.transactions_enabled(db_utils.get_mongo_client()),
+            'window_ms': CHECKOUT_COALESCE_WINDOW_MS,
+            'max_batch': CHECKOUT_COALESCE_MAX_BATCH,
+            'avg_group': round(stats['requests'] / stats['groups'], 2) if stats['groups'] else None
+        })
+        return stats
+
+_coalescer = CheckoutCoalescer()
+
+def submit(client, hwSetName, amount):
+    """requestSpace(client, hwSetName, amount) through this worker's open group for the set."""
+    return _coalescer.submit(client, hwSetName, amount)
+
+def get_stats():
+    return _coalescer.get_stats()
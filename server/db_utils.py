@@ -1,53 +1,589 @@
 # Database utility functions for centralized connection and database access
 import os
-from pymongo import MongoClient
+import json
+import random
+import threading
+import time
+from pymongo import MongoClient, ASCENDING, DESCENDING, IndexModel, monitoring
+from pymongo.errors import PyMongoError
 from functools import wraps
-from flask import jsonify
+from flask import jsonify, g, has_app_context
+import metrics
 
 # Database configuration constants
 MONGODB_SERVER = os.environ.get('MONGODB_URI', 'mongodb://localhost:27017/')
-DATABASE_NAME = 'momentum_swelab'
+DATABASE_NAME = os.environ.get('MONGODB_DATABASE', 'momentum_swelab')
 
-# Global connection pool (reused across requests)
+# Storage backend: 'mongo' (default) or 'memory' for the in-process engine in
+# memory_db.py. The memory store lives inside one process, so run a single
+# worker with it (benchmarks, load tests, CI without a mongod).
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+
+# Transaction configuration
+# MONGODB_TRANSACTIONS: 'auto' (use transactions when the deployment supports them) or 'off'
+TRANSACTIONS_MODE = os.environ.get('MONGODB_TRANSACTIONS', 'auto').lower()
+TRANSACTION_MAX_RETRIES = int(os.environ.get('MONGODB_TRANSACTION_MAX_RETRIES', '5'))
+
+# Connection pool configuration (per worker process)
+# Unset values keep the pymongo defaults
+POOL_OPTIONS = {
+    option: cast(os.environ[env_name])
+    for option, env_name, cast in (
+        ('maxPoolSize', 'MONGODB_MAX_POOL_SIZE', int),
+        ('minPoolSize', 'MONGODB_MIN_POOL_SIZE', int),
+        ('waitQueueTimeoutMS', 'MONGODB_WAIT_QUEUE_TIMEOUT_MS', int),
+        ('maxIdleTimeMS', 'MONGODB_MAX_IDLE_TIME_MS', int),
+        ('compressors', 'MONGODB_COMPRESSORS', str),  # e.g. 'zstd,snappy,zlib'
+    )
+    if os.environ.get(env_name)
+}
+PREWARM_TIMEOUT = float(os.environ.get('MONGODB_PREWARM_TIMEOUT', '5'))
+
+# Sampled request log: one JSON line per sampled API request with its DB summary
+REQUEST_LOG_PATH = os.environ.get('REQUEST_LOG_PATH')
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get('REQUEST_LOG_SAMPLE_RATE', '0.01'))
+
+# Health probe configuration
+# The readiness status is refreshed by a background ping on the shared client
+# every MONGODB_PING_INTERVAL seconds and counts as stale after MONGODB_PING_STALE_AFTER
+PING_INTERVAL = float(os.environ.get('MONGODB_PING_INTERVAL', '5'))
+PING_STALE_AFTER = float(os.environ.get('MONGODB_PING_STALE_AFTER', str(PING_INTERVAL * 3)))
+
+# Create the declared indexes in the background when each worker starts
+ENSURE_INDEXES = os.environ.get('MONGODB_ENSURE_INDEXES', 'true').lower() == 'true'
+
+# Collections whose unique indexes this process has seen in place
+_unique_indexes_ready = set()
+
+# Indexes the application relies on, per collection.
+# Unique indexes back the create paths, which insert directly and treat a
+# duplicate-key error as "already exists" instead of checking first. Until
+# unique_indexes_ready confirms them, those paths refuse to insert.
+INDEXES = {
+    'users': [
+        IndexModel([('username', ASCENDING)], name='username_1', unique=True),
+        IndexModel([('email', ASCENDING)], name='email_1', unique=True),
+    ],
+    'projects': [
+        IndexModel([('projectId', ASCENDING)], name='projectId_1', unique=True),
+        IndexModel([('owner', ASCENDING)], name='owner_1'),
+    ],
+    'hardware_sets': [
+        IndexModel([('hwName', ASCENDING)], name='hwName_1', unique=True),
+    ],
+    'hardware_shards': [
+        IndexModel([('hwName', ASCENDING), ('shard', ASCENDING)], name='hwName_1_shard_1', unique=True),
+    ],
+    'usage_history': [
+        IndexModel([('projectId', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], name='projectId_1_timestamp_-1__id_-1'),
+    ],
+    'leases': [
+        IndexModel([('expiresAt', ASCENDING)], name='lease_expiry'),
+        IndexModel([('projectId', ASCENDING), ('hwSetName', ASCENDING), ('expiresAt', ASCENDING)],
+                   name='projectId_1_hwSetName_1_expiresAt_1'),
+    ],
+}
+
+# Global connection pool (reused across requests), owned by the process that created it
 _client = None
+_client_pid = None
+
+# Cached result of the replica set / mongos probe (None until first checked)
+_replicated = None
+
+# Callbacks to run once the current thread's transaction commits (None outside one)
+_transaction_local = threading.local()
+
+# Per-worker transaction counters, exposed for contention monitoring
+_transaction_stats = {'commits': 0, 'retries': 0, 'commit_retries': 0, 'aborts': 0, 'fallbacks': 0}
+_transaction_stats_lock = threading.Lock()
+
+# Per-worker Mongo round trips per route, keyed by route function name
+_round_trip_stats = {}
+_round_trip_stats_lock = threading.Lock()
+
+class _RequestCommandTracker(monitoring.CommandListener):
+    """
+    Attribute every MongoDB command to the Flask request that issued it:
+    round trips, total server time and the slowest command.
+    """
+
+    def started(self, event):
+        # Listeners run on the thread issuing the command, so g is the request's
+        if has_app_context() and 'db_round_trips' in g:
+            g.db_round_trips += 1
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        if has_app_context() and 'db_round_trips' in g:
+            g.db_time_us += event.duration_micros
+            if event.duration_micros > g.db_slowest[1]:
+                g.db_slowest = (event.command_name, event.duration_micros)
+
+class _PoolStats(monitoring.ConnectionPoolListener):
+    """Track open and checked-out connections of the shared client's pools."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.checkout_failures = 0
+
+    def _add(self, name, delta):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._add('open', 1)
+
+    def connection_closed(self, event):
+        self._add('open', -1)
+
+    def connection_checked_out(self, event):
+        self._add('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        self._add('checked_out', -1)
+
+    def connection_check_out_failed(self, event):
+        self._add('checkout_failures', 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+_pool_stats = _PoolStats()
 
 def get_mongo_client():
     """Get or create MongoDB client with connection pooling."""
-    global _client
-    if _client is None:
-        _client = MongoClient(MONGODB_SERVER)
+    global _client, _client_pid
+    # A client inherited across fork is not safe to use, so each process builds its own
+    if _client is None or _client_pid != os.getpid():
+        if STORAGE_BACKEND == 'memory':
+            import memory_db
+            _client = memory_db.MemoryClient(**POOL_OPTIONS)
+        else:
+            _client = MongoClient(MONGODB_SERVER, event_listeners=[_RequestCommandTracker(), _pool_stats], **POOL_OPTIONS)
+        _client_pid = os.getpid()
     return _client
 
+def _reset_after_fork():
+    # Drop (never close) the parent's client and counters in the child; its
+    # sockets and monitor threads belong to the parent process
+    global _client, _client_pid, _pool_stats
+    _client = None
+    _client_pid = None
+    _pool_stats = _PoolStats()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def prewarm_pool(timeout=None):
+    """
+    Create this process's client and wait until minPoolSize connections are
+    open, so the first requests after a deploy skip connection setup.
+    Returns the number of open connections (best effort, never raises).
+    """
+    if timeout is None:
+        timeout = PREWARM_TIMEOUT
+    client = get_mongo_client()
+    target = client.options.pool_options.min_pool_size
+    deadline = time.monotonic() + timeout
+    try:
+        # The first command selects a server; the pool then fills to minPoolSize
+        client.admin.command('ping')
+    except PyMongoError as e:
+        print(f"MongoDB pool pre-warm failed: {str(e)}")
+        return _pool_stats.open
+    while _pool_stats.open < target and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return _pool_stats.open
+
+def get_round_trip_stats():
+    """Return requests, round trips and the average per request for each route."""
+    with _round_trip_stats_lock:
+        stats = {route: dict(entry) for route, entry in _round_trip_stats.items()}
+    for entry in stats.values():
+        entry['per_request'] = round(entry['round_trips'] / entry['requests'], 2) if entry['requests'] else 0
+    return stats
+
+_request_log_lock = threading.Lock()
+
+def get_request_db_summary():
+    """
+    Return the MongoDB summary for the current request, or None outside
+    routes wrapped by with_db_connection.
+    """
+    if not has_app_context() or 'db_round_trips' not in g:
+        return None
+    slowest_command, slowest_us = g.db_slowest
+    return {
+        'request_ms': round((time.perf_counter() - g.request_start) * 1000, 3),
+        'round_trips': g.db_round_trips,
+        'db_ms': round(g.db_time_us / 1000, 3),
+        'slowest_command': slowest_command,
+        'slowest_ms': round(slowest_us / 1000, 3)
+    }
+
+def server_timing_header(summary):
+    """Format a request DB summary as a Server-Timing header value."""
+    value = f'db;dur={summary["db_ms"]};desc="{summary["round_trips"]} round trips"'
+    if summary['slowest_command']:
+        value += f', db-slowest;dur={summary["slowest_ms"]};desc="{summary["slowest_command"]}"'
+    return value
+
+def log_request_sample(record):
+    """Append record as a JSON line to REQUEST_LOG_PATH for a sample of requests."""
+    if not REQUEST_LOG_PATH or random.random() >= REQUEST_LOG_SAMPLE_RATE:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _request_log_lock:
+        with open(REQUEST_LOG_PATH, 'a') as log_file:
+            log_file.write(line)
+
+def record_round_trips(route, count):
+    with _round_trip_stats_lock:
+        entry = _round_trip_stats.setdefault(route, {'requests': 0, 'round_trips': 0})
+        entry['requests'] += 1
+        entry['round_trips'] += count
+
 def get_database(client=None):
     """Get database instance. Uses provided client or gets default."""
     if client is None:
         client = get_mongo_client()
     return client[DATABASE_NAME]
 
+# Last result of the background ping, served by the health probes
+_health_status = {'connected': False, 'last_ping_ms': None, 'last_checked': None, 'last_success': None, 'error': None}
+_health_lock = threading.Lock()
+_pinger_pid = None
+
+def _ping_loop():
+    client = get_mongo_client()
+    while True:
+        start = time.monotonic()
+        try:
+            client.admin.command('ping')
+            rtt_ms = round((time.monotonic() - start) * 1000, 2)
+            with _health_lock:
+                _health_status.update(connected=True, last_ping_ms=rtt_ms, last_checked=time.time(),
+                                      last_success=time.time(), error=None)
+        except PyMongoError as e:
+            with _health_lock:
+                _health_status.update(connected=False, last_checked=time.time(), error=str(e))
+        time.sleep(PING_INTERVAL)
+
+def start_health_pinger():
+    """Start the background MongoDB pinger for this process if it is not running."""
+    global _pinger_pid
+    with _health_lock:
+        # Threads do not survive fork, so each worker starts its own
+        if _pinger_pid == os.getpid():
+            return
+        _pinger_pid = os.getpid()
+    threading.Thread(target=_ping_loop, name='mongodb-pinger', daemon=True).start()
+
+_worker_threads_pid = None
+
+def start_worker_threads():
+    """
+    Start this process's background work once: index creation, the MongoDB
+    pinger and the lease expiry scheduler. Called from gunicorn's post_fork
+    and on the first request, never at import: with --preload the app is
+    imported in the master, and a worker forked from it would inherit its
+    client and the locks its threads hold.
+    """
+    global _worker_threads_pid
+    with _health_lock:
+        if _worker_threads_pid == os.getpid():
+            return
+        _worker_threads_pid = os.getpid()
+    if ENSURE_INDEXES:
+        # In the background, so an unreachable database never blocks a worker from serving
+        threading.Thread(target=ensure_indexes, name='mongodb-indexes', daemon=True).start()
+    start_health_pinger()
+    import lease_expiry
+    lease_expiry.start()
+
+def get_health_status():
+    """
+    Return the cached MongoDB status without touching the network: connectivity,
+    last ping RTT, staleness and pool statistics for the shared client.
+    """
+    start_health_pinger()
+    with _health_lock:
+        status = dict(_health_status)
+    now = time.time()
+    status['stale_seconds'] = round(now - status['last_checked'], 2) if status['last_checked'] else None
+    status['ready'] = bool(status['connected'] and status['stale_seconds'] is not None
+                           and status['stale_seconds'] <= PING_STALE_AFTER)
+    with _pool_stats.lock:
+        status['pool'] = {
+            'open_connections': _pool_stats.open,
+            'checked_out': _pool_stats.checked_out,
+            'checkout_failures': _pool_stats.checkout_failures,
+            'max_pool_size': get_mongo_client().options.pool_options.max_pool_size
+        }
+    return status
+
 def test_mongodb_connection():
-    """Test MongoDB connection."""
+    """Report MongoDB connectivity from the cached background ping."""
+    return get_health_status()['ready']
+
+class ServiceBusyError(Exception):
+    """Raised when a bounded resource is saturated; routes answer 503 with Retry-After."""
+    retry_after = 1
+
+def _record_transaction_stat(name):
+    with _transaction_stats_lock:
+        _transaction_stats[name] += 1
+
+def get_transaction_stats():
+    """Return a snapshot of this worker's transaction counters."""
+    with _transaction_stats_lock:
+        stats = dict(_transaction_stats)
+    stats['mode'] = TRANSACTIONS_MODE
+    stats['supported'] = _replicated
+    return stats
+
+def transactions_enabled(client):
+    """
+    Check whether multi-document transactions should be used.
+    Transactions need a replica set or sharded cluster; on a standalone mongod
+    callers fall back to their atomic non-transactional path.
+    """
+    if TRANSACTIONS_MODE == 'off':
+        return False
     try:
-        client = MongoClient(MONGODB_SERVER, serverSelectionTimeoutMS=10000)
-        client.server_info()
-        client.close()
-        return True
-    except Exception as e:
-        print(f"MongoDB connection error: {str(e)}")
+        return is_replicated(client)
+    except PyMongoError as e:
+        print(f"Could not determine transaction support: {str(e)}")
         return False
 
+def is_replicated(client):
+    """
+    True on a replica set or sharded cluster, where transactions and change
+    streams are available. Raises PyMongoError if the server cannot be reached.
+    """
+    global _replicated
+    if _replicated is None:
+        hello = client.admin.command('hello')
+        _replicated = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+    return _replicated
+
+def run_in_transaction(client, callback, max_retries=None):
+    """
+    Run callback(session) inside a transaction with bounded retry.
+
+    The callback returns the usual {'success': ...} result dict. A result with
+    success False aborts the transaction so none of its writes are applied.
+    Transient errors (including write conflicts) retry the whole callback;
+    an unknown commit result retries only the commit.
+    """
+    if max_retries is None:
+        max_retries = TRANSACTION_MAX_RETRIES
+
+    attempt = 0
+    while True:
+        with client.start_session() as session:
+            try:
+                session.start_transaction()
+                _transaction_local.after_commit = []
+                result = callback(session)
+                if not result.get('success'):
+                    session.abort_transaction()
+                    _record_transaction_stat('aborts')
+                    return result
+                _commit_with_retry(session, max_retries)
+                _record_transaction_stat('commits')
+                callbacks, _transaction_local.after_commit = _transaction_local.after_commit, None
+                for fn in callbacks:
+                    fn()
+                return result
+            except PyMongoError as e:
+                if session.in_transaction:
+                    session.abort_transaction()
+                _record_transaction_stat('aborts')
+                if e.has_error_label('TransientTransactionError') and attempt < max_retries:
+                    attempt += 1
+                    _record_transaction_stat('retries')
+                    # Jittered exponential backoff so contending workers spread out
+                    time.sleep(random.uniform(0, min(0.1, 0.005 * (2 ** attempt))))
+                    continue
+                raise
+            finally:
+                # Callbacks of an aborted attempt are dropped; a retry registers its own
+                _transaction_local.after_commit = None
+
+def after_commit(session, fn):
+    """
+    Run fn once the transaction of session has committed, or right away when
+    session is None (the non-transactional path has already written).
+    """
+    callbacks = getattr(_transaction_local, 'after_commit', None)
+    if session is None or callbacks is None:
+        fn()
+    else:
+        callbacks.append(fn)
+
+def _commit_with_retry(session, max_retries):
+    for attempt in range(max_retries + 1):
+        try:
+            session.commit_transaction()
+            return
+        except PyMongoError as e:
+            if e.has_error_label('UnknownTransactionCommitResult') and attempt < max_retries:
+                _record_transaction_stat('commit_retries')
+                continue
+            raise
+
+def run_transactional(client, callback):
+    """Run callback(session) in a transaction when supported, else callback(None)."""
+    if transactions_enabled(client):
+        return run_in_transaction(client, callback)
+    _record_transaction_stat('fallbacks')
+    return callback(None)
+
 def with_db_connection(f):
     """Decorator to handle MongoDB connection for Flask routes."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         client = get_mongo_client()
+        g.db_round_trips = 0
+        g.db_time_us = 0
+        g.db_slowest = (None, 0)
+        start = g.request_start = time.perf_counter()
+        error = False
         try:
             return f(client, *args, **kwargs)
+        except ServiceBusyError as e:
+            # Shed load quickly and tell the client when to come back
+            error = True
+            response = jsonify({'success': False, 'message': str(e), 'retry': True})
+            return response, 503, {'Retry-After': str(e.retry_after)}
         except Exception as e:
+            error = True
             return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+        finally:
+            metrics.record_request(f.__name__, time.perf_counter() - start, error)
+            record_round_trips(f.__name__, g.db_round_trips)
         # Note: We don't close the client here as it's reused via connection pooling
     
     return decorated_function
 
+def check_indexes(client=None, create=False):
+    """
+    Compare the indexes declared in INDEXES with those in the database.
+    Returns a report per collection listing missing and extra indexes
+    (such as the legacy userId_1). With create=True, missing indexes are
+    built first and reported as created.
+    """
+    if client is None:
+        client = get_mongo_client()
+    db = get_database(client)
+
+    report = {}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        declared = [model.document['name'] for model in models]
+        entry = {'created': [], 'missing': [], 'extra': [], 'errors': []}
+        try:
+            existing = set(collection.index_information())
+            missing = [model for model in models if model.document['name'] not in existing]
+            if create and missing:
+                for model in missing:
+                    try:
+                        collection.create_indexes([model])
+                        entry['created'].append(model.document['name'])
+                    except PyMongoError as e:
+                        # Usually duplicate data blocking a unique index
+                        entry['errors'].append(f"{model.document['name']}: {str(e)}")
+                existing = set(collection.index_information())
+            entry['missing'] = [name for name in declared if name not in existing]
+            if not any(model.document.get('unique') and model.document['name'] in entry['missing'] for model in models):
+                _unique_indexes_ready.add(collection_name)
+            entry['extra'] = sorted(name for name in existing if name != '_id_' and name not in declared)
+        except PyMongoError as e:
+            entry['errors'].append(str(e))
+        report[collection_name] = entry
+    return report
+
+class IndexesNotReadyError(ServiceBusyError):
+    """Raised by create paths while the unique indexes they rely on do not exist yet."""
+    retry_after = 5
+
+def unique_indexes_ready(client, collection_name):
+    """
+    True once every unique index declared for collection_name exists. The
+    indexes are built in the background (and fail to build over duplicate
+    data), so create paths check this before inserting; a confirmed
+    collection is not checked again.
+    """
+    if collection_name in _unique_indexes_ready:
+        return True
+    declared = {model.document['name'] for model in INDEXES[collection_name] if model.document.get('unique')}
+    try:
+        existing = set(get_database(client)[collection_name].index_information())
+    except PyMongoError:
+        return False
+    if declared <= existing:
+        _unique_indexes_ready.add(collection_name)
+        return True
+    return False
+
+def require_unique_indexes(client, collection_name):
+    """Raise IndexesNotReadyError unless collection_name's unique indexes exist."""
+    if not unique_indexes_ready(client, collection_name):
+        raise IndexesNotReadyError(
+            f'Unique indexes on {collection_name} are not in place yet; see GET /admin/indexes'
+        )
+
+def ensure_indexes(client=None):
+    """Create any missing declared indexes and return the index report."""
+    report = check_indexes(client, create=True)
+    for collection_name, entry in report.items():
+        if entry['created']:
+            print(f"Created indexes on {collection_name}: {', '.join(entry['created'])}")
+        if entry['extra']:
+            print(f"Undeclared indexes on {collection_name}: {', '.join(entry['extra'])}")
+        for error in entry['errors']:
+            print(f"Index error on {collection_name}: {error}")
+    return report
+
+def duplicate_key_field(error):
+    """Return the field that caused a DuplicateKeyError, or None if unknown."""
+    key_pattern = (error.details or {}).get('keyPattern')
+    if key_pattern:
+        return next(iter(key_pattern))
+    # Older servers only include the index name in the message
+    message = str(error)
+    for fields in INDEXES.values():
+        for model in fields:
+            name = model.document['name']
+            if f'index: {name}' in message:
+                return next(iter(model.document['key']))
+    if 'userId' in message:
+        return 'userId'
+    return None
+
 def drop_userId_index():
     """Drop the userId unique index from the users collection."""
     try:
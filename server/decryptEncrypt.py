@@ -1,5 +1,48 @@
 # Password hashing utilities using bcrypt for secure password storage
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import bcrypt
+import db_utils
+
+# Hashing configuration
+# BCRYPT_ROUNDS: cost factor for new hashes; existing hashes with a different
+# cost are re-hashed transparently on the next successful login
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+# BCRYPT_MAX_WORKERS: hashes computed concurrently (bcrypt releases the GIL)
+BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', '2'))
+# BCRYPT_MAX_QUEUE: hashes allowed to wait for a worker before requests are shed
+BCRYPT_MAX_QUEUE = int(os.environ.get('BCRYPT_MAX_QUEUE', '8'))
+
+class HasherBusyError(db_utils.ServiceBusyError):
+    """Raised when the bcrypt pool is saturated and the request should be retried."""
+
+# Dedicated, size-limited bcrypt pool so a burst of logins cannot occupy every
+# request thread. Created lazily so forked workers each start their own threads.
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(BCRYPT_MAX_WORKERS + BCRYPT_MAX_QUEUE)
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix='bcrypt')
+            _executor_pid = os.getpid()
+        return _executor
+
+def _run_hasher(fn, *args):
+    # Reserve a slot without waiting; a full pool means shed load immediately
+    if not _slots.acquire(blocking=False):
+        raise HasherBusyError('Too many password operations in progress, please try again')
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
 
 def validate_password_input(inputText: str):
     """Validate password input"""
@@ -18,10 +61,10 @@ def encrypt_password(password: str) -> str:
     """
     validate_password_input(password)
     
-    # Generate salt and hash password
+    # Generate salt and hash password on the bcrypt pool
     # bcrypt automatically generates a unique salt for each password
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    hashed = _run_hasher(bcrypt.hashpw, password.encode('utf-8'), salt)
     
     # Return as string (bcrypt hash includes the salt)
     return hashed.decode('utf-8')
@@ -33,7 +76,8 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     try:
         # bcrypt.checkpw handles the salt automatically
-        return bcrypt.checkpw(
+        return _run_hasher(
+            bcrypt.checkpw,
             plain_password.encode('utf-8'),
             hashed_password.encode('utf-8')
         )
@@ -41,6 +85,16 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
         # If password validation fails or hash is invalid, return False
         return False
 
+def needs_rehash(hashed_password: str) -> bool:
+    """
+    Check whether a stored hash was made with a different cost factor
+    than BCRYPT_ROUNDS. Hashes look like $2b$<cost>$<salt+hash>.
+    """
+    try:
+        return int(hashed_password.split('$')[2]) != BCRYPT_ROUNDS
+    except (AttributeError, IndexError, ValueError):
+        return False
+
 # Additional utility functions
 def is_valid_password(password: str) -> bool:
     """
@@ -0,0 +1,37 @@
+# Gunicorn configuration. Pass it explicitly, from the repository root:
+#
+#   gunicorn -c server/gunicorn.conf.py --chdir server app:app
+#
+# Gunicorn looks for a default gunicorn.conf.py before it applies --chdir, so
+# without -c this file is never loaded and none of the hooks below run.
+import os
+import shutil
+import sys
+import tempfile
+
+# Shared directory for per-worker Prometheus samples; must be set before any
+# worker imports prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'momentum-prometheus'))
+
+# The config is loaded before --chdir puts server/ on sys.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db_utils
+import metrics
+
+def on_starting(server):
+    # Start every deploy with an empty metrics directory
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+def post_fork(server, worker):
+    # Runs in each worker before it accepts traffic: build the worker's own
+    # MongoClient and open minPoolSize connections up front
+    open_connections = db_utils.prewarm_pool()
+    server.log.info(f"Worker {worker.pid}: MongoDB pool pre-warmed with {open_connections} connections")
+    # Index creation, the health pinger and lease expiry run in each worker
+    db_utils.start_worker_threads()
+
+def child_exit(server, worker):
+    metrics.mark_worker_dead(worker.pid)
@@ -1,35 +1,65 @@
 # Import necessary libraries and modules
-from pymongo import MongoClient
+import os
+import random
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import db_utils
+import hardware_versions
+import hardware_cache
+import checkout_coalescer
 
 '''
 Structure of Hardware Set entry:
 HardwareSet = {
     'hwName': hwSetName,
     'capacity': initCapacity,
-    'availability': initCapacity
+    'availability': initCapacity,
+    'version': int,               # stamped after every write (see hardware_versions.py)
+    'versionPending': [ObjectId], # tokens of writes not stamped yet
+    'writeSeq': int,              # bumped by every write of availability, so the
+                                  # cache can tell which of two values is newer
+    'shards': int                 # only on sharded sets (see shardHardwareSet)
 }
+
+A sharded set keeps its units in hardware_shards, so concurrent checkouts
+update different documents instead of queueing on one:
+HardwareShard = {
+    'hwName': hwSetName,
+    'shard': int,                 # 0 .. shards - 1
+    'capacity': int,              # this shard's part of the set's capacity
+    'availability': int
+}
+The set's own 'availability' is then the shards' total, brought up to date
+by the version stamper within HW_VERSION_FLUSH_INTERVAL of each write.
 '''
 
+# Most shard documents one hardware set may be split into
+HW_MAX_SHARDS = int(os.environ.get('HW_MAX_SHARDS', '64'))
+
 # Function to create a new hardware set
 def createHardwareSet(client, hwSetName, initCapacity):
     # Create a new hardware set in the database
     db = db_utils.get_database(client)
     hardware_collection = db['hardware_sets']
     
-    # Check if hardware set already exists
-    existing = hardware_collection.find_one({'hwName': hwSetName})
-    if existing:
-        return {'success': False, 'message': 'Hardware set already exists'}
-    
     # Create new hardware set
+    token = hardware_versions.new_token()
     hardware_set = {
         'hwName': hwSetName,
         'capacity': initCapacity,
-        'availability': initCapacity
+        'availability': initCapacity,
+        'versionPending': [token]
     }
     
-    result = hardware_collection.insert_one(hardware_set)
+    # Uniqueness of hwName is enforced by a unique index (see db_utils.INDEXES)
+    db_utils.require_unique_indexes(client, 'hardware_sets')
+    try:
+        result = hardware_collection.insert_one(hardware_set)
+    except DuplicateKeyError:
+        return {'success': False, 'message': 'Hardware set already exists'}
+    hardware_versions.record_write(None, [hwSetName], token)
+    # A new set changes the catalog every worker caches
+    hardware_cache.catalog_changed(client)
     return {'success': True, 'id': str(result.inserted_id)}
 
 # Function to query a hardware set by its name
@@ -38,10 +68,18 @@ def queryHardwareSet(client, hwSetName):
     db = db_utils.get_database(client)
     hardware_collection = db['hardware_sets']
     
-    hardware_set = hardware_collection.find_one({'hwName': hwSetName})
+    if hardware_cache.HW_CACHE_ENABLED:
+        hardware_set = hardware_cache.get_set(client, hwSetName)
+        if hardware_set:
+            return {'success': True, 'data': hardware_set}
+        # Possibly created since the catalog was cached: fall through to the database
+    hardware_set = hardware_collection.find_one({'hwName': hwSetName}, {'versionPending': 0, 'pendingBatches': 0, 'writeSeq': 0})
     if hardware_set:
-        # Convert ObjectId to string for JSON serialization
-        hardware_set['_id'] = str(hardware_set['_id'])
+        if hardware_cache.HW_CACHE_ENABLED:
+            # The cached catalog is missing a set, so reload it on the next read
+            hardware_cache.invalidate()
+        if hardware_set.get('shards'):
+            hardware_set['availability'] = _shardTotal(db, hwSetName)
         return {'success': True, 'data': hardware_set}
     else:
         return {'success': False, 'message': 'Hardware set not found'}
@@ -56,6 +94,8 @@ def updateAvailability(client, hwSetName, newAvailability):
     existing = hardware_collection.find_one({'hwName': hwSetName})
     if not existing:
         return {'success': False, 'message': 'Hardware set not found'}
+    if existing.get('shards'):
+        return {'success': False, 'message': 'Availability of a sharded hardware set cannot be set directly'}
     
     # Validate availability doesn't exceed capacity
     if newAvailability > existing['capacity']:
@@ -65,46 +105,316 @@ def updateAvailability(client, hwSetName, newAvailability):
         return {'success': False, 'message': 'Availability cannot be negative'}
     
     # Update availability
-    result = hardware_collection.update_one(
-        {'hwName': hwSetName},
-        {'$set': {'availability': newAvailability}}
+    token = hardware_versions.new_token()
+    updated = hardware_collection.find_one_and_update(
+        {'hwName': hwSetName, 'availability': {'$ne': newAvailability}, 'shards': {'$exists': False}},
+        {'$set': {'availability': newAvailability}, '$inc': {'writeSeq': 1}, '$push': {'versionPending': token}},
+        projection={'_id': 0, 'writeSeq': 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count > 0:
+    if updated:
+        hardware_versions.record_write(None, [hwSetName], token)
+        hardware_cache.note_availability(None, hwSetName, newAvailability, updated['writeSeq'])
         return {'success': True, 'message': 'Availability updated successfully'}
     else:
         return {'success': False, 'message': 'Failed to update availability'}
 
 # Function to request space from a hardware set
-def requestSpace(client, hwSetName, amount):
+def requestSpace(client, hwSetName, amount, session=None):
     # Request a certain amount of hardware and update availability
+    
+    # Validate amount is positive
+    if amount <= 0:
+        return {'success': False, 'message': 'Amount must be positive'}
+    
+    # Outside a transaction, concurrent requests for one set may share a single write
+    # (see checkout_coalescer.py); sharded sets already spread their writes
+    if session is None and checkout_coalescer.CHECKOUT_COALESCE_ENABLED and not _cachedShards(client, hwSetName):
+        return checkout_coalescer.submit(client, hwSetName, amount)
+    return _requestSpace(client, hwSetName, amount, session)
+
+def _requestSpace(client, hwSetName, amount, session):
     db = db_utils.get_database(client)
     hardware_collection = db['hardware_sets']
     
-    # Check if hardware set exists
-    hardware_set = hardware_collection.find_one({'hwName': hwSetName})
-    if not hardware_set:
-        return {'success': False, 'message': 'Hardware set not found'}
+    success = {'success': True, 'message': f'Successfully allocated {amount} units'}
+    failure = {'success': False, 'message': 'Not enough hardware available'}
     
-    # Check if enough space is available
-    if hardware_set['availability'] < amount:
-        return {'success': False, 'message': 'Not enough hardware available'}
+    # Sets the catalog cache knows to be sharded go straight to their shards
+    shards = _cachedShards(client, hwSetName)
+    if shards:
+        result = _moveShardUnits(client, hwSetName, shards, amount, -1, session, success, failure)
+        if result is not None:
+            return result
+    
+    # Reserve in a single round trip: the filter only matches while enough units
+    # remain, so concurrent checkouts can never oversell or overwrite each other
+    token = hardware_versions.new_token()
+    updated = hardware_collection.find_one_and_update(
+        {'hwName': hwSetName, 'availability': {'$gte': amount}, 'shards': {'$exists': False}},
+        {'$inc': {'availability': -amount, 'writeSeq': 1}, '$push': {'versionPending': token}},
+        projection={'_id': 0, 'availability': 1, 'writeSeq': 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if updated:
+        hardware_versions.record_write(session, [hwSetName], token)
+        hardware_cache.note_availability(session, hwSetName, updated['availability'], updated['writeSeq'])
+        return dict(success, new_availability=updated['availability'])
+    
+    # Reservation did not match - find out whether the set exists, and whether it is sharded
+    hardware_set = hardware_collection.find_one({'hwName': hwSetName}, {'_id': 0, 'shards': 1}, session=session)
+    if hardware_set is None:
+        return {'success': False, 'message': 'Hardware set not found'}
+    if hardware_set.get('shards'):
+        return _moveShardUnits(client, hwSetName, hardware_set['shards'], amount, -1, session, success, failure) or failure
+    return failure
+
+# Function to return space to a hardware set
+def releaseSpace(client, hwSetName, amount, session=None):
+    # Return a certain amount of hardware and update availability
+    db = db_utils.get_database(client)
+    hardware_collection = db['hardware_sets']
     
     # Validate amount is positive
     if amount <= 0:
         return {'success': False, 'message': 'Amount must be positive'}
     
-    # Update availability by reducing it
-    new_availability = hardware_set['availability'] - amount
-    result = hardware_collection.update_one(
-        {'hwName': hwSetName},
-        {'$set': {'availability': new_availability}}
+    success = {'success': True, 'message': f'Successfully returned {amount} units'}
+    failure = {'success': False, 'message': 'Availability cannot exceed capacity'}
+    
+    shards = _cachedShards(client, hwSetName)
+    if shards:
+        result = _moveShardUnits(client, hwSetName, shards, amount, 1, session, success, failure)
+        if result is not None:
+            return result
+    
+    # Increment in place so concurrent check-ins never overwrite each other;
+    # the filter keeps availability from exceeding capacity
+    token = hardware_versions.new_token()
+    updated = hardware_collection.find_one_and_update(
+        {'hwName': hwSetName, '$expr': {'$lte': [{'$add': ['$availability', amount]}, '$capacity']},
+         'shards': {'$exists': False}},
+        {'$inc': {'availability': amount, 'writeSeq': 1}, '$push': {'versionPending': token}},
+        projection={'_id': 0, 'availability': 1, 'writeSeq': 1},
+        return_document=ReturnDocument.AFTER,
+        session=session
     )
+    if updated:
+        hardware_versions.record_write(session, [hwSetName], token)
+        hardware_cache.note_availability(session, hwSetName, updated['availability'], updated['writeSeq'])
+        return dict(success, new_availability=updated['availability'])
     
-    if result.modified_count > 0:
-        return {'success': True, 'message': f'Successfully allocated {amount} units', 'new_availability': new_availability}
+    hardware_set = hardware_collection.find_one({'hwName': hwSetName}, {'_id': 0, 'shards': 1}, session=session)
+    if hardware_set is None:
+        return {'success': False, 'message': 'Hardware set not found'}
+    if hardware_set.get('shards'):
+        return _moveShardUnits(client, hwSetName, hardware_set['shards'], amount, 1, session, success, failure) or failure
+    return failure
+
+# Function to request space for several callers of requestSpace at once
+def requestSpaceBatch(client, hwSetName, amounts):
+    # amounts are positive and in arrival order. Returns one requestSpace result
+    # per amount, as if the requests had run one after another in that order:
+    # each is granted while enough units remain, and sees the availability
+    # right after its own grant. Usually a single write covers every request.
+    db = db_utils.get_database(client)
+    hardware_collection = db['hardware_sets']
+    
+    def serially():
+        return [_requestSpace(client, hwSetName, amount, None) for amount in amounts]
+    
+    if len(amounts) == 1 or _cachedShards(client, hwSetName):
+        # Sharded sets already spread their writes
+        return serially()
+    
+    def take(available_filter, total):
+        token = hardware_versions.new_token()
+        updated = hardware_collection.find_one_and_update(
+            {'hwName': hwSetName, 'availability': available_filter, 'shards': {'$exists': False}},
+            {'$inc': {'availability': -total, 'writeSeq': 1}, '$push': {'versionPending': token}},
+            projection={'_id': 0, 'availability': 1, 'writeSeq': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated:
+            hardware_versions.record_write(None, [hwSetName], token)
+            hardware_cache.note_availability(None, hwSetName, updated['availability'], updated['writeSeq'])
+        return updated
+    
+    def results(available, granted):
+        # Replay the grants in arrival order starting from the availability before the write
+        out = []
+        for amount, ok in zip(amounts, granted):
+            if ok:
+                available -= amount
+                out.append({'success': True, 'message': f'Successfully allocated {amount} units',
+                            'new_availability': available})
+            else:
+                out.append({'success': False, 'message': 'Not enough hardware available'})
+        return out
+    
+    # Common case: enough for everyone, in one conditional write
+    total = sum(amounts)
+    updated = take({'$gte': total}, total)
+    if updated:
+        return results(updated['availability'] + total, [True] * len(amounts))
+    
+    # Not enough for all: grant in arrival order from the current availability,
+    # with a write that only applies if that availability has not changed since
+    for _ in range(3):
+        hardware_set = hardware_collection.find_one({'hwName': hwSetName}, {'_id': 0, 'availability': 1, 'shards': 1})
+        if hardware_set is None:
+            return [{'success': False, 'message': 'Hardware set not found'} for _ in amounts]
+        if hardware_set.get('shards'):
+            return serially()
+        available = remaining = hardware_set['availability']
+        granted = []
+        for amount in amounts:
+            granted.append(amount <= remaining)
+            if granted[-1]:
+                remaining -= amount
+        if remaining == available:
+            return results(available, granted)
+        if take(available, available - remaining):
+            return results(available, granted)
+    # Availability keeps moving under us: fall back to one write per request
+    return serially()
+
+# Helper: shard count of a hardware set according to the catalog cache (None if unsharded or unknown)
+def _cachedShards(client, hwSetName):
+    if not hardware_cache.HW_CACHE_ENABLED:
+        return None
+    hardware_set = hardware_cache.get_set(client, hwSetName)
+    return hardware_set.get('shards') if hardware_set else None
+
+# Helper: current total availability of a sharded set
+def _shardTotal(db, hwSetName, session=None):
+    shards = db['hardware_shards'].find({'hwName': hwSetName}, {'_id': 0, 'availability': 1}, session=session)
+    return sum(shard['availability'] for shard in shards)
+
+# Helper for requestSpace/releaseSpace on a sharded set: sign -1 takes units, +1 returns them.
+# Returns success (with the new total) or failure, or None if the set has no shards after all.
+def _moveShardUnits(client, hwSetName, shards, amount, sign, session, success, failure):
+    db = db_utils.get_database(client)
+    shard_collection = db['hardware_shards']
+    
+    def fits(units):
+        # Filter matching a shard that can give (or take back) units
+        if sign < 0:
+            return {'availability': {'$gte': units}}
+        return {'$expr': {'$lte': [{'$add': ['$availability', units]}, '$capacity']}}
+    
+    def move(shard, units):
+        result = shard_collection.update_one(
+            {'hwName': hwSetName, 'shard': shard, **fits(units)},
+            {'$inc': {'availability': sign * units}},
+            session=session
+        )
+        return result.modified_count > 0
+    
+    # Start at a random shard so concurrent requests spread out, then spill over to the others
+    start = random.randrange(shards)
+    moved = None
+    for i in range(shards):
+        shard = (start + i) % shards
+        if move(shard, amount):
+            moved = [(shard, amount)]
+            break
+    
+    if moved is None:
+        # No single shard can cover the amount: split it, and undo if the shards together cannot
+        shard_docs = list(shard_collection.find(
+            {'hwName': hwSetName}, {'_id': 0, 'shard': 1, 'capacity': 1, 'availability': 1}, session=session
+        ))
+        if not shard_docs:
+            return None
+        moved = []
+        remaining = amount
+        for shard in shard_docs:
+            room = shard['availability'] if sign < 0 else shard['capacity'] - shard['availability']
+            units = min(room, remaining)
+            if units > 0 and move(shard['shard'], units):
+                moved.append((shard['shard'], units))
+                remaining -= units
+                if not remaining:
+                    break
+        if remaining:
+            for shard, units in moved:
+                shard_collection.update_one({'hwName': hwSetName, 'shard': shard},
+                                            {'$inc': {'availability': -sign * units}}, session=session)
+            return failure
+    
+    # The total is not noted in the cache: reads of the shards have no order
+    # against each other, so it could replace a newer one. The stamper writes
+    # it to the set, which the cache picks up on its next revalidation.
+    total = _shardTotal(db, hwSetName, session)
+    hardware_versions.record_shard_write(session, hwSetName)
+    return dict(success, new_availability=total)
+
+# Function to split a hardware set's units across shard documents (or merge them back)
+def shardHardwareSet(client, hwSetName, shards):
+    # Opt-in for hot sets: with shards > 1 checkouts spread over that many
+    # documents in hardware_shards; shards <= 1 merges them back into the set.
+    # Runs in a transaction when the deployment supports one; otherwise
+    # checkouts racing the conversion may briefly see no units.
+    if shards > HW_MAX_SHARDS:
+        return {'success': False, 'message': f'shards cannot exceed {HW_MAX_SHARDS}'}
+    return db_utils.run_transactional(
+        client, lambda session: _shardHardwareSet(client, hwSetName, shards, session)
+    )
+
+def _shardHardwareSet(client, hwSetName, shards, session):
+    db = db_utils.get_database(client)
+    hardware_collection = db['hardware_sets']
+    shard_collection = db['hardware_shards']
+    
+    def split(total, shard):
+        # Even split, with the remainder spread over the first shards
+        return total // shards + (1 if shard < total % shards else 0)
+    
+    if shards > 1:
+        # Mark the set sharded and read its units in one atomic step
+        hardware_set = hardware_collection.find_one_and_update(
+            {'hwName': hwSetName, 'shards': {'$exists': False}},
+            {'$set': {'shards': shards}},
+            projection={'_id': 0, 'capacity': 1, 'availability': 1},
+            session=session
+        )
+        if hardware_set is None:
+            if hardware_collection.find_one({'hwName': hwSetName}, {'_id': 1}, session=session) is None:
+                return {'success': False, 'message': 'Hardware set not found'}
+            return {'success': False, 'message': 'Hardware set is already sharded; merge it first'}
+        shard_collection.insert_many([
+            {'hwName': hwSetName, 'shard': shard, 'capacity': split(hardware_set['capacity'], shard),
+             'availability': split(hardware_set['availability'], shard)}
+            for shard in range(shards)
+        ], session=session)
+        message = f'Hardware set split into {shards} shards'
     else:
-        return {'success': False, 'message': 'Failed to allocate hardware'}
+        if hardware_collection.find_one({'hwName': hwSetName, 'shards': {'$exists': True}}, {'_id': 1},
+                                        session=session) is None:
+            return {'success': False, 'message': 'Hardware set not found or not sharded'}
+        # Remove the shards one at a time so each one's final count is exact
+        total = 0
+        while True:
+            shard = shard_collection.find_one_and_delete({'hwName': hwSetName}, session=session)
+            if shard is None:
+                break
+            total += shard['availability']
+        token = hardware_versions.new_token()
+        hardware_collection.update_one(
+            {'hwName': hwSetName},
+            {'$set': {'availability': total}, '$unset': {'shards': ''}, '$inc': {'writeSeq': 1},
+             '$push': {'versionPending': token}},
+            session=session
+        )
+        hardware_versions.record_write(session, [hwSetName], token)
+        message = 'Hardware set shards merged'
+    
+    # Sharding is part of the catalog every worker caches
+    db_utils.after_commit(session, lambda: hardware_cache.catalog_changed(client))
+    return {'success': True, 'message': message}
 
 # Function to get all hardware set names
 def getAllHwNames(client):
@@ -113,6 +423,8 @@ def getAllHwNames(client):
     hardware_collection = db['hardware_sets']
     
     try:
+        if hardware_cache.HW_CACHE_ENABLED:
+            return {'success': True, 'data': [hw['hwName'] for hw in hardware_cache.get_sets(client)]}
         # Get all hardware sets and extract just the names
         hardware_sets = hardware_collection.find({}, {'hwName': 1, '_id': 0})
         names = [hw['hwName'] for hw in hardware_sets]
@@ -121,18 +433,39 @@ def getAllHwNames(client):
         return {'success': False, 'message': f'Error retrieving hardware names: {str(e)}'}
 
 # Function to get all hardware sets with full details
-def getAllHardwareSets(client):
-    # Get and return all hardware sets with full details
+def getAllHardwareSets(client, since=None):
+    # Get and return all hardware sets with full details, or with since=<version>
+    # only the sets changed after that version plus the new collection version
     db = db_utils.get_database(client)
     hardware_collection = db['hardware_sets']
     
     try:
-        hardware_sets = list(hardware_collection.find({}))
-        # Convert ObjectId to string for JSON serialization and rename hwName to hwSetName for consistency
+        if since is None and hardware_cache.HW_CACHE_ENABLED:
+            hardware_sets = hardware_cache.get_sets(client)
+        elif since is None:
+            hardware_sets = list(hardware_collection.find({}, {'version': 0, 'versionPending': 0, 'pendingBatches': 0, 'writeSeq': 0}))
+        else:
+            # Read the collection version first: every set stamped at or below it
+            # is then either stamped in this read or still pending in it
+            version = hardware_versions.current_version(client)
+            # since=0, or a version from before the counter was reset, needs everything
+            full = since == 0 or since > version
+            query = {} if full else {'$or': [{'version': {'$gt': since}}] + hardware_versions.UNSTAMPED}
+            hardware_sets = list(hardware_collection.find(query, {'pendingBatches': 0, 'writeSeq': 0}))
+            # Sets written before versioning get a version so later deltas can skip them
+            unversioned = [hw['hwName'] for hw in hardware_sets if 'version' not in hw]
+            if unversioned:
+                hardware_versions.stamp(unversioned)
+            # So do sets whose writer died before stamping them
+            hardware_versions.stamp_orphans(hardware_sets)
+            for hw in hardware_sets:
+                hw.pop('versionPending', None)
+        # Rename hwName to hwSetName for consistency (ObjectId is encoded by the JSON provider)
         for hw in hardware_sets:
-            hw['_id'] = str(hw['_id'])
             hw['hwSetName'] = hw.get('hwName', '')
-        return {'success': True, 'data': hardware_sets}
+        if since is None:
+            return {'success': True, 'data': hardware_sets}
+        return {'success': True, 'data': hardware_sets, 'version': version, 'full': full}
     except Exception as e:
         return {'success': False, 'message': f'Error retrieving hardware sets: {str(e)}'}
 
@@ -0,0 +1,210 @@
+# Per-worker cache of the hardware catalog in front of hardwareDatabase reads
+#
+# getAllHwNames, getAllHardwareSets (without since) and queryHardwareSet are
+# served from memory. The catalog (names, capacities, everything but
+# availability) is kept until it changes; availability is trusted for
+# HW_CACHE_AVAILABILITY_TTL seconds. After that, the next read revalidates
+# with one small query on the counters collection, which holds two versions:
+#
+# - hardware_catalog, bumped by writes that change the catalog
+#   (createHardwareSet); a new value reloads the whole catalog
+# - hardware_sets, the collection version bumped by every stamped write (see
+#   hardware_versions.py); a new value reloads availability only
+#
+# With nothing changed, the revalidation is the only round trip. Checkouts
+# and check-ins made by this worker update the cached availability as soon as
+# they commit. Writes from other workers show up within the TTL plus the
+# version stamping delay (HW_VERSION_FLUSH_INTERVAL).
+#
+# Concurrent writes can commit in one order and be noted in another, so every
+# cached value keeps the set's writeSeq, which each availability write bumps.
+# A value is only replaced by one with a higher writeSeq.
+import os
+import threading
+import time
+
+import db_utils
+import hardware_versions
+
+HW_CACHE_ENABLED = os.environ.get('HW_CACHE', 'true').lower() == 'true'
+HW_CACHE_AVAILABILITY_TTL = float(os.environ.get('HW_CACHE_AVAILABILITY_TTL', '1'))
+
+# _id of the catalog version in the counters collection
+CATALOG_COUNTER_ID = 'hardware_catalog'
+
+# Bookkeeping fields left out of cached sets
+_EXCLUDED = {'version': 0, 'versionPending': 0, 'pendingBatches': 0}
+
+class HardwareCache:
+    """Catalog and availability of every hardware set, revalidated through the counters collection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # One revalidation at a time; other readers wait for its result instead of piling onto MongoDB
+        self.refresh_lock = threading.Lock()
+        self.catalog = None    # hwName -> catalog fields, in collection order
+        self.availability = {}  # hwName -> availability
+        self.write_seqs = {}    # hwName -> writeSeq of the cached availability
+        self.catalog_version = None
+        self.sets_version = None
+        self.checked_at = 0.0   # time.monotonic() of the last load or revalidation
+        self.stats = {'hits': 0, 'revalidations': 0, 'catalog_loads': 0, 'availability_loads': 0,
+                      'local_updates': 0, 'stale_updates': 0, 'invalidations': 0}
+        self.age_total = 0.0
+        self.age_max = 0.0
+
+    def _fresh(self, now):
+        return self.catalog is not None and now - self.checked_at < HW_CACHE_AVAILABILITY_TTL
+
+    def read(self, client, hwSetName=None):
+        """
+        Every hardware set as its catalog fields plus 'availability', or only
+        hwSetName (None if the catalog does not have it). Copies, so callers
+        may add or rename fields.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self._fresh(now):
+                return self._read(now, hwSetName)
+        with self.refresh_lock:
+            with self.lock:
+                if self._fresh(time.monotonic()):
+                    # Revalidated by another thread while this one waited
+                    return self._read(time.monotonic(), hwSetName)
+            self._revalidate(client)
+            with self.lock:
+                return self._read(None, hwSetName)
+
+    def _read(self, now, hwSetName):
+        # now is None right after a revalidation, which is not a hit
+        if now is not None:
+            self.stats['hits'] += 1
+            age = now - self.checked_at
+            self.age_total += age
+            self.age_max = max(self.age_max, age)
+        if hwSetName is not None:
+            fields = self.catalog.get(hwSetName)
+            return dict(fields, availability=self.availability.get(hwSetName)) if fields else None
+        return [dict(fields, availability=self.availability.get(name)) for name, fields in self.catalog.items()]
+
+    def _revalidate(self, client):
+        db = db_utils.get_database(client)
+        counters = {
+            counter['_id']: counter['value']
+            for counter in db['counters'].find({'_id': {'$in': [CATALOG_COUNTER_ID, hardware_versions.COUNTER_ID]}})
+        }
+        catalog_version = counters.get(CATALOG_COUNTER_ID, 0)
+        sets_version = counters.get(hardware_versions.COUNTER_ID, 0)
+
+        if self.catalog is None or self.catalog_version is None or catalog_version != self.catalog_version:
+            self._load_catalog(db)
+        elif sets_version != self.sets_version:
+            hardware_sets = list(db['hardware_sets'].find({}, {'_id': 0, 'hwName': 1, 'availability': 1, 'writeSeq': 1}))
+            if {hw['hwName'] for hw in hardware_sets} != self.catalog.keys():
+                # Sets added or removed without a catalog bump (e.g. seeded directly)
+                self._load_catalog(db)
+            else:
+                with self.lock:
+                    self._set_availability(hardware_sets)
+                    self.stats['availability_loads'] += 1
+        else:
+            with self.lock:
+                self.stats['revalidations'] += 1
+
+        with self.lock:
+            self.catalog_version = catalog_version
+            self.sets_version = sets_version
+            self.checked_at = time.monotonic()
+
+    def _load_catalog(self, db):
+        catalog = {}
+        hardware_sets = []
+        for hw in db['hardware_sets'].find({}, _EXCLUDED):
+            hardware_sets.append({'hwName': hw['hwName'], 'availability': hw.pop('availability', None),
+                                  'writeSeq': hw.pop('writeSeq', 0)})
+            catalog[hw['hwName']] = hw
+        with self.lock:
+            self.catalog = catalog
+            # A new catalog may hold recreated sets, whose writeSeq starts over
+            self.write_seqs = {}
+            self._set_availability(hardware_sets)
+            self.stats['catalog_loads'] += 1
+
+    def _set_availability(self, hardware_sets):
+        # Called with the lock held. A value noted while the read was in flight
+        # may be newer than the one read; it is kept.
+        availability, write_seqs = {}, {}
+        for hw in hardware_sets:
+            name, seq = hw['hwName'], hw.get('writeSeq', 0)
+            if self.write_seqs.get(name, -1) > seq and name in self.availability:
+                availability[name], write_seqs[name] = self.availability[name], self.write_seqs[name]
+            else:
+                availability[name], write_seqs[name] = hw.get('availability'), seq
+        self.availability, self.write_seqs = availability, write_seqs
+
+    def note_availability(self, hwSetName, availability, write_seq):
+        with self.lock:
+            if self.catalog is None or hwSetName not in self.catalog:
+                return
+            if write_seq <= self.write_seqs.get(hwSetName, -1):
+                # A later write to the set is cached already
+                self.stats['stale_updates'] += 1
+                return
+            self.availability[hwSetName] = availability
+            self.write_seqs[hwSetName] = write_seq
+            self.stats['local_updates'] += 1
+
+    def invalidate(self):
+        # The next read reloads the catalog; until then the current one stays readable
+        with self.lock:
+            self.catalog_version = None
+            self.checked_at = 0.0
+            self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            hits = stats['hits']
+            misses = stats['revalidations'] + stats['catalog_loads'] + stats['availability_loads']
+            stats.update({
+                'enabled': HW_CACHE_ENABLED,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+                # How old the cached availability was when served
+                'served_age_ms_avg': round(self.age_total / hits * 1000, 3) if hits else None,
+                'served_age_ms_max': round(self.age_max * 1000, 3),
+                'hardware_sets': len(self.catalog) if self.catalog is not None else None,
+                'availability_ttl_s': HW_CACHE_AVAILABILITY_TTL
+            })
+            return stats
+
+_cache = HardwareCache()
+
+def get_cache():
+    return _cache
+
+def get_sets(client):
+    return _cache.read(client)
+
+def get_set(client, hwSetName):
+    """One hardware set from the cache, or None if the catalog does not have it."""
+    return _cache.read(client, hwSetName)
+
+def note_availability(session, hwSetName, availability, write_seq):
+    """Record availability written by this worker (write_seq: the set's writeSeq after the write) once session's transaction (if any) commits."""
+    if HW_CACHE_ENABLED:
+        db_utils.after_commit(session, lambda: _cache.note_availability(hwSetName, availability, write_seq))
+
+def invalidate():
+    """Reload this worker's catalog on the next read."""
+    _cache.invalidate()
+
+def catalog_changed(client):
+    """Bump the catalog version so every worker reloads its catalog on its next revalidation."""
+    db_utils.get_database(client)['counters'].update_one(
+        {'_id': CATALOG_COUNTER_ID}, {'$inc': {'value': 1}}, upsert=True
+    )
+    _cache.invalidate()
+
+def get_stats():
+    return _cache.get_stats()
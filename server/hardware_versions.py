@@ -0,0 +1,198 @@
+# Monotonic versions of hardware sets, for delta sync (/get_all_hardware?since=)
+#
+# Every hardware set carries a 'version', and the counters collection holds
+# the collection version: the highest version handed out so far. A write to
+# a set pushes a unique token onto the set's 'versionPending' list in the same
+# update, and once the write has committed the token is queued here. A
+# background thread per worker stamps the queued sets in batches: one $inc on
+# the counter reserves a block of versions and one bulk write gives each set
+# the next one and pulls its tokens, so writes pay no extra round trip.
+#
+# Readers take the collection version before reading the sets and return every
+# set stamped after 'since' plus every set still pending. A version is only
+# handed out once its write is visible, so a set stamped at or below the
+# version a reader returned was either in that read or pending in it: no
+# write falls between two polls.
+#
+# A worker that dies between a write and its stamp leaves the token behind,
+# which would keep the set pending (and in every delta) for good. Tokens are
+# ObjectIds, so their age is known: a reader that meets one older than
+# HW_VERSION_ORPHAN_SECONDS queues the set with that token, and the next flush
+# stamps it and pulls the token like any other.
+#
+# Sharded sets (see shardHardwareSet) are written through their shard
+# documents, so the stamper also keeps their 'availability' current: each
+# flush sums the shards of the sets written since the last one and writes the
+# totals in the same batch, as writes of their own that get stamped with it.
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+import db_utils
+
+# Seconds queued writes wait so that concurrent ones are stamped together
+HW_VERSION_FLUSH_INTERVAL = float(os.environ.get('HW_VERSION_FLUSH_INTERVAL', '0.05'))
+# Age after which a pending token is taken to belong to a worker that died
+# before stamping it; readers then have the set stamped themselves
+HW_VERSION_ORPHAN_SECONDS = float(os.environ.get('HW_VERSION_ORPHAN_SECONDS', '60'))
+
+# _id of the collection version in the counters collection
+COUNTER_ID = 'hardware_sets'
+
+# Matches sets with a write that has not been stamped yet, or no version at all
+# (created before versioning); readers always include them
+UNSTAMPED = [{'versionPending.0': {'$exists': True}}, {'version': {'$exists': False}}]
+
+class _Stamper:
+    """Per-worker queue of written hardware sets, stamped in batches by a background thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = {}  # hwName -> tokens of the committed writes to pull
+        self.sharded = set()  # sharded sets whose total availability is out of date
+        self.pid = None
+
+    def _start(self):
+        # Called with the lock held
+        if self.pid != os.getpid():
+            # Threads do not survive fork: the child starts its own stamper
+            self.pid = os.getpid()
+            self.pending = {}
+            self.sharded = set()
+            threading.Thread(target=self._run, name='hw-version-stamper', daemon=True).start()
+
+    def enqueue(self, names, token=None):
+        with self.lock:
+            self._start()
+            for name in names:
+                tokens = self.pending.setdefault(name, [])
+                if token is not None:
+                    tokens.append(token)
+            self.ready.notify()
+
+    def enqueue_tokens(self, pending):
+        # pending: hwName -> tokens to pull when the set is stamped
+        with self.lock:
+            self._start()
+            for name, tokens in pending.items():
+                self.pending.setdefault(name, []).extend(tokens)
+            self.ready.notify()
+
+    def enqueue_shards(self, name):
+        with self.lock:
+            self._start()
+            self.sharded.add(name)
+            self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.sharded:
+                    self.ready.wait()
+            time.sleep(HW_VERSION_FLUSH_INTERVAL)
+            if not self.flush():
+                time.sleep(1)
+
+    def flush(self):
+        """Stamp every queued set now; returns False (keeping them queued) if MongoDB failed."""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            sharded, self.sharded = self.sharded, set()
+        if not batch and not sharded:
+            return True
+        db = db_utils.get_database()
+        try:
+            if sharded:
+                self._materialize(db, sharded, batch)
+                sharded = set()
+            if not batch:
+                return True
+            # Reserve one version per set, then stamp them all in one round trip
+            counter = db['counters'].find_one_and_update(
+                {'_id': COUNTER_ID},
+                {'$inc': {'value': len(batch)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            first = counter['value'] - len(batch) + 1
+            db['hardware_sets'].bulk_write([
+                UpdateOne({'hwName': name}, {'$max': {'version': first + i}, '$pullAll': {'versionPending': tokens}})
+                for i, (name, tokens) in enumerate(batch.items())
+            ], ordered=False)
+            return True
+        except PyMongoError as e:
+            # Versions reserved by a failed attempt are skipped; gaps are harmless
+            print(f"Could not stamp hardware set versions: {str(e)}")
+            with self.lock:
+                for name, tokens in batch.items():
+                    self.pending.setdefault(name, []).extend(tokens)
+                self.sharded |= sharded
+            return False
+
+    def _materialize(self, db, names, batch):
+        # Write the sum of each sharded set's shards to the set itself, pushing a
+        # token that the stamp below pulls along with the batch's other tokens
+        totals = {
+            group['_id']: group['availability']
+            for group in db['hardware_shards'].aggregate([
+                {'$match': {'hwName': {'$in': list(names)}}},
+                {'$group': {'_id': '$hwName', 'availability': {'$sum': '$availability'}}}
+            ])
+        }
+        if not totals:
+            return
+        tokens = {name: new_token() for name in totals}
+        # 'shards' in the filter skips sets merged back since their write
+        db['hardware_sets'].bulk_write([
+            UpdateOne({'hwName': name, 'shards': {'$exists': True}},
+                      {'$set': {'availability': total}, '$inc': {'writeSeq': 1}, '$push': {'versionPending': tokens[name]}})
+            for name, total in totals.items()
+        ], ordered=False)
+        for name, token in tokens.items():
+            batch.setdefault(name, []).append(token)
+
+_stamper = _Stamper()
+atexit.register(_stamper.flush)
+
+def new_token():
+    """Token a write pushes onto versionPending of every set it changes."""
+    return ObjectId()
+
+def record_write(session, names, token):
+    """Queue the written sets for stamping once session's transaction (if any) commits."""
+    db_utils.after_commit(session, lambda: _stamper.enqueue(names, token))
+
+def record_shard_write(session, name):
+    """Queue a sharded set to have its total availability written (and stamped) once session commits."""
+    db_utils.after_commit(session, lambda: _stamper.enqueue_shards(name))
+
+def stamp(names):
+    """Queue sets for a new version without a write, e.g. ones created before versioning."""
+    _stamper.enqueue(names)
+
+def stamp_orphans(hardware_sets):
+    """Queue read sets whose pending tokens are older than HW_VERSION_ORPHAN_SECONDS, pulling those tokens."""
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=HW_VERSION_ORPHAN_SECONDS)
+    orphans = {}
+    for hw in hardware_sets:
+        stale = [token for token in hw.get('versionPending', []) if token.generation_time < cutoff]
+        if stale:
+            orphans[hw['hwName']] = stale
+    if orphans:
+        _stamper.enqueue_tokens(orphans)
+    return list(orphans)
+
+def flush():
+    return _stamper.flush()
+
+def current_version(client, session=None):
+    """The collection version: no set has been stamped with a higher one."""
+    counter = db_utils.get_database(client)['counters'].find_one({'_id': COUNTER_ID}, session=session)
+    return counter['value'] if counter else 0
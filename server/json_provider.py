@@ -0,0 +1,56 @@
+# Flask JSON provider backed by orjson
+#
+# Installed on the app in app.py (app.json = OrjsonProvider(app)), so jsonify,
+# request.get_json and the async build (asgi.py) all go through it. ObjectId,
+# Decimal128 and Decimal are encoded here; datetime, date, UUID and dataclasses
+# are encoded natively by orjson. Handlers can therefore return documents
+# straight from a cursor instead of stringifying _id and timestamps first.
+# Datetimes are ISO 8601 (2024-01-31T12:00:00.123000), the same text
+# datetime.isoformat() gives, rather than Flask's default HTTP date format.
+from decimal import Decimal
+
+import orjson
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from flask.json.provider import DefaultJSONProvider
+
+def _default(value):
+    # Types orjson does not encode by itself
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider using orjson, with BSON types encoded natively."""
+
+    # Keep document field order instead of sorting every object
+    sort_keys = False
+
+    def _options(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumpb(self, obj, indent=False):
+        """Serialize obj to UTF-8 JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=self._options(indent))
+
+    def dumps(self, obj, **kwargs):
+        # Unknown stdlib json arguments (cls, separators, ...) are ignored
+        return self.dumpb(obj, indent=bool(kwargs.get('indent'))).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Same contract as DefaultJSONProvider.response, without the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dumpb(obj, indent) + b'\n', mimetype=self.mimetype)
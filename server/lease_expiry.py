@@ -0,0 +1,174 @@
+# Automatic return of time-limited checkouts (leases, see leasesDatabase.py)
+#
+# Each worker runs one scheduler thread over a heap of upcoming expiry times.
+# Leases this worker creates are pushed onto the heap once their checkout
+# commits. Every LEASE_POLL_INTERVAL seconds the thread also loads the
+# expiries due before its next poll from the lease_expiry index, which picks
+# up leases created by other workers or left over from a restart. Leases
+# further out are not held in memory until a later poll reaches them.
+#
+# The thread sleeps until the earliest expiry, then drains every expired
+# lease, not just its own, in batches of LEASE_BATCH_SIZE: one claim, one
+# mark and one delete of the leases no check-in settled meanwhile, one write
+# per project and hardware set, and one history insert per batch, so a
+# backlog goes back quickly. Workers race for the same leases
+# through atomic claims: the claim update only matches unclaimed leases, so
+# each lease is returned once. A claim lapses after LEASE_CLAIM_TTL seconds,
+# after which another worker may take over the leases of one that died.
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db_utils
+import leasesDatabase
+
+LEASE_EXPIRY_ENABLED = os.environ.get('LEASE_EXPIRY', 'true').lower() == 'true'
+LEASE_MAX_SECONDS = int(os.environ.get('LEASE_MAX_SECONDS', str(30 * 24 * 3600)))
+LEASE_BATCH_SIZE = int(os.environ.get('LEASE_BATCH_SIZE', '100'))
+LEASE_POLL_INTERVAL = float(os.environ.get('LEASE_POLL_INTERVAL', '30'))
+LEASE_CLAIM_TTL = float(os.environ.get('LEASE_CLAIM_TTL', '60'))
+
+class LeaseScheduler:
+    """Heap of upcoming lease expiries, drained by a background thread per worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.heap = []          # (expiresAt, leaseId), earliest first
+        self.queued = set()     # leaseIds in the heap
+        self.pid = None
+        self.next_poll = 0.0    # time.monotonic() of the next index load
+        self.stats = {'scheduled': 0, 'loaded': 0, 'runs': 0, 'batches': 0, 'expired': 0,
+                      'units_returned': 0, 'failed': 0, 'errors': 0}
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def start(self):
+        with self.lock:
+            # Threads do not survive fork, so each worker starts its own
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.heap = []
+            self.queued = set()
+            self.next_poll = 0.0
+        threading.Thread(target=self._run, name='lease-expiry', daemon=True).start()
+
+    def push(self, expires_at, lease_id):
+        with self.lock:
+            # Leases past the next poll are loaded from the index when it comes
+            horizon = datetime.utcnow() + timedelta(seconds=max(self.next_poll - time.monotonic(), 0))
+            if lease_id in self.queued or expires_at > horizon:
+                return
+            heapq.heappush(self.heap, (expires_at, lease_id))
+            self.queued.add(lease_id)
+            self.stats['scheduled'] += 1
+            if self.heap[0][1] == lease_id:
+                # New earliest expiry: wake the thread to shorten its sleep
+                self.wakeup.notify()
+
+    def _run(self):
+        client = db_utils.get_mongo_client()
+        while True:
+            with self.lock:
+                timeout = self.next_poll - time.monotonic()
+                if self.heap:
+                    timeout = min(timeout, (self.heap[0][0] - datetime.utcnow()).total_seconds())
+                if timeout > 0:
+                    self.wakeup.wait(timeout)
+                now = datetime.utcnow()
+                due = False
+                while self.heap and self.heap[0][0] <= now:
+                    self.queued.discard(heapq.heappop(self.heap)[1])
+                    due = True
+            try:
+                if time.monotonic() >= self.next_poll:
+                    due = self._load(client) or due
+                if due:
+                    self.expire_due(client)
+            except Exception as e:
+                # Any failure only costs this sweep; the thread must outlive it
+                print(f"Lease expiry failed: {e!r}")
+                with self.lock:
+                    self.stats['errors'] += 1
+                time.sleep(1)
+
+    def _load(self, client):
+        # Returns True if some of the loaded leases have already expired
+        until = datetime.utcnow() + timedelta(seconds=LEASE_POLL_INTERVAL)
+        upcoming = leasesDatabase.getUpcomingExpiries(client, until, LEASE_BATCH_SIZE * 10)
+        now = datetime.utcnow()
+        with self.lock:
+            self.next_poll = time.monotonic() + LEASE_POLL_INTERVAL
+            self.stats['loaded'] += len(upcoming)
+            for lease in upcoming:
+                if lease['expiresAt'] > now and lease['_id'] not in self.queued:
+                    heapq.heappush(self.heap, (lease['expiresAt'], lease['_id']))
+                    self.queued.add(lease['_id'])
+        return any(lease['expiresAt'] <= now for lease in upcoming)
+
+    def expire_due(self, client):
+        """Return the units of every expired lease this worker can claim; returns the lease count."""
+        with self.lock:
+            self.stats['runs'] += 1
+        expired = 0
+        while True:
+            claim_id, leases = leasesDatabase.claimDueLeases(client, LEASE_BATCH_SIZE, LEASE_CLAIM_TTL)
+            if not leases:
+                # Nothing left, or the rest is claimed by other workers
+                return expired
+            result = leasesDatabase.expireLeases(client, claim_id, leases)
+            now = datetime.utcnow()
+            if not result['success']:
+                # The batch rolled back; its leases are retried once their claim lapses
+                print(f"Lease expiry batch failed: {result['message']}")
+                with self.lock:
+                    self.stats['errors'] += 1
+                continue
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['failed'] += result['failed']
+                self.stats['expired'] += result['expired']
+                self.stats['units_returned'] += sum(result['returned'].values())
+                if not result['failed']:
+                    for lease in leases:
+                        lag = (now - lease['expiresAt']).total_seconds()
+                        self.lag_total += lag
+                        self.lag_max = max(self.lag_max, lag)
+            expired += result['expired']
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats.update({
+                'enabled': LEASE_EXPIRY_ENABLED,
+                'queued': len(self.heap),
+                'next_expiry': self.heap[0][0].isoformat(timespec='milliseconds') if self.heap else None,
+                # Seconds between a lease's expiry and its units going back
+                'lag_s_avg': round(self.lag_total / stats['expired'], 3) if stats['expired'] else None,
+                'lag_s_max': round(self.lag_max, 3),
+                'batch_size': LEASE_BATCH_SIZE,
+                'poll_interval_s': LEASE_POLL_INTERVAL
+            })
+            return stats
+
+_scheduler = LeaseScheduler()
+
+def start():
+    """Start this worker's expiry thread (once per process) unless LEASE_EXPIRY=false."""
+    if LEASE_EXPIRY_ENABLED:
+        _scheduler.start()
+
+def schedule(session, lease):
+    """Queue a new lease's expiry once session's transaction (if any) commits."""
+    if LEASE_EXPIRY_ENABLED:
+        db_utils.after_commit(session, lambda: _scheduler.push(lease['expiresAt'], lease['_id']))
+
+def expire_due(client):
+    """Return every expired lease's units now, from the calling thread."""
+    return _scheduler.expire_due(client)
+
+def get_stats():
+    return _scheduler.get_stats()
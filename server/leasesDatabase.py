@@ -0,0 +1,244 @@
+# Import necessary libraries and modules
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING
+import db_utils
+
+# Note: Import hardwareDatabase when needed to avoid circular imports
+
+'''
+Structure of a lease entry (one per time-limited checkout, indexed on
+expiresAt as lease_expiry):
+Lease = {
+    'projectId': projectId,
+    'hwSetName': str,
+    'qty': int,                # units still out under this lease
+    'username': str,           # who checked them out
+    'createdAt': datetime,
+    'expiresAt': datetime,
+    'claimedBy': ObjectId,     # set while an expiry run is returning the units
+    'claimedUntil': datetime,  # after this the claim is abandoned and may be taken over
+    'expiring': ObjectId       # the claim whose run is returning the units right now
+}
+
+Leased units are also counted in the project's hwSets like any other
+checkout; the lease only records when they go back on their own.
+'''
+
+# Leases nobody is returning right now, or whose claim was abandoned
+def _claimable(now):
+    return {'$or': [{'claimedUntil': {'$exists': False}}, {'claimedUntil': {'$lt': now}}]}
+
+# Function to record a lease for units just checked out
+def createLease(client, projectId, hwSetName, qty, username, leaseSeconds, session=None):
+    # Returns the inserted lease so the caller can schedule its expiry
+    db = db_utils.get_database(client)
+    now = datetime.utcnow()
+    lease = {
+        'projectId': projectId,
+        'hwSetName': hwSetName,
+        'qty': qty,
+        'username': username,
+        'createdAt': now,
+        'expiresAt': now + timedelta(seconds=leaseSeconds)
+    }
+    db['leases'].insert_one(lease, session=session)
+    return lease
+
+# Function to settle leases when units are checked in by hand
+def settleLeases(client, projectId, hwSetName, qty, session=None):
+    # Checked-in units count against the project's leases on that set, soonest
+    # expiring first, so an expiry never takes back units a project still keeps.
+    # Claimed leases are settled too: an expiry run only returns the units of
+    # leases whose qty is still the one it claimed, marking them 'expiring' in
+    # one atomic step; from then on the lease is the expiry's and is skipped here.
+    db = db_utils.get_database(client)
+    leases_collection = db['leases']
+
+    leases = list(leases_collection.find(
+        {'projectId': projectId, 'hwSetName': hwSetName, 'expiring': {'$exists': False}},
+        {'qty': 1},
+        session=session
+    ).sort('expiresAt', ASCENDING))
+
+    remaining = qty
+    for lease in leases:
+        if not remaining:
+            break
+        take = min(lease['qty'], remaining)
+        lease_filter = {'_id': lease['_id'], 'qty': {'$gte': take}, 'expiring': {'$exists': False}}
+        if take == lease['qty']:
+            lease_filter['qty'] = take
+            settled = leases_collection.delete_one(lease_filter, session=session).deleted_count
+        else:
+            settled = leases_collection.update_one(lease_filter, {'$inc': {'qty': -take}}, session=session).modified_count
+        if settled:
+            remaining -= take
+    return qty - remaining
+
+# Function to list the next lease expiries, for the in-process scheduler
+def getUpcomingExpiries(client, until, limit):
+    # Walks the lease_expiry index; already expired leases come first
+    db = db_utils.get_database(client)
+    return list(db['leases'].find(
+        {'expiresAt': {'$lte': until}}, {'expiresAt': 1}
+    ).sort('expiresAt', ASCENDING).limit(limit))
+
+# Function to claim a batch of expired leases for this worker
+def claimDueLeases(client, limit, claimSeconds):
+    # Returns (claimId, leases). Several workers may race for the same leases;
+    # the claim update only matches unclaimed ones, so each lease is won once.
+    db = db_utils.get_database(client)
+    leases_collection = db['leases']
+    now = datetime.utcnow()
+
+    due = [
+        lease['_id'] for lease in leases_collection.find(
+            {'expiresAt': {'$lte': now}, **_claimable(now)}, {'_id': 1}
+        ).sort('expiresAt', ASCENDING).limit(limit)
+    ]
+    if not due:
+        return None, []
+
+    claimId = ObjectId()
+    claimedUntil = now + timedelta(seconds=claimSeconds)
+    leases_collection.update_many(
+        {'_id': {'$in': due}, **_claimable(now)},
+        {'$set': {'claimedBy': claimId, 'claimedUntil': claimedUntil}}
+    )
+    leases = list(leases_collection.find({'claimedBy': claimId}))
+    return claimId, leases
+
+# Function to return the units of claimed, expired leases
+def expireLeases(client, claimId, leases):
+    # One transaction for the whole batch when the deployment supports it
+    return db_utils.run_transactional(
+        client, lambda session: _expireLeases(client, claimId, leases, session)
+    )
+
+def _expireLeases(client, claimId, leases, session):
+    import hardwareDatabase
+    import projectsDatabase
+
+    db = db_utils.get_database(client)
+    leases_collection = db['leases']
+    projects_collection = db['projects']
+
+    if not leases:
+        return {'success': True, 'message': 'Expired 0 lease(s)', 'expired': 0, 'returned': {}, 'failed': 0}
+    # A claim that has lapsed may already belong to another worker
+    if leases[0]['claimedUntil'] <= datetime.utcnow():
+        return {'success': False, 'message': 'Lease claim expired before the batch ran', 'expired': 0, 'returned': {}}
+
+    # Take over only the leases still unsettled since the claim: a check-in that
+    # settled one meanwhile changed its qty (or deleted it) and returned its units
+    ids = [lease['_id'] for lease in leases]
+    result = leases_collection.update_many(
+        {'$or': [{'_id': lease['_id'], 'qty': lease['qty']} for lease in leases], 'claimedBy': claimId},
+        {'$set': {'expiring': claimId}},
+        session=session
+    )
+    if result.modified_count < len(ids):
+        # Some were settled or taken over meanwhile; leave those alone
+        expiring = {lease['_id'] for lease in leases_collection.find({'expiring': claimId}, {'_id': 1}, session=session)}
+        leases = [lease for lease in leases if lease['_id'] in expiring]
+        # Partly settled leases go back to the queue with their new qty
+        leases_collection.update_many(
+            {'_id': {'$in': ids}, 'claimedBy': claimId, 'expiring': {'$exists': False}},
+            {'$unset': {'claimedBy': '', 'claimedUntil': ''}},
+            session=session
+        )
+    # Remove the leases before returning their units: if this run dies part-way
+    # outside a transaction, units stay checked out instead of going back twice
+    leases_collection.delete_many({'expiring': claimId}, session=session)
+
+    # Take the units back from each project once per hardware set
+    groups = {}
+    for lease in leases:
+        groups.setdefault((lease['projectId'], lease['hwSetName']), []).append(lease)
+    taken = {}    # hwSetName -> [(projectId, units, leases)]
+    history = {}  # hwSetName -> usage_history entries
+    for (projectId, hwSetName), group in groups.items():
+        units = _takeBack(projects_collection, projectId, hwSetName, sum(lease['qty'] for lease in group), session)
+        if not units:
+            continue
+        taken.setdefault(hwSetName, []).append((projectId, units, group))
+        # One history entry per lease, for the units that actually went back
+        entries = history.setdefault(hwSetName, [])
+        for lease in group:
+            qty = min(lease['qty'], units)
+            units -= qty
+            if qty:
+                entries.append(projectsDatabase._historyEntry(projectId, 'expire', hwSetName, qty, lease['username']))
+
+    # Then return them to each hardware set in one write per set
+    returned = {}
+    failed = []
+    for hwSetName, projects in taken.items():
+        units = sum(project_units for _, project_units, _ in projects)
+        hw_result = hardwareDatabase.releaseSpace(client, hwSetName, units, session=session)
+        if hw_result['success']:
+            returned[hwSetName] = units
+            continue
+        message = f"Could not return {units} expired units of {hwSetName}: {hw_result['message']}"
+        if session is not None:
+            # Abort the whole batch; its leases stay claimed and are retried once the claim lapses
+            return {'success': False, 'message': message, 'expired': 0, 'returned': {}}
+        # Outside a transaction, undo this set's part by hand: the projects get
+        # their units back and the leases return, still claimed, for a later sweep
+        print(f"Warning: {message}; retrying once the claim lapses")
+        for projectId, project_units, group in projects:
+            projects_collection.update_one({'projectId': projectId}, {'$inc': {f'hwSets.{hwSetName}': project_units}})
+            failed.extend(group)
+        del history[hwSetName]
+    if failed:
+        leases_collection.insert_many(failed)
+
+    entries = [entry for set_entries in history.values() for entry in set_entries]
+    if entries:
+        db['usage_history'].insert_many(entries, session=session)
+    expired = len(leases) - len(failed)
+    return {'success': True, 'message': f'Expired {expired} lease(s)', 'expired': expired, 'returned': returned,
+            'failed': len(failed)}
+
+# Helper: decrement a project's usage by up to qty units; returns the units taken
+def _takeBack(projects_collection, projectId, hwSetName, qty, session):
+    for _ in range(3):
+        result = projects_collection.update_one(
+            {'projectId': projectId, f'hwSets.{hwSetName}': {'$gte': qty}},
+            {'$inc': {f'hwSets.{hwSetName}': -qty}},
+            session=session
+        )
+        if result.matched_count:
+            return qty
+        # The project holds fewer units than leased (or is gone): take what is left
+        project = projects_collection.find_one({'projectId': projectId}, {f'hwSets.{hwSetName}': 1}, session=session)
+        held = project.get('hwSets', {}).get(hwSetName, 0) if project else 0
+        if held <= 0:
+            return 0
+        qty = min(qty, held)
+    return 0
+
+# Function to drop every lease of a project (used when the project is deleted)
+def deleteProjectLeases(client, projectId):
+    db = db_utils.get_database(client)
+    result = db['leases'].delete_many({'projectId': projectId})
+    return result.deleted_count
+
+# Function to list a project's active leases
+def getProjectLeases(client, projectId):
+    db = db_utils.get_database(client)
+    leases = db['leases'].find(
+        {'projectId': projectId}, {'_id': 1, 'hwSetName': 1, 'qty': 1, 'username': 1, 'expiresAt': 1}
+    ).sort('expiresAt', ASCENDING)
+    return {'success': True, 'leases': [formatLease(lease) for lease in leases]}
+
+# Helper: JSON-ready view of a lease
+def formatLease(lease):
+    return {
+        'leaseId': str(lease['_id']),
+        'hwSetName': lease['hwSetName'],
+        'qty': lease['qty'],
+        'username': lease['username'],
+        'expiresAt': lease['expiresAt'].isoformat(timespec='milliseconds')
+    }
@@ -0,0 +1,775 @@
+# In-process storage backend with the pymongo surface used by the database modules
+#
+# Selected with STORAGE_BACKEND=memory (see db_utils.get_mongo_client). It lets
+# the whole Flask app run without a mongod for benchmarks, load tests and CI.
+# Every collection operation runs under one store-wide lock, which gives the
+# same per-operation atomicity MongoDB gives per document: a conditional $inc
+# such as {'availability': {'$gte': qty}} can never oversell under threads.
+# Only the query, update and aggregation operators the app uses are supported;
+# anything else raises NotImplementedError rather than silently misbehaving.
+# MEMORY_DB_LATENCY_MS adds a sleep before every collection operation to
+# emulate the network round trip to a real mongod in benchmarks.
+# MEMORY_DB_WRITE_MS makes update_one/find_one_and_update hold the document
+# they change for that long, so writes to one hot document queue behind each
+# other while writes to different documents overlap, as they do in MongoDB.
+import copy
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+_MISSING = object()
+# Value of '$$REMOVE' in update pipelines: the field is removed
+_REMOVE = object()
+
+
+# ---------------------------------------------------------------------------
+# Field access
+# ---------------------------------------------------------------------------
+
+def _get(doc, path):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def _unset(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(parts[-1], None)
+
+
+# ---------------------------------------------------------------------------
+# Query matching
+# ---------------------------------------------------------------------------
+
+def _compare(op, value, target):
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if op == '$gt':
+            return value > target
+        if op == '$gte':
+            return value >= target
+        if op == '$lt':
+            return value < target
+        if op == '$lte':
+            return value <= target
+    except TypeError:
+        return False
+    raise NotImplementedError(op)
+
+def _equals(value, target):
+    # Arrays match when any element equals the target, as in MongoDB
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    if value is _MISSING:
+        return target is None
+    return value == target
+
+def _match_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+        for op, target in condition.items():
+            if op in ('$gt', '$gte', '$lt', '$lte'):
+                candidates = value if isinstance(value, list) else [value]
+                if not any(_compare(op, candidate, target) for candidate in candidates):
+                    return False
+            elif op == '$in':
+                if not any(_equals(value, item) for item in target):
+                    return False
+            elif op == '$exists':
+                if (value is not _MISSING) != bool(target):
+                    return False
+            elif op == '$size':
+                if not isinstance(value, list) or len(value) != target:
+                    return False
+            elif op == '$ne':
+                if _equals(value, target):
+                    return False
+            else:
+                raise NotImplementedError(f'Query operator {op} is not supported by the memory backend')
+        return True
+    return _equals(value, condition)
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$expr':
+            if not _evaluate(condition, doc):
+                return False
+        elif key.startswith('$'):
+            raise NotImplementedError(f'Query operator {key} is not supported by the memory backend')
+        elif not _match_condition(_get(doc, key), condition):
+            return False
+    return True
+
+
+# ---------------------------------------------------------------------------
+# Aggregation expressions
+# ---------------------------------------------------------------------------
+
+_DATE_FORMAT = re.compile(r'%[YmdHMSL%]')
+
+def _format_date(value, fmt):
+    parts = {
+        '%Y': f'{value.year:04d}', '%m': f'{value.month:02d}', '%d': f'{value.day:02d}',
+        '%H': f'{value.hour:02d}', '%M': f'{value.minute:02d}', '%S': f'{value.second:02d}',
+        '%L': f'{value.microsecond // 1000:03d}', '%%': '%'
+    }
+    return _DATE_FORMAT.sub(lambda m: parts[m.group(0)], fmt)
+
+def _evaluate(expression, doc):
+    if expression == '$$REMOVE':
+        return _REMOVE
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = _get(doc, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, list):
+        return [_evaluate(item, doc) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        op, args = next(iter(expression.items()))
+        if op.startswith('$'):
+            if op == '$add':
+                return sum(_evaluate(arg, doc) for arg in args)
+            if op in ('$gt', '$gte', '$lt', '$lte'):
+                left, right = (_evaluate(arg, doc) for arg in args)
+                return _compare(op, left, right)
+            if op == '$eq':
+                left, right = (_evaluate(arg, doc) for arg in args)
+                return left == right
+            if op == '$concat':
+                return ''.join(_evaluate(arg, doc) for arg in args)
+            if op == '$cond':
+                if isinstance(args, dict):
+                    args = [args['if'], args['then'], args['else']]
+                condition, then, otherwise = args
+                return _evaluate(then if _evaluate(condition, doc) else otherwise, doc)
+            if op == '$ifNull':
+                value, fallback = (_evaluate(arg, doc) for arg in args)
+                return fallback if value is None else value
+            if op == '$setDifference':
+                array, remove = (_evaluate(arg, doc) for arg in args)
+                return [item for i, item in enumerate(array) if item not in remove and item not in array[:i]]
+            if op == '$slice':
+                array, n = (_evaluate(arg, doc) for arg in args)
+                return array[n:] if n < 0 else array[:n]
+            if op == '$reverseArray':
+                return list(reversed(_evaluate(args, doc)))
+            if op == '$arrayElemAt':
+                array, index = (_evaluate(arg, doc) for arg in args)
+                return array[index] if -len(array) <= index < len(array) else None
+            if op == '$toString':
+                return str(_evaluate(args, doc))
+            if op == '$dateToString':
+                return _format_date(_evaluate(args['date'], doc), args.get('format', '%Y-%m-%dT%H:%M:%S.%LZ'))
+            raise NotImplementedError(f'Expression {op} is not supported by the memory backend')
+    return {key: _evaluate(value, doc) for key, value in expression.items()}
+
+
+# ---------------------------------------------------------------------------
+# Updates and projections
+# ---------------------------------------------------------------------------
+
+def _apply_update(doc, update, inserting=False):
+    if isinstance(update, list):
+        # Update pipeline: each stage's expressions see the document as the stage gets it
+        for stage in update:
+            (op, fields), = stage.items()
+            if op in ('$set', '$addFields'):
+                values = {path: _evaluate(expression, doc) for path, expression in fields.items()}
+                for path, value in values.items():
+                    if value is _REMOVE:
+                        _unset(doc, path)
+                    else:
+                        _set(doc, path, copy.deepcopy(value))
+            elif op == '$unset':
+                for path in [fields] if isinstance(fields, str) else fields:
+                    _unset(doc, path)
+            else:
+                raise NotImplementedError(f'Pipeline stage {op} is not supported by the memory backend')
+        return
+    for op, fields in update.items():
+        if op == '$setOnInsert':
+            if inserting:
+                for path, value in fields.items():
+                    _set(doc, path, copy.deepcopy(value))
+        elif op == '$set':
+            for path, value in fields.items():
+                _set(doc, path, copy.deepcopy(value))
+        elif op == '$unset':
+            for path in fields:
+                _unset(doc, path)
+        elif op == '$inc':
+            for path, amount in fields.items():
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + amount)
+        elif op in ('$max', '$min'):
+            for path, value in fields.items():
+                current = _get(doc, path)
+                if current is _MISSING or (value > current if op == '$max' else value < current):
+                    _set(doc, path, copy.deepcopy(value))
+        elif op == '$push':
+            for path, value in fields.items():
+                current = _get(doc, path)
+                array = [] if current is _MISSING else list(current)
+                if isinstance(value, dict) and '$each' in value:
+                    array.extend(copy.deepcopy(value['$each']))
+                    if '$slice' in value:
+                        limit = value['$slice']
+                        array = array[limit:] if limit < 0 else array[:limit]
+                else:
+                    array.append(copy.deepcopy(value))
+                _set(doc, path, array)
+        elif op == '$pull':
+            for path, value in fields.items():
+                current = _get(doc, path)
+                if isinstance(current, list):
+                    _set(doc, path, [item for item in current if item != value])
+        elif op == '$pullAll':
+            for path, values in fields.items():
+                current = _get(doc, path)
+                if isinstance(current, list):
+                    _set(doc, path, [item for item in current if item not in values])
+        elif op == '$addToSet':
+            for path, value in fields.items():
+                current = _get(doc, path)
+                array = [] if current is _MISSING else list(current)
+                if value not in array:
+                    array.append(copy.deepcopy(value))
+                _set(doc, path, array)
+        else:
+            raise NotImplementedError(f'Update operator {op} is not supported by the memory backend')
+
+def _project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get('_id', 1)
+    fields = {key: value for key, value in projection.items() if key != '_id'}
+    if fields and all(fields.values()):
+        result = {}
+        if include_id and '_id' in doc:
+            result['_id'] = doc['_id']
+        for path in fields:
+            value = _get(doc, path)
+            if value is not _MISSING:
+                _set(result, path, value)
+        return result
+    for path, keep in fields.items():
+        if not keep:
+            _unset(doc, path)
+    if not include_id:
+        doc.pop('_id', None)
+    return doc
+
+def _sort_key(spec):
+    def key(doc):
+        values = []
+        for path, direction in spec:
+            value = _get(doc, path)
+            values.append(_Reversible(None if value is _MISSING else value, direction < 0))
+        return values
+    return key
+
+class _Reversible:
+    """Sort wrapper that orders None first and can invert per key."""
+    __slots__ = ('value', 'reverse')
+
+    def __init__(self, value, reverse):
+        self.value = value
+        self.reverse = reverse
+
+    def __lt__(self, other):
+        a, b = (other.value, self.value) if self.reverse else (self.value, other.value)
+        if a is None:
+            return b is not None
+        if b is None:
+            return False
+        return a < b
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def _normalize_sort(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return list(key_or_list)
+
+
+# ---------------------------------------------------------------------------
+# Results, cursors and sessions
+# ---------------------------------------------------------------------------
+
+class _Result(SimpleNamespace):
+    acknowledged = True
+
+class MemoryCursor:
+    """Lazy find() cursor supporting sort, limit and iteration."""
+
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _normalize_sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        # Results are already produced one at a time
+        return self
+
+    def __iter__(self):
+        with self._collection._store.operation():
+            docs = self._collection._select(self._query)
+            if self._sort:
+                docs.sort(key=_sort_key(self._sort))
+            if self._limit:
+                docs = docs[:self._limit]
+        # Stored documents are replaced, never mutated, by updates, so they can
+        # be copied lazily outside the lock; a large result is never held twice
+        return (_project(doc, self._projection) for doc in docs)
+
+class MemorySession:
+    """No-op session; the memory backend reports no transaction support."""
+
+    in_transaction = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def start_transaction(self, *args, **kwargs):
+        raise OperationFailure('Transactions are not supported by the memory backend')
+
+    def end_session(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+# Collections, databases and the client
+# ---------------------------------------------------------------------------
+
+class MemoryCollection:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+        self._docs = {}       # _id -> document
+        self._indexes = {}    # name -> {'key': [(field, direction)], 'unique': bool}
+        self._lookup = {}     # unique single-field index name -> {value: _id}
+
+    # -- internal helpers (callers hold the store lock) --
+
+    def _candidates(self, query):
+        # Use a unique single-field index for plain equality lookups
+        for name, index in self._indexes.items():
+            field = index['key'][0][0]
+            if name in self._lookup and field in query and not isinstance(query[field], (dict, list)):
+                doc_id = self._lookup[name].get(query[field])
+                return [self._docs[doc_id]] if doc_id is not None else []
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self._docs.get(query['_id'])
+            return [doc] if doc is not None else []
+        return list(self._docs.values())
+
+    def _select(self, query, first=False):
+        matched = []
+        for doc in self._candidates(query or {}):
+            if _matches(doc, query or {}):
+                matched.append(doc)
+                if first:
+                    break
+        return matched
+
+    def _unique_key(self, index, doc):
+        values = tuple(_get(doc, field) for field, _ in index['key'])
+        if all(value is _MISSING for value in values):
+            return None
+        return tuple(None if value is _MISSING else value for value in values)
+
+    def _check_unique(self, doc, ignore_id=None):
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            key = self._unique_key(index, doc)
+            if key is None:
+                continue
+            if name in self._lookup:
+                # Single-field unique index: constant-time check
+                other_id = self._lookup[name].get(key[0])
+                duplicate = other_id is not None and other_id != ignore_id
+            else:
+                duplicate = any(other['_id'] != ignore_id and self._unique_key(index, other) == key
+                                for other in self._docs.values())
+            if duplicate:
+                raise DuplicateKeyError(
+                    f'E11000 duplicate key error collection: {self.name} index: {name}',
+                    11000,
+                    {'keyPattern': dict(index['key']), 'keyValue': dict(zip([f for f, _ in index['key']], key))}
+                )
+
+    def _reindex(self, old, new):
+        for name, mapping in self._lookup.items():
+            field = self._indexes[name]['key'][0][0]
+            if old is not None:
+                value = _get(old, field)
+                if value is not _MISSING and mapping.get(value) == old['_id']:
+                    del mapping[value]
+            if new is not None:
+                value = _get(new, field)
+                if value is not _MISSING:
+                    mapping[value] = new['_id']
+
+    def _insert(self, document):
+        doc = copy.deepcopy(document)
+        doc.setdefault('_id', ObjectId())
+        if doc['_id'] in self._docs:
+            raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: _id_', 11000,
+                                    {'keyPattern': {'_id': 1}})
+        self._check_unique(doc)
+        self._docs[doc['_id']] = doc
+        self._reindex(None, doc)
+        document['_id'] = doc['_id']
+        return doc
+
+    def _update_doc(self, doc, update):
+        updated = copy.deepcopy(doc)
+        _apply_update(updated, update)
+        if updated == doc:
+            return doc, False
+        self._check_unique(updated, ignore_id=doc['_id'])
+        self._docs[doc['_id']] = updated
+        self._reindex(doc, updated)
+        return updated, True
+
+    def _upsert(self, query, update):
+        doc = {key: value for key, value in query.items()
+               if not key.startswith('$') and not isinstance(value, dict)}
+        doc = copy.deepcopy(doc)
+        _apply_update(doc, update, inserting=True)
+        return self._insert(doc)
+
+    def _update(self, query, update, many=False, upsert=False):
+        matched = modified = 0
+        upserted_id = None
+        for doc in self._select(query, first=not many):
+            matched += 1
+            _, changed = self._update_doc(doc, update)
+            modified += changed
+        if not matched and upsert:
+            upserted_id = self._upsert(query, update)['_id']
+        return _Result(matched_count=matched, modified_count=modified, upserted_id=upserted_id)
+
+    # -- pymongo Collection API --
+
+    def find_one(self, filter=None, projection=None, session=None, **kwargs):
+        with self._store.operation():
+            docs = self._select(filter or {}, first=True)
+            return _project(docs[0], projection) if docs else None
+
+    def find(self, filter=None, projection=None, session=None, **kwargs):
+        return MemoryCursor(self, filter or {}, projection)
+
+    def insert_one(self, document, session=None, **kwargs):
+        with self._store.operation():
+            doc = self._insert(document)
+        return _Result(inserted_id=doc['_id'])
+
+    def insert_many(self, documents, ordered=True, session=None, **kwargs):
+        with self._store.operation():
+            ids = [self._insert(document)['_id'] for document in documents]
+        return _Result(inserted_ids=ids)
+
+    def update_one(self, filter, update, upsert=False, session=None, **kwargs):
+        with self._store.document_write(self, filter), self._store.operation():
+            return self._update(filter, update, upsert=upsert)
+
+    def update_many(self, filter, update, upsert=False, session=None, **kwargs):
+        with self._store.operation():
+            return self._update(filter, update, many=True, upsert=upsert)
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=ReturnDocument.BEFORE,
+                            upsert=False, session=None, **kwargs):
+        with self._store.document_write(self, filter), self._store.operation():
+            docs = self._select(filter, first=True)
+            if not docs:
+                if upsert:
+                    doc = self._upsert(filter, update)
+                    return _project(doc, projection) if return_document == ReturnDocument.AFTER else None
+                return None
+            updated, _ = self._update_doc(docs[0], update)
+            return _project(updated if return_document == ReturnDocument.AFTER else docs[0], projection)
+
+    def find_one_and_delete(self, filter, projection=None, session=None, **kwargs):
+        with self._store.operation():
+            docs = self._select(filter, first=True)
+            if not docs:
+                return None
+            self._reindex(docs[0], None)
+            del self._docs[docs[0]['_id']]
+            return _project(docs[0], projection)
+
+    def delete_one(self, filter, session=None, **kwargs):
+        with self._store.operation():
+            docs = self._select(filter, first=True)
+            for doc in docs:
+                self._reindex(doc, None)
+                del self._docs[doc['_id']]
+        return _Result(deleted_count=len(docs))
+
+    def delete_many(self, filter, session=None, **kwargs):
+        with self._store.operation():
+            docs = self._select(filter)
+            for doc in docs:
+                self._reindex(doc, None)
+                del self._docs[doc['_id']]
+        return _Result(deleted_count=len(docs))
+
+    def bulk_write(self, requests, ordered=True, session=None, **kwargs):
+        # Supports UpdateOne/UpdateMany/InsertOne; the whole batch runs under the lock
+        matched = modified = inserted = upserted = 0
+        with self._store.operation():
+            for op in requests:
+                kind = type(op).__name__
+                if kind == 'InsertOne':
+                    self._insert(op._doc)
+                    inserted += 1
+                elif kind in ('UpdateOne', 'UpdateMany'):
+                    result = self._update(op._filter, op._doc, many=kind == 'UpdateMany', upsert=bool(op._upsert))
+                    matched += result.matched_count
+                    modified += result.modified_count
+                    upserted += result.upserted_id is not None
+                else:
+                    raise NotImplementedError(f'{kind} is not supported by the memory backend')
+        return _Result(matched_count=matched, modified_count=modified, inserted_count=inserted,
+                       upserted_count=upserted, deleted_count=0)
+
+    def aggregate(self, pipeline, session=None, **kwargs):
+        with self._store.operation():
+            docs = [copy.deepcopy(doc) for doc in self._docs.values()]
+        for stage in pipeline:
+            (op, spec), = stage.items()
+            if op == '$match':
+                docs = [doc for doc in docs if _matches(doc, spec)]
+            elif op == '$sort':
+                docs.sort(key=_sort_key(_normalize_sort(spec)))
+            elif op == '$limit':
+                docs = docs[:spec]
+            elif op == '$skip':
+                docs = docs[spec:]
+            elif op == '$project':
+                docs = [_project(doc, {k: v for k, v in spec.items() if v in (0, 1, True, False)}) |
+                        {k: _evaluate(v, doc) for k, v in spec.items() if v not in (0, 1, True, False)}
+                        for doc in docs]
+            elif op == '$group':
+                docs = _group(docs, spec)
+            else:
+                raise NotImplementedError(f'Pipeline stage {op} is not supported by the memory backend')
+        return iter(docs)
+
+    def count_documents(self, filter, session=None, **kwargs):
+        with self._store.operation():
+            return len(self._select(filter))
+
+    def create_indexes(self, models, session=None, **kwargs):
+        names = []
+        with self._store.operation():
+            for model in models:
+                document = model.document
+                name = document['name']
+                index = {'key': list(document['key'].items()), 'unique': bool(document.get('unique'))}
+                # Validate existing documents before registering the index
+                seen = set()
+                for doc in self._docs.values():
+                    key = self._unique_key(index, doc) if index['unique'] else None
+                    if key is None:
+                        continue
+                    if key in seen:
+                        raise DuplicateKeyError(
+                            f'E11000 duplicate key error collection: {self.name} index: {name}', 11000,
+                            {'keyPattern': dict(index['key'])}
+                        )
+                    seen.add(key)
+                self._indexes[name] = index
+                if index['unique'] and len(index['key']) == 1:
+                    field = index['key'][0][0]
+                    self._lookup[name] = {
+                        _get(doc, field): doc['_id'] for doc in self._docs.values() if _get(doc, field) is not _MISSING
+                    }
+                names.append(name)
+        return names
+
+    def create_index(self, keys, **kwargs):
+        from pymongo import IndexModel
+        return self.create_indexes([IndexModel(keys, **kwargs)])[0]
+
+    def index_information(self, session=None):
+        with self._store.operation():
+            info = {'_id_': {'key': [('_id', 1)]}}
+            for name, index in self._indexes.items():
+                info[name] = {'key': list(index['key'])}
+                if index['unique']:
+                    info[name]['unique'] = True
+            return info
+
+    def drop_index(self, name, session=None, **kwargs):
+        with self._store.operation():
+            if name not in self._indexes:
+                raise OperationFailure(f'index not found with name [{name}]')
+            del self._indexes[name]
+            self._lookup.pop(name, None)
+
+def _group(docs, spec):
+    groups = {}
+    order = []
+    for doc in docs:
+        key = _evaluate(spec['_id'], doc)
+        hashable = repr(key)
+        if hashable not in groups:
+            groups[hashable] = {'_id': key}
+            order.append(hashable)
+        group = groups[hashable]
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (op, expression), = accumulator.items()
+            value = _evaluate(expression, doc)
+            if op == '$push':
+                group.setdefault(field, []).append(value)
+            elif op == '$first':
+                group.setdefault(field, value)
+            elif op == '$last':
+                group[field] = value
+            elif op == '$sum':
+                group[field] = group.get(field, 0) + value
+            else:
+                raise NotImplementedError(f'Accumulator {op} is not supported by the memory backend')
+    return [groups[key] for key in order]
+
+class MemoryDatabase:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self._store.lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self._store, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        # db.users style access, as with pymongo
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return list(self._collections)
+
+    def command(self, command, *args, **kwargs):
+        name = command if isinstance(command, str) else next(iter(command))
+        if name in ('ping', 'hello', 'isMaster', 'ismaster'):
+            # No setName: callers treat this like a standalone mongod
+            return {'ok': 1.0, 'isWritablePrimary': True}
+        raise NotImplementedError(f'Command {name} is not supported by the memory backend')
+
+class MemoryClient:
+    """Drop-in for the subset of pymongo.MongoClient used by the app."""
+
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.RLock()
+        self.latency = float(os.environ.get('MEMORY_DB_LATENCY_MS', '0')) / 1000
+        self.write_hold = float(os.environ.get('MEMORY_DB_WRITE_MS', '0')) / 1000
+        self._document_locks = {}
+        self._databases = {}
+        self.options = SimpleNamespace(pool_options=SimpleNamespace(
+            max_pool_size=kwargs.get('maxPoolSize', 0), min_pool_size=0
+        ))
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    @contextmanager
+    def operation(self):
+        # One collection operation: the emulated round trip happens outside
+        # the lock so concurrent callers overlap like they would on a network
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            yield
+
+    @contextmanager
+    def document_write(self, collection, query):
+        # Hold the document query selects for write_hold before the write runs
+        if not self.write_hold:
+            yield
+            return
+        with self.lock:
+            docs = collection._select(query, first=True)
+            if not docs:
+                document_lock = None
+            else:
+                key = (collection.name, docs[0]['_id'])
+                document_lock = self._document_locks.setdefault(key, threading.Lock())
+        if document_lock is None:
+            yield
+            return
+        with document_lock:
+            time.sleep(self.write_hold)
+            yield
+
+    @property
+    def admin(self):
+        return self['admin']
+
+    def start_session(self, **kwargs):
+        return MemorySession()
+
+    def server_info(self):
+        return {'version': 'memory', 'ok': 1.0}
+
+    def close(self):
+        pass
@@ -0,0 +1,44 @@
+# Request metrics exposed in Prometheus text format on /metrics
+#
+# When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) every worker
+# writes its samples to memory-mapped files in that directory and /metrics
+# aggregates all workers, whichever one serves the scrape.
+import os
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+# Latency buckets in seconds, tuned for API calls that mostly wait on MongoDB
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter('momentum_http_requests_total', 'API requests handled, by route', ['route'])
+ERRORS = Counter('momentum_http_request_errors_total', 'API requests that raised or were shed, by route', ['route'])
+LATENCY = Histogram('momentum_http_request_duration_seconds', 'API request latency, by route', ['route'],
+                    buckets=LATENCY_BUCKETS)
+
+# Labelled children cached per route; labels() alone costs more than the update
+_children = {}
+
+def record_request(route, seconds, error=False):
+    """Record one request for route. Cheap enough to call on every request."""
+    children = _children.get(route)
+    if children is None:
+        children = _children[route] = (REQUESTS.labels(route), ERRORS.labels(route), LATENCY.labels(route))
+    children[0].inc()
+    if error:
+        children[1].inc()
+    children[2].observe(seconds)
+
+def render_metrics():
+    """Return (body, content_type) for a scrape, merging all workers when multiprocess."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_worker_dead(pid):
+    """Clean up a dead worker's live gauges (call from gunicorn's child_exit)."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -1,7 +1,8 @@
 # Import necessary libraries and modules
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
 import db_utils
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Note: Import hardwareDatabase when needed to avoid circular imports
 
@@ -14,16 +15,22 @@ Project = {
     'hwSets': {HW1: 0, HW2: 10, ...},
     'users': [user1, user2, ...],
     'owner': username  # Username of the project owner/creator
-    'usageHistory': [  # List of history entries
-        {
-            'timestamp': datetime,
-            'action': 'checkout' or 'checkin',
-            'hwSetName': str,
-            'qty': int,
-            'username': str
-        }
-    ]
 }
+
+Structure of a usage_history entry (separate append-only collection,
+indexed on (projectId, timestamp)):
+HistoryEntry = {
+    'projectId': projectId,
+    'timestamp': datetime,
+    'action': 'checkout', 'checkin' or 'expire' (a lease ran out, see leasesDatabase.py),
+    'hwSetName': str,
+    'qty': int,
+    'username': str
+}
+
+Older projects may still carry an embedded 'usageHistory' array until
+migrateEmbeddedUsageHistory, or the project's first history read, has moved
+it into usage_history.
 '''
 
 # Function to query a project by its ID
@@ -34,23 +41,83 @@ def queryProject(client, projectId):
     
     project = projects_collection.find_one({'projectId': projectId})
     if project:
-        # Convert ObjectId to string for JSON serialization
-        project['_id'] = str(project['_id'])
         return {'success': True, 'data': project}
     else:
         return {'success': False, 'message': 'Project not found'}
 
+# Fields /api/inventory may project; projectId is always returned as the page cursor
+INVENTORY_FIELDS = ('_id', 'projectId', 'projectName', 'description', 'hwSets', 'users', 'owner')
+
+def _inventoryQuery(after, fields):
+    # Filter and projection shared by inventory pages and streams
+    unknown = [field for field in fields or [] if field not in INVENTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    query = {'projectId': {'$gt': after}} if after is not None else {}
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection['projectId'] = 1
+        projection.setdefault('_id', 0)
+    else:
+        # Legacy projects may still embed a large usageHistory array
+        projection = {'usageHistory': 0}
+    return query, projection
+
+# Function to get the whole project inventory in one response (legacy /api/inventory)
+def getInventory(client, fields=None):
+    result = getInventoryCursor(client, None, fields)
+    if not result['success']:
+        return result
+    return {'success': True, 'data': list(result['projects'])}
+
+# Function to get one page of the project inventory, ordered by projectId
+def getInventoryPage(client, after=None, limit=100, fields=None):
+    # Keyset pagination on the unique projectId index: every page is an index
+    # range scan starting after the previous page's last projectId
+    db = db_utils.get_database(client)
+    projects_collection = db['projects']
+    
+    try:
+        limit = max(1, min(int(limit), 1000))
+    except (ValueError, TypeError):
+        return {'success': False, 'message': 'limit must be a valid number'}
+    try:
+        query, projection = _inventoryQuery(after, fields)
+    except ValueError as e:
+        return {'success': False, 'message': str(e)}
+    
+    # One extra document tells whether another page exists
+    projects = list(projects_collection.find(query, projection).sort('projectId', 1).limit(limit + 1))
+    has_more = len(projects) > limit
+    projects = projects[:limit]
+    return {
+        'success': True,
+        'data': projects,
+        'cursor': {'after': projects[-1]['projectId'] if projects else None},
+        'hasMore': has_more
+    }
+
+# Function to open a cursor over the project inventory, ordered by projectId
+def getInventoryCursor(client, after=None, fields=None, batch_size=100):
+    # The caller iterates 'projects' and receives documents batch by batch as
+    # the server returns them, so memory stays flat however many projects exist
+    db = db_utils.get_database(client)
+    projects_collection = db['projects']
+    
+    try:
+        query, projection = _inventoryQuery(after, fields)
+    except ValueError as e:
+        return {'success': False, 'message': str(e)}
+    
+    projects = projects_collection.find(query, projection).sort('projectId', 1).batch_size(batch_size)
+    return {'success': True, 'projects': projects}
+
 # Function to create a new project
 def createProject(client, projectName, projectId, description, owner=None):
     # Create a new project in the database
     db = db_utils.get_database(client)
     projects_collection = db['projects']
     
-    # Check if project already exists
-    existing = projects_collection.find_one({'projectId': projectId})
-    if existing:
-        return {'success': False, 'message': 'Project already exists'}
-    
     # Create new project
     project = {
         'projectName': projectName,
@@ -61,11 +128,14 @@ def createProject(client, projectName, projectId, description, owner=None):
         'owner': owner  # Username of the project owner/creator
     }
     
-    result = projects_collection.insert_one(project)
-    # Retrieve the created project
-    created = projects_collection.find_one({'_id': result.inserted_id})
-    created['_id'] = str(created['_id'])
-    return {'success': True, 'project': created, 'message': 'Project created successfully'}
+    # Uniqueness of projectId is enforced by a unique index (see db_utils.INDEXES)
+    db_utils.require_unique_indexes(client, 'projects')
+    try:
+        projects_collection.insert_one(project)
+    except DuplicateKeyError:
+        return {'success': False, 'message': 'Project already exists'}
+    # insert_one fills in _id on the document, so no need to read it back
+    return {'success': True, 'project': project, 'message': 'Project created successfully'}
 
 # Function to add a user to a project
 def addUser(client, projectId, username):
@@ -136,92 +206,333 @@ def updateUsage(client, projectId, hwSetName):
     return {'success': True, 'message': 'Hardware set already exists in project'}
 
 # Function to check out hardware for a project
-def checkOutHW(client, projectId, hwSetName, qty, username):
+def checkOutHW(client, projectId, hwSetName, qty, username, leaseSeconds=None):
     # Check out hardware for the specified project and update availability
+    # With leaseSeconds the units go back on their own once the lease runs out (see lease_expiry.py)
+    # Uses a transaction when the deployment supports one, otherwise atomic writes with compensation
+    return db_utils.run_transactional(
+        client, lambda session: _checkOutHW(client, projectId, hwSetName, qty, username, session, leaseSeconds)
+    )
+
+def _checkOutHW(client, projectId, hwSetName, qty, username, session, leaseSeconds=None):
+    # Hot path: one hardware write, one project write and one history insert.
+    # Membership is enforced by the project write's filter. In a transaction the
+    # project is only read on failure, to report which precondition did not
+    # hold; a rejected write rolls back with the reservation.
     import hardwareDatabase
     
     db = db_utils.get_database(client)
     projects_collection = db['projects']
     
-    # Check if project exists
-    project = projects_collection.find_one({'projectId': projectId})
-    if not project:
-        return {'success': False, 'message': 'Project not found'}
-    
-    # Check if user is part of the project
-    if username not in project['users']:
-        return {'success': False, 'message': 'User not authorized for this project'}
+    if session is None:
+        # Outside a transaction reserved units are visible to other checkouts until
+        # released again, so refuse non-members before taking any
+        access_error = _projectAccessError(projects_collection, projectId, username)
+        if access_error:
+            return access_error
     
     # Try to request hardware from the hardware database
-    hw_result = hardwareDatabase.requestSpace(client, hwSetName, qty)
+    hw_result = hardwareDatabase.requestSpace(client, hwSetName, qty, session=session)
     if not hw_result['success']:
-        return hw_result
-    
-    # Update project's hardware usage
-    current_usage = project['hwSets'].get(hwSetName, 0)
-    new_usage = current_usage + qty
+        # Project problems take precedence over hardware ones
+        if session is None:
+            return hw_result
+        return _projectAccessError(projects_collection, projectId, username, session) or hw_result
     
+    # Update project's hardware usage in place (requiring membership)
     result = projects_collection.update_one(
-        {'projectId': projectId},
-        {'$set': {f'hwSets.{hwSetName}': new_usage}}
+        {'projectId': projectId, 'users': username},
+        {'$inc': {f'hwSets.{hwSetName}': qty}},
+        session=session
     )
     
-    if result.modified_count > 0:
-        # Log history entry
-        addHistoryEntry(client, projectId, 'checkout', hwSetName, qty, username)
-        return {'success': True, 'message': f'Successfully checked out {qty} units of {hwSetName}'}
-    else:
-        # If project update failed, we should return the hardware
-        hardwareDatabase.updateAvailability(client, hwSetName, hw_result['new_availability'] + qty)
-        return {'success': False, 'message': 'Failed to update project hardware usage'}
+    if result.matched_count == 0:
+        # Outside a transaction, return the reserved units ourselves
+        if session is None:
+            hardwareDatabase.releaseSpace(client, hwSetName, qty)
+        return _projectAccessError(projects_collection, projectId, username, session) or \
+            {'success': False, 'message': 'Failed to update project hardware usage'}
+    
+    response = {'success': True, 'message': f'Successfully checked out {qty} units of {hwSetName}', 'availability': hw_result['new_availability']}
+    
+    if leaseSeconds:
+        import leasesDatabase
+        import lease_expiry
+        try:
+            lease = leasesDatabase.createLease(client, projectId, hwSetName, qty, username, leaseSeconds, session=session)
+        except PyMongoError as e:
+            # Units must not stay out without the lease that returns them
+            if session is None:
+                projects_collection.update_one({'projectId': projectId}, {'$inc': {f'hwSets.{hwSetName}': -qty}})
+                hardwareDatabase.releaseSpace(client, hwSetName, qty)
+            return {'success': False, 'message': f'Failed to record lease: {str(e)}'}
+        lease_expiry.schedule(session, lease)
+        response['lease'] = leasesDatabase.formatLease(lease)
+    
+    # Log history entry
+    addHistoryEntry(client, projectId, 'checkout', hwSetName, qty, username, session=session)
+    return response
+
+# Helper to explain why a membership-filtered project write matched nothing
+def _projectAccessError(projects_collection, projectId, username, session=None):
+    project = projects_collection.find_one({'projectId': projectId}, {'users': 1}, session=session)
+    if not project:
+        return {'success': False, 'message': 'Project not found'}
+    if username not in project.get('users', []):
+        return {'success': False, 'message': 'User not authorized for this project'}
+    return None
 
 # Function to check in hardware for a project
 def checkInHW(client, projectId, hwSetName, qty, username):
     # Check in hardware for the specified project and update availability
+    # Uses a transaction when the deployment supports one, otherwise atomic writes with compensation
+    return db_utils.run_transactional(
+        client, lambda session: _checkInHW(client, projectId, hwSetName, qty, username, session)
+    )
+
+def _checkInHW(client, projectId, hwSetName, qty, username, session):
     import hardwareDatabase
     
     db = db_utils.get_database(client)
     projects_collection = db['projects']
     
-    # Check if project exists
-    project = projects_collection.find_one({'projectId': projectId})
+    # Decrement project usage only if the user is a member and enough is checked out
+    result = projects_collection.update_one(
+        {'projectId': projectId, 'users': username, f'hwSets.{hwSetName}': {'$gte': qty}},
+        {'$inc': {f'hwSets.{hwSetName}': -qty}},
+        session=session
+    )
+    
+    if result.matched_count == 0:
+        # Work out which precondition failed
+        return _projectAccessError(projects_collection, projectId, username, session) or \
+            {'success': False, 'message': 'Cannot check in more hardware than is checked out'}
+    
+    # Update hardware availability
+    hw_result = hardwareDatabase.releaseSpace(client, hwSetName, qty, session=session)
+    if not hw_result['success']:
+        # Outside a transaction, restore the project's usage ourselves
+        if session is None:
+            projects_collection.update_one(
+                {'projectId': projectId},
+                {'$inc': {f'hwSets.{hwSetName}': qty}}
+            )
+        if hw_result['message'] == 'Hardware set not found':
+            return hw_result
+        return {'success': False, 'message': 'Failed to update hardware availability'}
+    
+    # Units checked in by hand settle the project's leases on the set first
+    import leasesDatabase
+    leasesDatabase.settleLeases(client, projectId, hwSetName, qty, session=session)
+    
+    # Log history entry
+    addHistoryEntry(client, projectId, 'checkin', hwSetName, qty, username, session=session)
+    return {'success': True, 'message': f'Successfully checked in {qty} units of {hwSetName}', 'availability': hw_result['new_availability']}
+
+# Function to check out several hardware sets for a project in one request
+def checkOutHWBatch(client, projectId, items, username):
+    # items: list of {'hwSetName': str, 'qty': int}; either every item is checked out or none are
+    return db_utils.run_transactional(
+        client, lambda session: _applyHWBatch(client, projectId, items, username, 'checkout', session)
+    )
+
+# Function to check in several hardware sets for a project in one request
+def checkInHWBatch(client, projectId, items, username):
+    # items: list of {'hwSetName': str, 'qty': int}; either every item is checked in or none are
+    return db_utils.run_transactional(
+        client, lambda session: _applyHWBatch(client, projectId, items, username, 'checkin', session)
+    )
+
+# Batch tags older than this (seconds) were left by a batch that died part-way;
+# the next batch on the same hardware set drops them
+BATCH_TAG_TTL = 300
+
+# Helper to remove batch tags from hardware sets in one write, dropping the field once it is empty
+def _clearBatchTags(hardware_collection, names, tags):
+    remaining = {'$setDifference': [{'$ifNull': ['$pendingBatches', []]}, tags]}
+    hardware_collection.update_many(
+        {'hwName': {'$in': names}, 'pendingBatches': {'$exists': True}},
+        [{'$set': {'pendingBatches': {'$cond': [{'$eq': [remaining, []]}, '$$REMOVE', remaining]}}}]
+    )
+
+# Helper to list the tags of dead batches on the given hardware sets
+def _staleBatchTags(hardware_sets):
+    from bson import ObjectId
+    
+    # Tags are ObjectId strings, which sort by creation time
+    cutoff = str(ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=BATCH_TAG_TTL)))
+    return sorted({tag for hw in hardware_sets for tag in hw.get('pendingBatches', []) if tag < cutoff})
+
+def _applyHWBatch(client, projectId, items, username, action, session):
+    from pymongo import UpdateOne
+    from bson import ObjectId
+    import hardware_versions
+    import hardware_cache
+    
+    db = db_utils.get_database(client)
+    projects_collection = db['projects']
+    hardware_collection = db['hardware_sets']
+    checkout = action == 'checkout'
+    
+    # Merge repeated hardware sets so each document is written once
+    totals = {}
+    for item in items:
+        totals[item['hwSetName']] = totals.get(item['hwSetName'], 0) + item['qty']
+    names = list(totals)
+    
+    # Validate the project and membership once for the whole batch
+    project = projects_collection.find_one({'projectId': projectId}, {'users': 1, 'hwSets': 1}, session=session)
     if not project:
         return {'success': False, 'message': 'Project not found'}
-    
-    # Check if user is part of the project
-    if username not in project['users']:
+    if username not in project.get('users', []):
         return {'success': False, 'message': 'User not authorized for this project'}
     
-    # Check if project has this hardware checked out
-    current_usage = project['hwSets'].get(hwSetName, 0)
-    if current_usage < qty:
-        return {'success': False, 'message': 'Cannot check in more hardware than is checked out'}
+    # Validate every item up front so a failing batch reports each problem and writes nothing
+    hardware = {
+        hw['hwName']: hw
+        for hw in hardware_collection.find(
+            {'hwName': {'$in': names}},
+            {'_id': 0, 'hwName': 1, 'capacity': 1, 'availability': 1, 'shards': 1, 'writeSeq': 1, 'pendingBatches': 1},
+            session=session
+        )
+    }
+    usage = project.get('hwSets', {})
+    errors = {}
+    for name, qty in totals.items():
+        hw = hardware.get(name)
+        if not hw:
+            errors[name] = 'Hardware set not found'
+        elif hw.get('shards'):
+            # Batches update each set document in one write, which sharded sets do not have
+            errors[name] = 'Hardware set is sharded; check it out on its own'
+        elif checkout and hw['availability'] < qty:
+            errors[name] = 'Not enough hardware available'
+        elif not checkout and usage.get(name, 0) < qty:
+            errors[name] = 'Cannot check in more hardware than is checked out'
+        elif not checkout and hw['availability'] + qty > hw['capacity']:
+            errors[name] = 'Availability cannot exceed capacity'
+    if errors:
+        return {
+            'success': False,
+            'message': 'No hardware was changed because some items failed',
+            'results': [
+                {'hwSetName': item['hwSetName'], 'qty': item['qty'], 'success': item['hwSetName'] not in errors,
+                 'message': errors.get(item['hwSetName'], 'OK')}
+                for item in items
+            ]
+        }
     
-    # Update project's hardware usage
-    new_usage = current_usage - qty
+    # Outside a transaction, tag each hardware write so a partial batch can be undone precisely
+    batch_id = None if session is not None else str(ObjectId())
     
-    result = projects_collection.update_one(
-        {'projectId': projectId},
-        {'$set': {f'hwSets.{hwSetName}': new_usage}}
+    def write_hardware(sign, tagged):
+        # Every hardware write also marks the set for a new version (see hardware_versions.py)
+        token = hardware_versions.new_token()
+        ops = []
+        for name, qty in totals.items():
+            if sign < 0:
+                hw_filter = {'hwName': name, 'availability': {'$gte': qty}, 'shards': {'$exists': False}}
+            else:
+                hw_filter = {'hwName': name, 'shards': {'$exists': False}, '$expr': {'$lte': [{'$add': ['$availability', qty]}, '$capacity']}}
+            update = {'$inc': {'availability': sign * qty, 'writeSeq': 1}, '$push': {'versionPending': token}}
+            if tagged:
+                update['$push']['pendingBatches'] = batch_id
+            ops.append(UpdateOne(hw_filter, update))
+        hw_result = hardware_collection.bulk_write(ops, session=session)
+        hardware_versions.record_write(session, names, token)
+        return hw_result
+    
+    def undo_hardware(sign):
+        # Reverse only the writes that carry this batch's tag
+        token = hardware_versions.new_token()
+        hardware_collection.bulk_write([
+            UpdateOne({'hwName': name, 'pendingBatches': batch_id},
+                      {'$inc': {'availability': -sign * qty, 'writeSeq': 1}, '$pull': {'pendingBatches': batch_id},
+                       '$push': {'versionPending': token}})
+            for name, qty in totals.items()
+        ])
+        hardware_versions.record_write(None, names, token)
+        _clearBatchTags(hardware_collection, names, [])
+    
+    # Project update: all usage counters in a single write
+    project_filter = {'projectId': projectId, 'users': username}
+    if not checkout:
+        for name, qty in totals.items():
+            project_filter[f'hwSets.{name}'] = {'$gte': qty}
+    project_update = {'$inc': {f'hwSets.{name}': (qty if checkout else -qty) for name, qty in totals.items()}}
+    conflict = {'success': False, 'message': 'Hardware usage changed during the request, please retry'}
+    
+    if checkout:
+        # Reserve all hardware first, then record it on the project
+        sign = -1
+        hw_result = write_hardware(sign, batch_id is not None)
+        if hw_result.matched_count < len(totals):
+            if batch_id is not None:
+                undo_hardware(sign)
+            return conflict
+        result = projects_collection.update_one(project_filter, project_update, session=session)
+        if result.matched_count == 0:
+            if batch_id is not None:
+                undo_hardware(sign)
+            return conflict
+    else:
+        # Release from the project first, then return the hardware
+        sign = 1
+        result = projects_collection.update_one(project_filter, project_update, session=session)
+        if result.matched_count == 0:
+            return conflict
+        hw_result = write_hardware(sign, batch_id is not None)
+        if hw_result.matched_count < len(totals):
+            if batch_id is not None:
+                undo_hardware(sign)
+                projects_collection.update_one(
+                    {'projectId': projectId},
+                    {'$inc': {f'hwSets.{name}': qty for name, qty in totals.items()}}
+                )
+            return conflict
+
+    if not checkout:
+        # As with single check-ins, returned units settle the project's leases first
+        import leasesDatabase
+        for name, qty in totals.items():
+            leasesDatabase.settleLeases(client, projectId, name, qty, session=session)
+
+    # Log all history entries in one insert
+    db['usage_history'].insert_many(
+        [_historyEntry(projectId, action, item['hwSetName'], item['qty'], username) for item in items],
+        session=session
     )
     
-    if result.modified_count > 0:
-        # Update hardware availability
-        hw_query = hardwareDatabase.queryHardwareSet(client, hwSetName)
-        if hw_query['success']:
-            current_availability = hw_query['data']['availability']
-            new_availability = current_availability + qty
-            hw_update = hardwareDatabase.updateAvailability(client, hwSetName, new_availability)
-            if hw_update['success']:
-                # Log history entry
-                addHistoryEntry(client, projectId, 'checkin', hwSetName, qty, username)
-                return {'success': True, 'message': f'Successfully checked in {qty} units of {hwSetName}'}
-            else:
-                return {'success': False, 'message': 'Failed to update hardware availability'}
-        else:
-            return {'success': False, 'message': 'Hardware set not found'}
+    if batch_id is not None:
+        # Every write landed - clear the tag (and any a dead batch left) and read back the live availability
+        _clearBatchTags(hardware_collection, names, [batch_id] + _staleBatchTags(hardware.values()))
+        written = {
+            hw['hwName']: (hw['availability'], hw.get('writeSeq', 0))
+            for hw in hardware_collection.find(
+                {'hwName': {'$in': names}}, {'_id': 0, 'hwName': 1, 'availability': 1, 'writeSeq': 1}
+            )
+        }
     else:
-        return {'success': False, 'message': 'Failed to update project hardware usage'}
+        # Inside a transaction the validated snapshot plus our own change is exact
+        written = {
+            name: (hardware[name]['availability'] + sign * qty, hardware[name].get('writeSeq', 0) + 1)
+            for name, qty in totals.items()
+        }
+    availability = {}
+    for name, (value, seq) in written.items():
+        hardware_cache.note_availability(session, name, value, seq)
+        availability[name] = value
+    
+    verb = 'checked out' if checkout else 'checked in'
+    return {
+        'success': True,
+        'message': f'Successfully {verb} {len(items)} item(s)',
+        'results': [
+            {'hwSetName': item['hwSetName'], 'qty': item['qty'], 'success': True, 'message': 'OK'}
+            for item in items
+        ],
+        'availability': availability
+    }
 
 # Function to delete a project
 def deleteProject(client, projectId, username):
@@ -256,6 +567,10 @@ def deleteProject(client, projectId, username):
             {'$pull': {'projects': projectId}}
         )
     
+    # Drop the project's leases first so an expiry cannot return its units a second time
+    import leasesDatabase
+    leasesDatabase.deleteProjectLeases(client, projectId)
+    
     # Check in any checked-out hardware before deleting
     import hardwareDatabase
     hw_sets = project.get('hwSets', {})
@@ -270,19 +585,16 @@ def deleteProject(client, projectId, username):
             qty = 0
         
         if qty > 0:
-            # Check in the hardware
+            # Check in the hardware with an atomic increment (a read of the possibly
+            # cached availability followed by a write could lose concurrent updates)
             try:
-                hw_query = hardwareDatabase.queryHardwareSet(client, hw_set_name)
-                if hw_query['success']:
-                    current_availability = hw_query['data']['availability']
-                    new_availability = current_availability + qty
-                    update_result = hardwareDatabase.updateAvailability(client, hw_set_name, new_availability)
-                    if update_result['success']:
-                        total_checked_in[hw_set_name] = qty
-                    else:
-                        checkin_errors.append(f"Failed to check in {qty} units of {hw_set_name}: {update_result.get('message', 'Unknown error')}")
-                else:
+                release_result = hardwareDatabase.releaseSpace(client, hw_set_name, qty)
+                if release_result['success']:
+                    total_checked_in[hw_set_name] = qty
+                elif release_result['message'] == 'Hardware set not found':
                     checkin_errors.append(f"Hardware set {hw_set_name} not found")
+                else:
+                    checkin_errors.append(f"Failed to check in {qty} units of {hw_set_name}: {release_result['message']}")
             except Exception as e:
                 checkin_errors.append(f"Error checking in {hw_set_name}: {str(e)}")
     
@@ -296,6 +608,8 @@ def deleteProject(client, projectId, username):
     result = projects_collection.delete_one({'projectId': projectId})
     
     if result.deleted_count > 0:
+        # History lives in its own collection, so remove it alongside the project
+        db['usage_history'].delete_many({'projectId': projectId})
         return {'success': True, 'message': 'Project deleted successfully'}
     else:
         return {'success': False, 'message': 'Failed to delete project'}
@@ -393,6 +707,9 @@ def updateProjectId(client, oldProjectId, newProjectId, username):
     )
     
     if result.modified_count > 0:
+        # Keep the project's history attached to its new ID
+        db['usage_history'].update_many({'projectId': oldProjectId}, {'$set': {'projectId': newProjectId}})
+        
         # Update project ID in all users' projects lists
         project_users = project.get('users', [])
         for user in project_users:
@@ -452,75 +769,177 @@ def inviteUserToProject(client, projectId, inviteeUsername, inviterUsername):
     
     return {'success': True, 'message': f'Successfully invited {inviteeUsername} to the project'}
 
-# Function to add a history entry for hardware operations
-def addHistoryEntry(client, projectId, action, hwSetName, qty, username):
-    # Add a history entry for checkout/checkin operations
-    db = db_utils.get_database(client)
-    projects_collection = db['projects']
-    
-    # Check if project exists
-    project = projects_collection.find_one({'projectId': projectId})
-    if not project:
-        return {'success': False, 'message': 'Project not found'}
-    
-    # Create history entry
-    history_entry = {
+# Helper to copy one project's embedded usageHistory into usage_history; returns the entries moved
+def _migrateProjectHistory(db, project):
+    from pymongo import UpdateOne
+    
+    entries = project.get('usageHistory') or []
+    if entries:
+        # Each entry gets an _id derived from the project, its content and how many
+        # identical entries precede it: a re-run after an interruption upserts the
+        # same documents again, while identical entries still stay separate
+        seen = {}
+        operations = []
+        for entry in entries:
+            key = repr(sorted(entry.items()))
+            occurrence = seen[key] = seen.get(key, -1) + 1
+            entry_id = _legacyHistoryId(project['_id'], entry, f'{key}|{occurrence}')
+            operations.append(UpdateOne(
+                {'_id': entry_id},
+                {'$setOnInsert': dict(entry, projectId=project['projectId'])},
+                upsert=True
+            ))
+        db['usage_history'].bulk_write(operations, ordered=False)
+    # Pull exactly what was copied so concurrent pushes from older workers survive
+    db['projects'].update_one({'_id': project['_id']}, {'$pullAll': {'usageHistory': entries}})
+    db['projects'].update_one(
+        {'_id': project['_id'], 'usageHistory': {'$size': 0}}, {'$unset': {'usageHistory': ''}}
+    )
+    return len(entries)
+
+# Helper to build the deterministic ObjectId of a migrated entry: its timestamp, then a hash
+def _legacyHistoryId(project_id, entry, key):
+    import hashlib
+    from bson import ObjectId
+    
+    timestamp = entry.get('timestamp')
+    seconds = int((timestamp - datetime(1970, 1, 1)).total_seconds()) if isinstance(timestamp, datetime) else 0
+    digest = hashlib.sha1(f'{project_id}|{key}'.encode('utf-8')).digest()
+    return ObjectId(max(seconds, 0).to_bytes(4, 'big') + digest[:8])
+
+# Helper to build a usage history entry
+def _historyEntry(projectId, action, hwSetName, qty, username):
+    return {
+        'projectId': projectId,
         'timestamp': datetime.utcnow(),
-        'action': action,  # 'checkout' or 'checkin'
+        'action': action,  # 'checkout', 'checkin' or 'expire'
         'hwSetName': hwSetName,
         'qty': qty,
         'username': username
     }
+
+# Function to add a history entry for hardware operations
+def addHistoryEntry(client, projectId, action, hwSetName, qty, username, session=None):
+    # Append a history entry for checkout/checkin operations
+    db = db_utils.get_database(client)
+    history_collection = db['usage_history']
     
-    # Initialize usageHistory if it doesn't exist
-    if 'usageHistory' not in project:
-        result = projects_collection.update_one(
-            {'projectId': projectId},
-            {'$set': {'usageHistory': []}}
-        )
-    
-    # Add history entry (keep last 100 entries)
-    result = projects_collection.update_one(
-        {'projectId': projectId},
-        {
-            '$push': {
-                'usageHistory': {
-                    '$each': [history_entry],
-                    '$slice': -100  # Keep only last 100 entries
-                }
-            }
-        }
-    )
-    
-    if result.modified_count > 0:
-        return {'success': True, 'message': 'History entry added'}
-    else:
-        return {'success': False, 'message': 'Failed to add history entry'}
+    history_collection.insert_one(_historyEntry(projectId, action, hwSetName, qty, username), session=session)
+    return {'success': True, 'message': 'History entry added'}
+
+# Helpers to build and parse history cursors.
+# A cursor is '<ISO timestamp>|<entry id>'; the id breaks ties between entries
+# logged in the same millisecond. A bare ISO timestamp is accepted as well.
+HISTORY_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%L'
+
+def _parseHistoryCursor(value):
+    from bson import ObjectId
+    
+    if value is None:
+        return None
+    timestamp, _, entry_id = str(value).partition('|')
+    timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00')).replace(tzinfo=None)
+    return timestamp, ObjectId(entry_id) if entry_id else None
+
+def _historyBound(cursor, op):
+    # Entries strictly beyond the cursor in (timestamp, _id) order
+    timestamp, entry_id = cursor
+    if entry_id is None:
+        return {'timestamp': {op: timestamp}}
+    return {'$or': [{'timestamp': {op: timestamp}}, {'timestamp': timestamp, '_id': {op: entry_id}}]}
 
 # Function to get project usage history
-def getProjectUsageHistory(client, projectId, limit=50):
-    # Get usage history for a project
+def getProjectUsageHistory(client, projectId, limit=50, before=None, after=None):
+    # Get one page of usage history for a project, most recent first.
+    # 'before' pages towards older entries and 'after' towards newer ones;
+    # both take a value from the 'cursor' of a previous page.
     db = db_utils.get_database(client)
     projects_collection = db['projects']
+    history_collection = db['usage_history']
     
     # Check if project exists
-    project = projects_collection.find_one({'projectId': projectId})
-    if not project:
+    project = projects_collection.find_one({'projectId': projectId}, {'projectId': 1, 'usageHistory': 1})
+    if project is None:
         return {'success': False, 'message': 'Project not found'}
+    if 'usageHistory' in project:
+        # Not migrated yet: move its history over before the first page is read
+        _migrateProjectHistory(db, project)
+    
+    try:
+        before = _parseHistoryCursor(before)
+        after = _parseHistoryCursor(after)
+        limit = max(1, min(int(limit), 500))
+    except Exception:
+        return {'success': False, 'message': 'Invalid limit or cursor'}
+    
+    conditions = [{'projectId': projectId}]
+    if before is not None:
+        conditions.append(_historyBound(before, '$lt'))
+    if after is not None:
+        conditions.append(_historyBound(after, '$gt'))
+    query = conditions[0] if len(conditions) == 1 else {'$and': conditions}
+    
+    # Sort, limit and format inside Mongo: paging forward from 'after' walks the
+    # index ascending and the page is flipped back to newest first. One entry
+    # past the page is read only to tell whether there are more, then dropped.
+    # The page comes back as a single document, already JSON-ready, with its
+    # boundary cursors.
+    direction = 1 if after is not None and before is None else -1
+    cursor_expr = {'$concat': [{'$dateToString': {'date': '$timestamp', 'format': HISTORY_TIMESTAMP_FORMAT}}, '|', {'$toString': '$_id'}]}
+    history = {'$slice': ['$history', limit]}
+    cursors = {'$slice': ['$cursors', limit]}
+    if direction == 1:
+        history = {'$reverseArray': history}
+        cursors = {'$reverseArray': cursors}
+    pipeline = [
+        {'$match': query},
+        {'$sort': {'timestamp': direction, '_id': direction}},
+        {'$limit': limit + 1},
+        {'$group': {
+            '_id': None,
+            'history': {'$push': {
+                'timestamp': {'$dateToString': {'date': '$timestamp', 'format': HISTORY_TIMESTAMP_FORMAT}},
+                'action': '$action',
+                'hwSetName': '$hwSetName',
+                'qty': '$qty',
+                'username': '$username'
+            }},
+            'cursors': {'$push': cursor_expr},
+            'count': {'$sum': 1}
+        }},
+        {'$project': {
+            '_id': 0,
+            'history': history,
+            'after': {'$arrayElemAt': [cursors, 0]},
+            'before': {'$arrayElemAt': [cursors, -1]},
+            'hasMore': {'$gt': ['$count', limit]}
+        }}
+    ]
+    page = next(history_collection.aggregate(pipeline), None)
+    if page is None:
+        return {'success': True, 'history': [], 'cursor': {'before': None, 'after': None}, 'hasMore': False}
+    
+    return {
+        'success': True,
+        'history': page['history'],
+        'cursor': {'before': page['before'], 'after': page['after']},
+        'hasMore': page['hasMore']
+    }
+
+# Function to move embedded usageHistory arrays into the usage_history collection
+def migrateEmbeddedUsageHistory(client, batch_size=100):
+    # Online and idempotent (see _migrateProjectHistory), so it can be re-run or
+    # interrupted. getProjectUsageHistory also migrates a project on first read.
+    db = db_utils.get_database(client)
+    projects_collection = db['projects']
     
-    # Get history entries
-    history = project.get('usageHistory', [])
-    
-    # Sort by timestamp (most recent first) and limit
-    history_sorted = sorted(history, key=lambda x: x.get('timestamp', datetime.min), reverse=True)[:limit]
-    
-    # Convert datetime objects to ISO format strings for JSON serialization
-    history_formatted = []
-    for entry in history_sorted:
-        formatted_entry = entry.copy()
-        if 'timestamp' in formatted_entry and isinstance(formatted_entry['timestamp'], datetime):
-            formatted_entry['timestamp'] = formatted_entry['timestamp'].isoformat()
-        history_formatted.append(formatted_entry)
+    migrated_projects = 0
+    migrated_entries = 0
+    projects = projects_collection.find(
+        {'usageHistory': {'$exists': True}}, {'projectId': 1, 'usageHistory': 1}, batch_size=batch_size
+    )
+    for project in projects:
+        migrated_entries += _migrateProjectHistory(db, project)
+        migrated_projects += 1
     
-    return {'success': True, 'history': history_formatted}
-
+    return {'success': True, 'message': f'Migrated {migrated_entries} history entries from {migrated_projects} projects'}
@@ -0,0 +1,202 @@
+# Static files of the React build, scanned once into an in-memory manifest
+#
+# serve() and the 404 handler in app.py look paths up in the manifest instead
+# of probing the filesystem on every request, and index.html is served from
+# memory. Files under static/ carry a content hash in their name
+# (main.3f2a1b9c.js), so browsers may cache them for a year as immutable;
+# everything else is revalidated with its ETag. Precompressed siblings
+# (file.br, file.gz) are sent to clients that accept them; build.sh writes
+# them with:
+#
+#   python server/static_assets.py compress client/build
+#
+# STATIC_WATCH=true rescans the build directory whenever it changes, for
+# development while the client is being rebuilt.
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+
+from flask import Response, request, send_file
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are written without it
+    brotli = None
+
+# One year, the longest lifetime browsers honour
+IMMUTABLE_MAX_AGE = 31536000
+# Content hash in a build file name, e.g. main.3f2a1b9c.js or 453.1a2b3c4d.chunk.css
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.')
+# Precompressed variants in order of preference: (Content-Encoding, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico')
+
+# Development: rescan the build directory when it changes
+STATIC_WATCH = os.environ.get('STATIC_WATCH', 'false').lower() == 'true'
+STATIC_WATCH_INTERVAL = float(os.environ.get('STATIC_WATCH_INTERVAL', '1'))
+
+_manifest = None
+_watched_dirs = set()
+
+class Asset:
+    """One file of the build with its response metadata and compressed variants."""
+
+    def __init__(self, path, mimetype, etag, immutable, variants):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = etag
+        self.immutable = immutable
+        self.variants = variants  # Content-Encoding -> path of the precompressed file
+
+class Manifest:
+    """Immutable snapshot of a build directory; rescans replace it whole."""
+
+    def __init__(self, build_dir, assets, index):
+        self.build_dir = build_dir
+        self.assets = assets  # URL path without the leading slash -> Asset
+        self.index = index    # Content-Encoding (None for identity) -> bytes of index.html, or None if not built
+
+def scan(build_dir):
+    """Walk build_dir once and return its Manifest."""
+    assets = {}
+    index = None
+    for root, _, files in os.walk(build_dir):
+        names = set(files)
+        for name in files:
+            if name.endswith(tuple(suffix for _, suffix in ENCODINGS)) and name[:name.rfind('.')] in names:
+                continue  # a variant, served through its original
+            path = os.path.join(root, name)
+            url_path = os.path.relpath(path, build_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = {encoding: path + suffix for encoding, suffix in ENCODINGS if name + suffix in names}
+            asset = Asset(
+                path,
+                mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                hashlib.sha256(data).hexdigest()[:32],
+                url_path.startswith('static/') and bool(HASHED_NAME.search(name)),
+                variants
+            )
+            assets[url_path] = asset
+            if url_path == 'index.html':
+                index = {None: data}
+                for encoding, variant_path in variants.items():
+                    with open(variant_path, 'rb') as f:
+                        index[encoding] = f.read()
+    return Manifest(build_dir, assets, index)
+
+def init(build_dir):
+    """Build the manifest for build_dir and start the watcher when STATIC_WATCH is set."""
+    global _manifest
+    _manifest = scan(build_dir)
+    if STATIC_WATCH:
+        start_watcher(build_dir)
+    return _manifest
+
+def get_manifest():
+    return _manifest
+
+def _preferred_encoding(asset):
+    # Best precompressed variant the client accepts, or None for the original
+    for encoding, _ in ENCODINGS:
+        if encoding in asset.variants and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def _set_caching(response, asset, encoding):
+    if asset.immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+
+def asset_response(asset):
+    """Send a build file, precompressed when possible, with its cache headers."""
+    encoding = _preferred_encoding(asset)
+    path = asset.variants[encoding] if encoding else asset.path
+    etag = f'{asset.etag}-{encoding}' if encoding else asset.etag
+    response = send_file(path, mimetype=asset.mimetype, etag=etag, conditional=True)
+    _set_caching(response, asset, encoding)
+    return response
+
+def index_response(manifest):
+    """Serve index.html from memory; it always revalidates so new deploys are picked up."""
+    asset = manifest.assets['index.html']
+    encoding = _preferred_encoding(asset)
+    response = Response(manifest.index[encoding], mimetype=asset.mimetype)
+    response.set_etag(f'{asset.etag}-{encoding}' if encoding else asset.etag)
+    _set_caching(response, asset, encoding)
+    return response.make_conditional(request)
+
+def _signature(build_dir):
+    # Cheap change detector: every file's path, size and modification time
+    entries = []
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue  # removed mid-walk by a rebuild
+            entries.append((root, name, stat.st_size, stat.st_mtime_ns))
+    return hash(tuple(sorted(entries)))
+
+def _watch_loop(build_dir, signature):
+    global _manifest
+    while True:
+        time.sleep(STATIC_WATCH_INTERVAL)
+        current = _signature(build_dir)
+        if current != signature:
+            signature = current
+            try:
+                _manifest = scan(build_dir)
+                print(f'Static manifest reloaded: {len(_manifest.assets)} files')
+            except OSError as e:
+                # Build still in progress; the next change triggers another scan
+                print(f'Static manifest reload failed: {str(e)}')
+
+def start_watcher(build_dir):
+    """Start the development watcher thread for build_dir (once per process)."""
+    if build_dir in _watched_dirs:
+        return
+    _watched_dirs.add(build_dir)
+    # Baseline taken now so changes made right after startup are not missed
+    threading.Thread(target=_watch_loop, args=(build_dir, _signature(build_dir)), daemon=True).start()
+
+def compress(build_dir, min_size=1024):
+    """Write .gz (and .br when brotli is installed) next to every compressible file."""
+    written = 0
+    for root, _, files in os.walk(build_dir):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < min_size:
+                continue
+            variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                # Only keep variants that actually save bytes
+                if len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                    written += 1
+    return written
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'compress':
+        sys.exit('usage: python static_assets.py compress <build_dir>')
+    print(f'Wrote {compress(sys.argv[2])} precompressed files in {sys.argv[2]}')
@@ -1,6 +1,7 @@
 # Import necessary libraries and modules
 from pymongo import MongoClient
-from decryptEncrypt import encrypt_password, verify_password
+from pymongo.errors import DuplicateKeyError
+from decryptEncrypt import encrypt_password, verify_password, needs_rehash, HasherBusyError
 import db_utils
 
 # Note: Import projectsDatabase when needed to avoid circular imports
@@ -21,16 +22,6 @@ def addUser(client, username, email, password):
     db = db_utils.get_database(client)
     users_collection = db['users']
     
-    # Check if username already exists
-    existing_username = users_collection.find_one({'username': username})
-    if existing_username:
-        return {'success': False, 'message': 'Username already exists'}
-    
-    # Check if email already exists
-    existing_email = users_collection.find_one({'email': email})
-    if existing_email:
-        return {'success': False, 'message': 'Email already registered'}
-    
     # Encrypt the password before storing
     try:
         encrypted_password = encrypt_password(password)
@@ -45,23 +36,20 @@ def addUser(client, username, email, password):
         'projects': []
     }
     
+    # Uniqueness of username and email is enforced by unique indexes (see db_utils.INDEXES)
+    db_utils.require_unique_indexes(client, 'users')
     try:
         result = users_collection.insert_one(user)
         return {'success': True, 'id': str(result.inserted_id)}
-    except Exception as e:
-        error_str = str(e)
-        # Check if it's a duplicate key error
-        if 'E11000' in error_str:
-            # Check if it's related to userId
-            if 'userId' in error_str:
-                return {'success': False, 'message': f'Database configuration error: Unique index on userId field exists. Error: {error_str}. Please run: python3 fix_userid_index.py'}
-            # Could be username or email duplicate
-            elif 'username' in error_str:
-                return {'success': False, 'message': 'Username already exists'}
-            elif 'email' in error_str:
-                return {'success': False, 'message': 'Email already registered'}
-        # Re-raise other exceptions
-        raise
+    except DuplicateKeyError as e:
+        field = db_utils.duplicate_key_field(e)
+        if field == 'username':
+            return {'success': False, 'message': 'Username already exists'}
+        elif field == 'email':
+            return {'success': False, 'message': 'Email already registered'}
+        elif field == 'userId':
+            return {'success': False, 'message': f'Database configuration error: Unique index on userId field exists. Error: {str(e)}. Please call POST /admin/drop_userid_index'}
+        return {'success': False, 'message': 'Username or email already registered'}
 
 # Helper function to query a user by username
 def __queryUserByUsername(client, username):
@@ -72,6 +60,20 @@ def __queryUserByUsername(client, username):
     user = users_collection.find_one({'username': username})
     return user
 
+# Helper function to re-hash a password with the configured cost factor
+def __rehashPassword(client, user, password):
+    try:
+        new_hash = encrypt_password(password)
+    except HasherBusyError:
+        # Not worth failing a login over; try again next time
+        return
+    db = db_utils.get_database(client)
+    # Only replace the hash we verified, in case the password changed meanwhile
+    db['users'].update_one(
+        {'_id': user['_id'], 'password': user['password']},
+        {'$set': {'password': new_hash}}
+    )
+
 # Function to log in a user
 def login(client, username, password=None):
     # Authenticate a user by username and return login status
@@ -81,6 +83,9 @@ def login(client, username, password=None):
     
     # Verify password using the encrypted password stored in database
     if verify_password(password, user['password']):
+        # Upgrade hashes made with a different cost factor while we know the password
+        if needs_rehash(user['password']):
+            __rehashPassword(client, user, password)
         return {'success': True, 'message': 'Login successful', 'user_data': {
             'username': user['username'],
             'email': user.get('email', ''),
@@ -160,15 +165,26 @@ def getUserProjectsList(client, username):
     users = db['users']
     projects = db['projects']
 
-    user = users.find_one({'username': username})
+    user = users.find_one({'username': username}, {'_id': 0, 'projects': 1})
     if not user:
         return {'success': False, 'message': 'User not found'}
 
     project_ids = user.get("projects", [])
 
+    # One query for all of the user's projects, fetching only the displayed fields
+    found = {
+        proj["projectId"]: proj
+        for proj in projects.find(
+            {'projectId': {'$in': project_ids}},
+            {'_id': 0, 'projectId': 1, 'projectName': 1, 'description': 1, 'hwSets': 1, 'owner': 1}
+        )
+    } if project_ids else {}
+
+    # Keep the user's ordering and collect ids that no longer point at a project
     project_list = []
+    missing = []
     for pid in project_ids:
-        proj = projects.find_one({'projectId': pid})
+        proj = found.get(pid)
         if proj:
             project_list.append({
                 "projectId": proj.get("projectId"),
@@ -177,8 +193,13 @@ def getUserProjectsList(client, username):
                 "hwSets": proj.get("hwSets", {}),   # shows the hardware sets
                 "owner": proj.get("owner")  # shows the project owner
             })
+        else:
+            missing.append(pid)
+
+    if missing:
+        print(f"Warning: user {username} references missing projects: {', '.join(map(str, missing))}")
 
-    return {"success": True, "projects": project_list}
+    return {"success": True, "projects": project_list, "missingProjectIds": missing}
 
 # Function to handle forgot password request
 def forgotPassword(client, email):